@@ -1,4 +1,8 @@
+import hashlib
+import logging
+import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import matplotlib.font_manager as fm
@@ -11,32 +15,49 @@ from skimage import exposure
 from tqdm import tqdm
 
 from ..guis import openfilegui
+from ..metadata import get_fr, get_nchannels, get_zs, si_metadata
+from ..tiffindex import index_tiff
+
+logger = logging.getLogger('live2p')
 
 class SItiff:
-    def __init__(self, path) -> None:
+    def __init__(self, path, cache_dir=None) -> None:
+        """
+        ScanImage tiff with lazy loading. Only the metadata is read here, the pixel data is read
+        the first time self.data is used. Mean/max images stream through the file in chunks and are
+        cached on disk (see project_tiffs).
+
+        Args:
+            path (str or Path): path to the tiff
+            cache_dir (str or Path, optional): folder for cached projections. Defaults to None,
+                                               which is 'live2p/cache' in the tiff's folder.
+        """
         self.path = str(path)
+        self.cache_dir = cache_dir
+        self._data = None
         
         self._metadata = metadata_to_dict(self.path)
         
-        chans = self._eval_numeric_metadata('channelSave')
-        if isinstance(chans, int):
-            self.nchannels = 1
-        else:
-            self.nchannels = len(chans)
-            
-        self.fr = self._eval_numeric_metadata('scanVolumeRate')
-        self.zs = self._eval_numeric_metadata('zs')
+        self.nchannels = get_nchannels(self.path)
+        self.fr = get_fr(self.path)
+        self.zs = get_zs(self.path)
         self.nplanes = len(self.zs)
         
-        with ScanImageTiffReader(self.path) as reader:
-            self.data = reader.data()
+    @property
+    def data(self):
+        """Full tiff (all planes and channels), read on first use."""
+        if self._data is None:
+            with ScanImageTiffReader(self.path) as reader:
+                self._data = reader.data()
+        return self._data
+    
+    def projection(self, z_idx, channel, kind='mean', cache=True):
+        """Mean or max projection of one plane and channel. See project_tiffs."""
+        return project_tiffs([self.path], z_idx, channel, self.nchannels, self.nplanes, kind=kind,
+                             cache_dir=self.cache_dir if cache else False)
     
-    def _eval_numeric_metadata(self, key):
-        return eval(self._metadata[key].replace(' ',',').replace(';',','))
-        
     def mean_img(self, z_idx, channel, scaling=None, as_rgb=False, rgb_ch=None, blue_as_cyan=True):
-        tslice = get_tslice(z_idx, channel, self.nchannels, self.nplanes)
-        mimg = np.mean(self.data[tslice,:,:], axis=0)
+        mimg = self.projection(z_idx, channel, 'mean')
         mimg -= mimg.min()
         
         if scaling:
@@ -120,19 +141,107 @@ class SItiff:
     
     
 def metadata_to_dict(file):
-    """Read the SI metadata and turn in into a dict. Does not cast/eval values."""
+    """
+    Read the SI metadata and turn in into a dict, keyed by only the last part of the fieldname.
+    Values are parsed into Python types (see live2p.metadata), and cached per file.
+    """
+    return {k.split('.')[-1]:v for k,v in si_metadata(file).items()}
+
+def project_tiffs(files, z_idx, channel, nchannels, nplanes, kind='mean', chunk=256, 
+                  processes=None, cache_dir=None):
+    """
+    Mean or max projection of one plane and channel across many tiffs. Each tiff is read in
+    chunks of pages (without loading the whole file), reduced, and the per-tiff result is cached on
+    disk, keyed by the file's path, size and modified time. Adding tiffs to an epoch only reads the
+    new ones.
+
+    Args:
+        files (list): list of str or Path of tiffs
+        z_idx (int): plane
+        channel (int): channel
+        nchannels (int): number of channels saved in the tiffs
+        nplanes (int): number of planes in the tiffs
+        kind (str, optional): 'mean' or 'max'. Defaults to 'mean'.
+        chunk (int, optional): number of pages to read at a time. Defaults to 256.
+        processes (int, optional): number of processes to reduce tiffs in parallel. Defaults to
+                                   None (in this process).
+        cache_dir (str, Path or False, optional): folder for the cache. Defaults to None, which is
+                                                  'live2p/cache' in each tiff's folder. False turns
+                                                  off caching.
+
+    Returns:
+        np.array of (y, x) projection
+    """
+    if kind not in ('mean', 'max'):
+        raise ValueError(f"kind must be 'mean' or 'max', not '{kind}'.")
+    
+    jobs = [(str(f), z_idx, channel, nchannels, nplanes, kind, chunk, cache_dir) for f in files]
+    if processes and len(jobs) > 1:
+        with ProcessPoolExecutor(processes) as pool:
+            parts = list(pool.map(_project_file, jobs))
+    else:
+        parts = [_project_file(job) for job in jobs]
     
-    with ScanImageTiffReader(file) as reader:
-        meta = reader.metadata()
+    parts = [p for p in parts if p[1] > 0]
+    if not parts:
+        raise ValueError(f'No frames for plane {z_idx} channel {channel} in the tiffs.')
     
-    # split at the new line marker
-    meta = meta.split('\n')
-    # filter out the ROI data by keeping fields that start with SI.
-    meta = list(filter(lambda x: 'SI.' in x, meta))
-    # make dictionary by splitting at equals, and only keep the last part of the fieldname as the key
-    d = {k.split('.')[-1]:v for k,v in (entry.split(' = ') for entry in meta)}
+    if kind == 'mean':
+        return sum(p[0] for p in parts) / sum(p[1] for p in parts)
+    return np.max([p[0] for p in parts], axis=0).astype(np.float64)
+
+def _project_file(job):
+    """Reduce one tiff to (sum or max, nframes), from the cache if it's there."""
+    path, z_idx, channel, nchannels, nplanes, kind, chunk, cache_dir = job
+    
+    cache_path = None
+    if cache_dir is not False:
+        cache_path = _projection_cache_path(path, z_idx, channel, nchannels, nplanes, kind, cache_dir)
+        if cache_path.exists():
+            try:
+                with np.load(cache_path) as cached:
+                    return cached['img'], int(cached['n'])
+            except Exception:
+                logger.warning(f'Cached projection {cache_path.name} could not be read. Recomputing.')
+    
+    reduce = np.add if kind == 'mean' else np.maximum
+    img = None
+    n = 0
+    pages = get_tslice(z_idx, channel, nchannels, nplanes)
+    idx = index_tiff(path)
+    if idx is not None:
+        pages = range(*slice(pages.start, None, pages.step).indices(len(idx)))
+        for i in range(0, len(pages), chunk):
+            block = idx.pages(pages[i:i+chunk])
+            part = block.sum(axis=0, dtype=np.float64) if kind == 'mean' else block.max(axis=0)
+            img = part if img is None else reduce(img, part)
+            n += block.shape[0]
+        idx.close()
+    else:
+        # not an indexable tiff, read it whole
+        with ScanImageTiffReader(path) as reader:
+            block = reader.data()[pages.start::pages.step]
+        if block.shape[0] > 0:
+            img = block.sum(axis=0, dtype=np.float64) if kind == 'mean' else block.max(axis=0)
+            n = block.shape[0]
     
-    return d
+    if cache_path is not None and img is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # write then rename so a crash or another process never leaves a partial file
+        tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp.npz')
+        np.savez(tmp_path, img=img, n=n)
+        os.replace(tmp_path, cache_path)
+    
+    return img, n
+
+def _projection_cache_path(path, z_idx, channel, nchannels, nplanes, kind, cache_dir=None):
+    # file identity is path + size + modified time, so changed files are recomputed
+    stat = os.stat(path)
+    key = f'{Path(path).resolve()}|{stat.st_size}|{stat.st_mtime_ns}|{z_idx}|{channel}|{nchannels}|{nplanes}|{kind}'
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    if cache_dir is None:
+        cache_dir = Path(path).parent/'live2p'/'cache'
+    return Path(cache_dir)/f'{Path(path).stem}_{kind}_z{z_idx}_ch{channel}_{digest}.npz'
 
 def get_tslice(z_idx, ch_idx, nchannels, nplanes):
     return slice((z_idx*nchannels)+ch_idx, -1, nplanes*nchannels)
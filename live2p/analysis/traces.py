@@ -1,11 +1,13 @@
 import warnings
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 import scipy.stats as stats
 import sklearn.preprocessing
 
-def process_data(raw_traces, trial_lengths, fr, new_start=1, norm_method='scale', stim_times=None, total_length=None, **kwargs):
+def process_data(raw_traces, trial_lengths, fr, new_start=1, norm_method='scale', stim_times=None, total_length=None,
+                 return_lengths=False, **kwargs):
     """
     Run the post-processing pipeline on traces. Performs min subtraction, normalizes the data, and
     makes it into trialwise data (trials, cells, time). Optionally run stim alignment (either by 
@@ -30,10 +32,13 @@ def process_data(raw_traces, trial_lengths, fr, new_start=1, norm_method='scale'
         norm_method (str, optional): Normalization method. Defaults to 'scale' (see above).
         stim_times (array-like, optional): List of stim times that is lengths of trials or cells. Defaults to None.
         total_length (float or int, optional): Desired length of PSTHs. Defaults to None (no cutting).
+        return_lengths (bool, optional): also return the number of frames of each trial in the
+                                         PSTHs (see trial_mask). Defaults to False.
 
     Returns:
         traces (cells, frames)
-        trailwise_data (trials, cells, frames)
+        trailwise_data (trials, cells, frames), NaN padded where trials are short
+        trial lengths (trials,) if return_lengths
     """
     
     # min subtract and normalize
@@ -43,13 +48,13 @@ def process_data(raw_traces, trial_lengths, fr, new_start=1, norm_method='scale'
     traces = normalize_data(data, norm_method)
     
     # make data trialwise
-    trialwise_data = make_trialwise(traces, trial_lengths) # trials, cells, time
+    trialwise_data, lengths = make_trialwise(traces, trial_lengths, return_lengths=True) # trials, cells, time
     
     # stimtime alignment (either by cell or by trial)
     new_start *= fr
     new_start = int(new_start)
     if stim_times is not None:
-        stim_times = np.array(stim_times)
+        stim_times = np.array(stim_times, dtype=float)
         stim_times *= fr
         trialwise_data = stimalign(trialwise_data, stim_times, new_start)
     
@@ -61,53 +66,273 @@ def process_data(raw_traces, trial_lengths, fr, new_start=1, norm_method='scale'
     if total_length is not None:
         total_length *= fr
         total_length = int(total_length)
-        trialwise_data = cut_psths(trialwise_data, length=total_length)
+        trialwise_data, lengths = cut_psths(trialwise_data, length=total_length, lengths=lengths)
     
+    if return_lengths:
+        return traces, trialwise_data, lengths
     return traces, trialwise_data
 
 def stimalign(trialwise_data: np.ndarray, stim_times: np.ndarray, new_start: int):
-    stim_times = stim_times.round().astype(int)
-    stim_times[np.isnan(stim_times)] = 0 # this is one way to handle cells that don't get stimmed
+    """
+    Align trialwise data so the stim time lands on frame new_start. Frames shifted in from outside
+    the trial are NaN (instead of wrapping around).
     
-    aligned_data = np.zeros_like(trialwise_data)
-    if len(stim_times) == trialwise_data.shape[1]: # aka number of cells, like stim test
-        for i in range(trialwise_data.shape[0]):
-            aligned_data[i,...] = np.array([np.roll(cell_trace, -amt+new_start) for cell_trace, amt in zip(trialwise_data[i,...], stim_times)])
+    Stim times can be per cell (like stim test), per trial (like ori epoch), or a full 
+    trial x cell array (unique each trial). NaN stim times (eg. cells that don't get stimmed) 
+    are treated as 0. 
     
-    elif len(stim_times) == trialwise_data.shape[0]: # aka number of trials, like ori epoch, although note this breaks in true online mode bc last tiff
-        for i in range(trialwise_data.shape[0]):
-            aligned_data[i,...] = np.roll(trialwise_data[i,...], -int(stim_times[i])+new_start, axis=1)
-            
-    # TODO: eventually add support for trial x cell stim times (unique each trial)
+    There are only a handful of unique shifts (bounded by the trial length), so traces are grouped
+    by shift and each group is moved with a single slice copy instead of rolling trace by trace.
+
+    Args:
+        trialwise_data (np.ndarray): trials x cells x time
+        stim_times (np.ndarray): stim times in frames, (cells,), (trials,), or (trials, cells)
+        new_start (int): frame to align the stim times to
+
+    Returns:
+        aligned data, trials x cells x time
+    """
+    trialwise_data = np.asarray(trialwise_data, dtype=float)
+    ntrials, ncells, nframes = trialwise_data.shape
+    stim_times = np.asarray(stim_times, dtype=float)
+    
+    if stim_times.shape == (ntrials, ncells): # trial x cell stim times
+        shifts = stim_times
+    elif stim_times.ndim == 1 and len(stim_times) == ncells: # aka number of cells, like stim test
+        shifts = stim_times[None,:]
+    elif stim_times.ndim == 1 and len(stim_times) == ntrials: # aka number of trials, like ori epoch
+        shifts = stim_times[:,None]
     else:
-        warnings.warn('Length of stim times did not match the number of cells or number of trials. Stim alignment not done.')
+        warnings.warn('Shape of stim times did not match the number of cells, number of trials, or trials x cells. Stim alignment not done.')
+        return trialwise_data
+    
+    # this is one way to handle cells that don't get stimmed
+    shifts = np.nan_to_num(shifts.round(), nan=0).astype(int) - new_start
+    
+    aligned_data = np.full_like(trialwise_data, np.nan)
+    for shift in np.unique(shifts):
+        if abs(shift) >= nframes:
+            continue
+        # aligned[t] = data[t + shift] where both are inside the trial
+        dst = slice(max(0, -shift), nframes - max(0, shift))
+        src = slice(max(0, shift), nframes + min(0, shift))
+        if shifts.shape[1] == 1:
+            trials = np.flatnonzero(shifts[:,0] == shift)
+            aligned_data[trials,:,dst] = trialwise_data[trials,:,src]
+        elif shifts.shape[0] == 1:
+            cells = np.flatnonzero(shifts[0] == shift)
+            aligned_data[:,cells,dst] = trialwise_data[:,cells,src]
+        else:
+            mask = shifts == shift
+            aligned_data[mask,dst] = trialwise_data[mask,src]
             
     return aligned_data
 
-def make_trialwise(traces, splits):
-    """Returns trial x cell x time."""
-    traces = np.split(traces, np.cumsum(splits[:-1]).astype(np.uint), axis=1)
-    shortest = min([s.shape[1] for s in traces])
-    return np.array([a[:, :shortest] for a in traces])
+def make_trialwise(traces, splits, return_lengths=False):
+    """
+    Returns trial x cell x time, padded with NaN to the longest trial so no frames are dropped.
+
+    Args:
+        traces (np.ndarray): cells x time
+        splits (array-like): length of each trial in frames
+        return_lengths (bool, optional): also return the length of each trial (clipped to the 
+                                         frames available in traces). Defaults to False.
+
+    Returns:
+        trialwise data (trials, cells, max length), and optionally trial lengths (trials,)
+    """
+    traces = np.asarray(traces)
+    splits = np.asarray(splits, dtype=int)
+    starts = np.concatenate([[0], np.cumsum(splits[:-1])])
+    lengths = np.clip(np.minimum(splits, traces.shape[1] - starts), 0, None)
+    
+    trialwise = np.full((len(splits), traces.shape[0], lengths.max(initial=0)), np.nan)
+    for i, (start, length) in enumerate(zip(starts, lengths)):
+        trialwise[i,:,:length] = traces[:,start:start+length]
+    
+    if return_lengths:
+        return trialwise, lengths
+    return trialwise
+
+def trial_mask(lengths, nframes):
+    """Boolean mask (trials, time) that is True for frames inside each trial."""
+    return np.arange(nframes) < np.asarray(lengths).reshape(-1,1)
 
 def min_subtract(traces):
-    return traces - traces.min(axis=1).reshape(-1,1)
+    # nanmin, frames skipped by a degraded worker are NaN
+    return traces - np.nanmin(traces, axis=1).reshape(-1,1)
 
 def baseline_subtract(cut_traces, baseline_length):
-    baseline = cut_traces[:,:,:baseline_length].mean(axis=2)
+    # nanmean since short trials are NaN padded and stim alignment leaves NaNs at the edges
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning) # all NaN baselines
+        baseline = np.nanmean(cut_traces[:,:,:baseline_length], axis=2)
     psths_baselined = cut_traces - baseline.reshape(*cut_traces.shape[:2], 1)
     return psths_baselined
 
-def cut_psths(stim_aligned, length=25):
+def cut_psths(stim_aligned, length=25, lengths=None):
+    """
+    Cut PSTHs to length frames. If lengths (per trial) is given, also returns the lengths of the
+    cut trials. PSTHs are NaN padded if length is longer than the trials.
+    """
     cut_psths = stim_aligned[:,:,:length]
+    if cut_psths.shape[2] < length:
+        pad = np.full((*cut_psths.shape[:2], length - cut_psths.shape[2]), np.nan)
+        cut_psths = np.concatenate([cut_psths, pad], axis=2)
+    if lengths is not None:
+        return cut_psths, np.minimum(lengths, length)
     return cut_psths
 
-def rolling_baseline_dff(traces):
-    f0s = pd.DataFrame(traces.T).rolling(200, min_periods=1, center=True).quantile(0.2)
-    f0s = f0s.values.T
+def rolling_baseline_dff(traces, window=200, q=0.2, step=1):
+    """dF/F with F0 as the rolling (centered) quantile of each trace. See rolling_f0."""
+    f0s = rolling_f0(traces, window=window, q=q, step=step)
     traces = (traces-f0s)/f0s
     return traces
 
+def rolling_f0(traces, window=200, q=0.2, step=1, chunk=1000):
+    """
+    Centered rolling quantile of each trace (cells x time). Windows shrink at the edges, same as
+    pandas rolling(window, min_periods=1, center=True).quantile(q), which is what's used with
+    step=1. With step > 1 the quantile is only computed every step frames and linearly
+    interpolated in between (F0 is slow, this is usually fine), those windows are sorted as
+    strided views in time chunks so memory stays bounded.
+
+    Args:
+        traces (np.ndarray): cells x time
+        window (int, optional): window length in frames. Defaults to 200.
+        q (float, optional): quantile. Defaults to 0.2.
+        step (int, optional): frames between computed quantiles. Defaults to 1.
+        chunk (int, optional): number of windows to sort at once. Defaults to 1000.
+
+    Returns:
+        F0 (cells x time)
+    """
+    traces = np.asarray(traces, dtype=np.float32)
+    ncells, nframes = traces.shape
+    
+    if step <= 1:
+        # pandas' skiplist is faster than sorting every window
+        f0 = pd.DataFrame(traces.T).rolling(window, min_periods=1, center=True).quantile(q)
+        return f0.values.T.astype(np.float32)
+    
+    centers = np.arange(0, nframes, step)
+    if centers[-1] != nframes - 1:
+        centers = np.append(centers, nframes - 1)
+    starts = np.clip(centers - window//2, 0, None)
+    stops = np.clip(centers + window - window//2, None, nframes)
+    f0 = np.empty((ncells, centers.size), dtype=np.float32)
+    
+    full = np.flatnonzero(stops - starts == window)
+    if full.size > 0:
+        windows = sliding_window_view(traces, window, axis=1)
+        for i in range(0, full.size, chunk):
+            idx = full[i:i+chunk]
+            f0[:,idx] = _sorted_quantile(np.sort(windows[:,starts[idx]], axis=-1), q)
+    # edges with shrunken windows
+    for i in np.flatnonzero(stops - starts != window):
+        f0[:,i] = _sorted_quantile(np.sort(traces[:,starts[i]:stops[i]], axis=-1), q)
+        
+    f0 = np.stack([np.interp(np.arange(nframes), centers, row) for row in f0])
+    
+    return f0
+
+def _sorted_quantile(sorted_vals, q, n=None):
+    """Linear interpolated quantile along the last axis of pre-sorted values, first n per row."""
+    if n is None:
+        n = sorted_vals.shape[-1]
+    k = q * (np.asarray(n) - 1)
+    lo = np.floor(k).astype(int)
+    hi = np.minimum(lo + 1, np.asarray(n) - 1)
+    frac = k - lo
+    if np.ndim(k) == 0:
+        return sorted_vals[...,lo] * (1 - frac) + sorted_vals[...,hi] * frac
+    rows = np.arange(sorted_vals.shape[0])
+    return sorted_vals[rows,lo] * (1 - frac) + sorted_vals[rows,hi] * frac
+
+
+class RunningQuantile:
+    """Trailing window quantile of many traces, updated one frame at a time."""
+    
+    def __init__(self, ncells, window=200, q=0.2, dtype=np.float32):
+        """
+        Keeps a ring buffer of the last 'window' values of each trace and a sorted copy of it. 
+        Each update finds the oldest and the new value in the sorted buffer by bisection and only
+        moves the values between them, vectorized across traces. Until the window is full, the
+        quantile is taken over the values seen so far (like min_periods=1).
+
+        Args:
+            ncells (int): number of traces
+            window (int, optional): window length in frames. Defaults to 200.
+            q (float, optional): quantile. Defaults to 0.2.
+            dtype (optional): dtype of the buffers. Defaults to np.float32.
+        """
+        self.window = window
+        self.q = q
+        self.dtype = dtype
+        
+        # unfilled slots are inf so they always sort to the end
+        self._sorted = np.full((0, window), np.inf, dtype=dtype)
+        self._ring = np.full((0, window), np.inf, dtype=dtype)
+        self._pos = 0
+        self.n = np.zeros(0, dtype=int)
+        self.resize(ncells)
+        
+    @property
+    def ncells(self):
+        return self._ring.shape[0]
+        
+    def resize(self, ncells):
+        """Add traces (eg. for newly found components). New traces start empty."""
+        extra = ncells - self.ncells
+        if extra <= 0:
+            return
+        self._sorted = np.vstack([self._sorted, np.full((extra, self.window), np.inf, dtype=self.dtype)])
+        self._ring = np.vstack([self._ring, np.full((extra, self.window), np.inf, dtype=self.dtype)])
+        self.n = np.concatenate([self.n, np.zeros(extra, dtype=int)])
+    
+    def update(self, values):
+        """
+        Add one frame of values (ncells,) and return the current quantile of each trace.
+        """
+        values = np.asarray(values, dtype=self.dtype)
+        old = self._ring[:,self._pos].copy()
+        self._ring[:,self._pos] = values
+        self._pos = (self._pos + 1) % self.window
+        self.n = np.minimum(self.n + 1, self.window)
+        
+        # position of the old value and insert position of the new one (after removing the old)
+        ncells = self.ncells
+        rows = np.arange(ncells)
+        pos = _bisect_rows(self._sorted, np.concatenate([old, values]), np.concatenate([rows, rows]))
+        r, ins = pos[:ncells], pos[ncells:] - (old < values)
+        
+        # only the values between the two positions move, by one toward the removed value
+        up = ins > r
+        nmoved = np.abs(ins - r)
+        total = nmoved.sum()
+        if total > 0:
+            first = rows * self.window + np.where(up, r, ins + 1)
+            dst = np.repeat(first - np.cumsum(nmoved) + nmoved, nmoved) + np.arange(total)
+            flat = self._sorted.reshape(-1)
+            flat[dst] = flat[dst + np.repeat(up * 2 - 1, nmoved)]
+        self._sorted[rows, ins] = values
+        
+        return self.value()
+    
+    def value(self):
+        """Current quantile of each trace."""
+        return _sorted_quantile(self._sorted, self.q, np.maximum(self.n, 1))
+
+def _bisect_rows(sorted_vals, x, rows):
+    """Branchless bisect_left of each x in its row of sorted_vals (number of values < x)."""
+    base = np.zeros(len(x), dtype=np.intp)
+    n = sorted_vals.shape[1]
+    while n > 1:
+        half = n >> 1
+        base += half * (sorted_vals[rows, base + half] < x)
+        n -= half
+    return base + (sorted_vals[rows, base] < x)
+
 def normalize_data(data, norm_method):
     normalize_func = {
         'none': data, # nothing done...
@@ -118,3 +343,103 @@ def normalize_data(data, norm_method):
     }.get(norm_method)
         
     return normalize_func(data)
+
+
+class PSTHAccumulator:
+    """Running per-condition trial sums for trial-averaged responses during the experiment."""
+    
+    def __init__(self):
+        """
+        Folds in one trial (cells x frames) at a time into running sum and sum of squares tensors
+        per condition, so means and standard deviations are available at any point without
+        keeping or rescanning past trials. Trials can have different lengths and the number of
+        cells can grow between trials; missing values (NaN or never seen) are not counted.
+        """
+        self.sums = {}
+        self.sumsqs = {}
+        self.counts = {}
+        self.n_trials = {}
+        
+    @property
+    def conditions(self):
+        return sorted(self.sums, key=str)
+    
+    @property
+    def shape(self):
+        """(cells, frames) large enough for every condition."""
+        shapes = np.array([s.shape for s in self.sums.values()]).reshape(-1, 2)
+        return tuple(shapes.max(axis=0)) if shapes.size > 0 else (0, 0)
+        
+    def add(self, trial, cond):
+        """
+        Add a trial.
+
+        Args:
+            trial (np.ndarray): cells x frames
+            cond (hashable): condition (eg. vis_id or stim_cond) of the trial, lists are made tuples
+        """
+        cond = _as_key(cond)
+        trial = np.asarray(trial, dtype=float)
+        valid = ~np.isnan(trial)
+        trial = np.where(valid, trial, 0)
+        
+        if cond not in self.sums:
+            self.sums[cond] = np.zeros(trial.shape)
+            self.sumsqs[cond] = np.zeros(trial.shape)
+            self.counts[cond] = np.zeros(trial.shape, dtype=int)
+            self.n_trials[cond] = 0
+        
+        shape = np.maximum(self.sums[cond].shape, trial.shape)
+        for d in (self.sums, self.sumsqs, self.counts):
+            d[cond] = _grow(d[cond], shape)
+            
+        cells, frames = trial.shape
+        self.sums[cond][:cells,:frames] += trial
+        self.sumsqs[cond][:cells,:frames] += trial**2
+        self.counts[cond][:cells,:frames] += valid
+        self.n_trials[cond] += 1
+        
+    def mean(self, cond=None):
+        """Mean (cells x frames) of a condition, or (conds x cells x frames) for all conditions."""
+        return self._reduce(cond, self._mean)
+    
+    def std(self, cond=None):
+        """Standard deviation, same shapes as mean."""
+        return self._reduce(cond, self._std)
+    
+    def sem(self, cond=None):
+        """Standard error of the mean, same shapes as mean."""
+        return self._reduce(cond, lambda c: self._std(c) / np.sqrt(self._counts(c)))
+    
+    def _counts(self, cond):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts[cond] > 0, self.counts[cond], np.nan)
+    
+    def _mean(self, cond):
+        return self.sums[cond] / self._counts(cond)
+    
+    def _std(self, cond):
+        mean = self._mean(cond)
+        var = self.sumsqs[cond] / self._counts(cond) - mean**2
+        return np.sqrt(np.clip(var, 0, None))
+    
+    def _reduce(self, cond, func):
+        if cond is not None:
+            return func(_as_key(cond))
+        shape = self.shape
+        return np.stack([_grow(func(c), shape, fill=np.nan) for c in self.conditions]) if self.sums \
+            else np.empty((0, *shape))
+
+
+def _as_key(cond):
+    if isinstance(cond, (list, np.ndarray)):
+        return tuple(np.ravel(cond).tolist())
+    return cond
+
+def _grow(arr, shape, fill=0):
+    """Pad arr at the end of each axis up to shape."""
+    if tuple(arr.shape) == tuple(shape):
+        return arr
+    out = np.full(shape, fill, dtype=arr.dtype)
+    out[tuple(slice(0, n) for n in arr.shape)] = arr
+    return out
@@ -0,0 +1,411 @@
+"""
+Array-native orientation tuning. Works directly on a (cells, trials, time) trace tensor and a
+trialwise condition vector, so no long-format dataframe is needed. See tuning_df to get the mean
+dataframe that analysis.vis makes for plotting.
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+
+BLANK = -45
+
+
+def trial_responses(traces, win, time=None):
+    """
+    Mean response of each cell on each trial, baseline subtracted trial by trial (same as
+    analysis.vis.meanby).
+
+    Args:
+        traces (np.array): (cells, trials, time) array of traces
+        win (tuple): (base start, base stop, resp start, resp stop), exclusive, in units of time
+        time (np.array, optional): time of each frame. Defaults to None, which uses frame numbers.
+
+    Returns:
+        np.array of (cells, trials)
+    """
+    assert len(win) == 4, 'Must give 4 numbers for window.'
+    if time is None:
+        time = np.arange(traces.shape[-1])
+    base = (time > win[0]) & (time < win[1])
+    resp = (time > win[2]) & (time < win[3])
+
+    with np.errstate(invalid='ignore'):
+        return np.nanmean(traces[..., resp], axis=-1) - np.nanmean(traces[..., base], axis=-1)
+
+def condition_tensor(responses, conds):
+    """
+    Groups trialwise responses by condition into a (cells, conditions, trials) array. Conditions
+    with fewer trials than the most are NaN padded.
+
+    Args:
+        responses (np.array): (cells, trials) responses
+        conds (array-like): condition of each trial
+
+    Returns:
+        np.array of (cells, conditions, trials)
+        np.array of conditions
+    """
+    conds = np.asarray(conds)
+    conditions, cond_idx = np.unique(conds, return_inverse=True)
+
+    # repeat number of each trial within its condition
+    order = np.argsort(cond_idx, kind='stable')
+    counts = np.bincount(cond_idx, minlength=conditions.size)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rep = np.empty(conds.size, dtype=int)
+    rep[order] = np.arange(conds.size) - np.repeat(starts, counts)
+
+    tensor = np.full((responses.shape[0], conditions.size, counts.max()), np.nan)
+    tensor[:, cond_idx, rep] = responses
+    return tensor, conditions
+
+def tuning_curves(responses, conds):
+    """Mean response to each condition. Returns (cells, conditions) array and the conditions."""
+    tensor, conditions = condition_tensor(responses, conds)
+    with np.errstate(invalid='ignore'):
+        return np.nanmean(tensor, axis=2), conditions
+
+def pref_ori(responses, conds, blank=BLANK):
+    """
+    Preferred and orthogonal orientation (mod 180) of each cell from its mean response to each
+    orientation, with both directions of an orientation pooled.
+
+    Returns:
+        np.array of pref oris
+        np.array of ortho oris
+    """
+    keep = conds != blank
+    curves, oris = tuning_curves(responses[:, keep], conds[keep] % 180)
+    pref = oris[_nanargmax(curves)]
+    ortho = (pref - 90) % 180
+    return pref, ortho
+
+def pref_dir(responses, conds, blank=BLANK):
+    """Preferred direction of each cell from its mean response to each direction."""
+    keep = conds != blank
+    curves, dirs = tuning_curves(responses[:, keep], conds[keep])
+    return dirs[_nanargmax(curves)]
+
+def osi(responses, conds, blank=BLANK):
+    """
+    OSI of each cell, (pref - ortho)/(pref + ortho). Same procedure as analysis.vis.osi, the
+    minimum trial response of each cell is subtracted off first so responses are all positive.
+
+    Returns:
+        np.array of OSIs, NaN if the ortho orientation wasn't shown
+    """
+    keep = conds != blank
+    resp = responses[:, keep]
+    resp = resp - np.nanmin(resp, axis=1, keepdims=True)
+    curves, oris = tuning_curves(resp, conds[keep] % 180)
+
+    pref = _nanargmax(curves)
+    ortho_ori = (oris[pref] - 90) % 180
+    ortho = np.searchsorted(oris, ortho_ori).clip(max=oris.size - 1)
+
+    rows = np.arange(curves.shape[0])
+    po = curves[rows, pref]
+    oo = np.where(oris[ortho] == ortho_ori, curves[rows, ortho], np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (po - oo) / (po + oo)
+
+def resp_test(tensor, test='anova', **kwargs):
+    """
+    p-values of a test for a difference in response across conditions, for every cell at once.
+
+    Tests:
+        * 'anova' = 1-way ANOVA
+        * 'kruskal' = Kruskal-Wallis H-test
+        * 'shuffle' = permutation test of the ANOVA F statistic (n_shuffles=1000, seed=None)
+
+    Args:
+        tensor (np.array): (cells, conditions, trials) NaN padded responses (see condition_tensor)
+        test (str, optional): test to use (see above). Defaults to 'anova'.
+        **kwargs: passed to the test
+
+    Returns:
+        np.array of p values for all cells
+    """
+    return _TESTS[test](tensor, **kwargs)
+
+def tuning(traces, conds, win, time=None, p=0.05, test='anova', blank=BLANK):
+    """
+    Runs the tuning analysis on a trace tensor. Array version of analysis.vis.run_pipeline.
+
+    Args:
+        traces (np.array): (cells, trials, time) array of traces
+        conds (array-like): orientation (or vis condition) of each trial
+        win (tuple): (base start, base stop, resp start, resp stop), in units of time
+        time (np.array, optional): time of each frame. Defaults to None (frame numbers).
+        p (float, optional): p-value for visual responsiveness. Defaults to 0.05.
+        test (str, optional): responsiveness test, see resp_test. Defaults to 'anova'.
+        blank (int, optional): condition for the blank/gray screen. Defaults to -45.
+
+    Returns:
+        dict of results, all arrays are per cell except 'responses' (cells, trials),
+        'curves' (cells, conditions), and 'conditions'
+    """
+    conds = np.asarray(conds)
+    responses = trial_responses(traces, win, time)
+    tensor, conditions = condition_tensor(responses, conds)
+
+    pvals = resp_test(tensor, test)
+    prefs, orthos = pref_ori(responses, conds, blank)
+
+    with np.errstate(invalid='ignore'):
+        curves = np.nanmean(tensor, axis=2)
+
+    return {
+        'responses': responses,
+        'conds': conds,
+        'conditions': conditions,
+        'curves': curves,
+        'pval': pvals,
+        'vis_resp': pvals < p,
+        'pref': prefs,
+        'ortho': orthos,
+        'pdir': pref_dir(responses, conds, blank),
+        'osi': osi(responses, conds, blank),
+    }
+
+def tuning_df(results, col='ori'):
+    """
+    Makes the mean dataframe (one row per cell and trial) from the results of tuning, same
+    columns as the mdf from analysis.vis.run_pipeline. Use for plotting.
+    """
+    ncells, ntrials = results['responses'].shape
+    cell = np.repeat(np.arange(ncells), ntrials)
+    trial = np.tile(np.arange(ntrials), ncells)
+
+    mdf = pd.DataFrame({
+        'cell': cell,
+        col: results['conds'][trial],
+        'trial': trial,
+        'df': results['responses'].ravel(),
+    })
+    for key in ['vis_resp', 'pval', 'pref', 'ortho', 'pdir', 'osi']:
+        mdf[key] = results[key][cell]
+
+    return mdf
+
+class RunningTuning:
+    """Per-cell tuning that is updated one trial at a time during the experiment."""
+
+    def __init__(self, win, p=0.05, test='anova', blank=BLANK, oris=True):
+        """
+        Keeps the baseline subtracted response of every cell to every trial (cells x trials, which
+        is small) and computes the tuning from them on request. The number of cells can grow
+        between trials, cells added later are NaN for the trials before they existed.
+
+        Args:
+            win (tuple): (base start, base stop, resp start, resp stop) in frames from the trial start
+            p (float, optional): p-value for visual responsiveness. Defaults to 0.05.
+            test (str, optional): responsiveness test, see resp_test. Defaults to 'anova'.
+            blank (int, optional): condition for the blank/gray screen. Defaults to -45.
+            oris (bool, optional): conditions are orientations in degrees. If False (eg. MATLAB's
+                                   vis_id without a map to orientations) only the per-condition
+                                   curves and responsiveness are computed. Defaults to True.
+        """
+        self.win = win
+        self.p = p
+        self.test = test
+        self.blank = blank
+        self.oris = oris
+
+        self._responses = np.full((0, 64), np.nan)
+        self.conds = []
+
+    @property
+    def n_trials(self):
+        return len(self.conds)
+
+    @property
+    def responses(self):
+        """(cells, trials) responses so far."""
+        return self._responses[:, :self.n_trials]
+
+    def add(self, trial, cond):
+        """
+        Add a trial.
+
+        Args:
+            trial (np.ndarray): cells x frames, starting at the trial start
+            cond (number): orientation of the trial (vis condition if not self.oris)
+        """
+        resp = trial_responses(np.asarray(trial, dtype=float)[:, None, :], self.win)[:, 0]
+
+        # grow cells and double the trial capacity when needed
+        cells = max(self._responses.shape[0], resp.size)
+        trials = self._responses.shape[1]
+        if self.n_trials == trials:
+            trials *= 2
+        if (cells, trials) != self._responses.shape:
+            grown = np.full((cells, trials), np.nan)
+            grown[:self._responses.shape[0], :self._responses.shape[1]] = self._responses
+            self._responses = grown
+
+        self._responses[:resp.size, self.n_trials] = resp
+        self.conds.append(cond)
+
+    def results(self):
+        """
+        Tuning results so far, same keys as tuning (without 'responses'). Without oris there's no
+        'pref', 'ortho', 'pdir' or 'osi'. None if no trials.
+        """
+        if self.n_trials == 0:
+            return None
+        responses = self.responses
+        conds = np.asarray(self.conds)
+        tensor, conditions = condition_tensor(responses, conds)
+        pvals = resp_test(tensor, self.test)
+
+        with np.errstate(invalid='ignore'):
+            curves = np.nanmean(tensor, axis=2)
+
+        results = {
+            'conditions': conditions,
+            'curves': curves,
+            'n_trials': (~np.isnan(tensor)).sum(axis=2),
+            'pval': pvals,
+            'vis_resp': pvals < self.p,
+        }
+        if self.oris:
+            prefs, orthos = pref_ori(responses, conds, self.blank)
+            results.update({
+                'pref': prefs,
+                'ortho': orthos,
+                'pdir': pref_dir(responses, conds, self.blank),
+                'osi': osi(responses, conds, self.blank),
+            })
+        return results
+
+    def summary(self, coms=None, bins=10):
+        """
+        Short summary of the tuning for deciding if the FOV is good.
+
+        Args:
+            coms (np.array, optional): (cells, 2) center of mass of each cell. Defaults to None.
+            bins (int, optional): number of bins for the OSI histogram (0-1). Defaults to 10.
+
+        Returns:
+            dict with number of cells, trials and responsive cells and the conditions. With oris,
+            an OSI histogram of responsive cells and a PO map (x, y, pref ori, OSI, responsive) of
+            each cell if coms are given. Without, a response map (x, y, best condition,
+            responsive) of each cell if coms are given.
+        """
+        results = self.results()
+        if results is None:
+            return {'n_cells': 0, 'n_trials': 0, 'n_responsive': 0}
+
+        vis_resp = results['vis_resp']
+        summary = {
+            'n_cells': int(vis_resp.size),
+            'n_trials': self.n_trials,
+            'n_responsive': int(vis_resp.sum()),
+            'conditions': np.asarray(results['conditions']).tolist(),
+        }
+
+        if not self.oris:
+            if coms is not None:
+                n = min(len(coms), vis_resp.size)
+                best = np.asarray(results['conditions'])[_nanargmax(results['curves'])]
+                summary['resp_map'] = [
+                    [float(x), float(y), best[i].item(), bool(vis_resp[i])]
+                    for i, (x, y) in enumerate(np.asarray(coms)[:n])
+                ]
+            return summary
+
+        counts, edges = np.histogram(results['osi'][vis_resp & ~np.isnan(results['osi'])],
+                                     bins=bins, range=(0, 1))
+        summary['osi_hist'] = counts.tolist()
+        summary['osi_edges'] = edges.tolist()
+
+        if coms is not None:
+            n = min(len(coms), vis_resp.size)
+            summary['po_map'] = [
+                [float(x), float(y), float(results['pref'][i]), _float_or_none(results['osi'][i]),
+                 bool(vis_resp[i])]
+                for i, (x, y) in enumerate(np.asarray(coms)[:n])
+            ]
+
+        return summary
+
+def _float_or_none(x):
+    # JSON doesn't do NaN
+    return None if np.isnan(x) else float(x)
+
+def _nanargmax(curves):
+    # argmax that ignores NaN (conditions a cell never saw), 0 for all NaN
+    return np.where(np.isnan(curves), -np.inf, curves).argmax(axis=1)
+
+def _anova_f(tensor):
+    """1-way ANOVA F statistic for every cell of a (cells, conditions, trials) array."""
+    valid = ~np.isnan(tensor)
+    n_k = valid.sum(axis=2)
+    n = n_k.sum(axis=1)
+    k = (n_k > 0).sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.nansum(tensor, axis=2) / n_k
+        grand = np.nansum(tensor, axis=(1,2)) / n
+        ss_between = np.nansum(n_k * (means - grand[:,None])**2, axis=1)
+        ss_within = np.nansum((tensor - means[...,None])**2, axis=(1,2))
+        f_val = (ss_between / (k - 1)) / (ss_within / (n - k))
+
+    return f_val, k - 1, n - k
+
+def _anova(tensor, **kwargs):
+    f_val, df_between, df_within = _anova_f(tensor)
+    return stats.f.sf(f_val, df_between, df_within)
+
+def _kruskal(tensor, **kwargs):
+    ncells = tensor.shape[0]
+    valid = ~np.isnan(tensor)
+
+    # rank all trials of a cell together, NaNs rank last and are ignored
+    flat = np.where(valid, tensor, np.inf).reshape(ncells, -1)
+    ranks = stats.rankdata(flat, axis=1).reshape(tensor.shape)
+    ranks[~valid] = 0
+
+    n_k = valid.sum(axis=2)
+    n = n_k.sum(axis=1)
+    k = (n_k > 0).sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        h = 12 / (n * (n + 1)) * np.nansum(ranks.sum(axis=2)**2 / n_k, axis=1) - 3 * (n + 1)
+
+        # tie correction, size of each value's tie group from its min and max rank
+        ties = stats.rankdata(flat, axis=1, method='max') - stats.rankdata(flat, axis=1, method='min') + 1
+        ties = np.where(valid.reshape(ncells, -1), ties, 1)
+        correction = 1 - (ties**2 - 1).sum(axis=1) / (n**3 - n)
+        h = h / correction
+
+    return stats.chi2.sf(h, k - 1)
+
+def _shuffle(tensor, n_shuffles=1000, seed=None, **kwargs):
+    ncells = tensor.shape[0]
+    flat = tensor.reshape(ncells, -1)
+    valid = ~np.isnan(flat)
+    rows = np.arange(ncells)[:,None]
+    rng = np.random.default_rng(seed)
+
+    f_val, _, _ = _anova_f(tensor)
+
+    # valid slots of each cell in order, shuffles only move values between valid slots
+    slots = np.argsort(~valid, axis=1, kind='stable')
+    n_greater = np.zeros(ncells)
+    shuffled = np.empty_like(flat)
+    for _ in range(n_shuffles):
+        order = np.argsort(np.where(valid, rng.random(flat.shape), np.inf), axis=1)
+        shuffled[rows, slots] = flat[rows, order]
+        f_shuf, _, _ = _anova_f(shuffled.reshape(tensor.shape))
+        n_greater += f_shuf >= f_val
+
+    return (n_greater + 1) / (n_shuffles + 1)
+
+_TESTS = {
+    'anova': _anova,
+    'kruskal': _kruskal,
+    'shuffle': _shuffle,
+}
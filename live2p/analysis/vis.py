@@ -1,7 +1,8 @@
 import xarray as xr
 import pandas as pd
 import numpy as np
-import scipy.stats as stats
+
+from .tuning import resp_test, tuning, tuning_df
 
 def run_pipeline(df, analysis_window, col_name):
     """
@@ -48,6 +49,29 @@ def run_pipeline(df, analysis_window, col_name):
     
     return df, mdf
 
+def run_pipeline_array(traces, vis_stim, analysis_window, col_name='ori', fr=None, **kwargs):
+    """
+    Same as run_pipeline but works on the trace array directly instead of the long dataframe
+    from create_df (see analysis.tuning). Much lighter on memory for big sessions.
+
+    Args:
+        traces (np.array): cells x trials x time
+        vis_stim (array): trialwise list of vis stims (ori, contrast, etc.) shown
+        analysis_window (tuple): (base start, base stop, resp start, resp stop)
+        col_name (str, optional): name for the vis stim column. Defaults to 'ori'.
+        fr (float, optional): framerate, if given the window is in seconds. Defaults to None.
+        **kwargs: passed to analysis.tuning.tuning (p, test, blank)
+
+    Returns:
+        dict of tuning results, mean dataframe
+    """
+    time = None
+    if fr is not None:
+        time = np.arange(traces.shape[-1])/fr
+    results = tuning(traces, vis_stim, analysis_window, time=time, **kwargs)
+    mdf = tuning_df(results, col=col_name)
+    return results, mdf
+
 def create_df(traces, vis_stim, vis_name, fr=None):
     """
     Make the data frame for the analysis. Needs traces (cell x trials x time),
@@ -114,27 +138,35 @@ def meanby(df, win, col):
     resp['df'] = resp['df'] - base['df']
     return resp
 
-def find_vis_resp(df, p=0.05, test='anova'):
+def find_vis_resp(df, p=0.05, test='anova', col='ori', **kwargs):
     """
     Takes a mean dataframe (see meanby) and finds visually responsive cells using 
-    a 1-way ANOVA test.
+    a 1-way ANOVA test (or one of the other tests below). All cells are tested at once.
+    
+    Tests:
+        * 'anova' = 1-way ANOVA
+        * 'kruskal' = Kruskal-Wallis H-test
+        * 'shuffle' = permutation test of the ANOVA F statistic (n_shuffles=1000, seed=None)
     
     Args:
         df (pd.DataFrame): mean dataframe (trials, cells, vis_condition)
         p (float, optional): p-valuse to use for significance. Defaults to 0.05.
-        test (str, optional): statistical test to use, only one option now. Defaults to 'anova'.
+        test (str, optional): statistical test to use (see above). Defaults to 'anova'.
+        col (str, optional): column with the vis condition. Defaults to 'ori'.
+        **kwargs: passed to the test
 
     Returns:
         np.array of visually responsive cells
         np.array of p values for all cells
     """
     
-    # for adding others later
     tests = {
-        'anova': _vis_resp_anova(df)
+        'anova': _vis_resp_anova,
+        'kruskal': _vis_resp_kruskal,
+        'shuffle': _vis_resp_shuffle,
     }
     
-    p_vals = tests[test]
+    p_vals = tests[test](df, col=col, **kwargs)
     vis_cells = np.where(p_vals < p)[0]
 
     n = vis_cells.size
@@ -237,16 +269,37 @@ def _global_osi(tuning_curve):
     # TODO
     pass
 
-def _vis_resp_anova(data):
-    """Determine visual responsiveness by 1-way ANOVA."""
+def trial_tensor(data, col='ori', val='df'):
+    """
+    Makes a mean dataframe (see meanby) into a (cells, conditions, trials) array. Conditions with
+    fewer trials than the most are NaN padded.
+
+    Args:
+        data (pd.DataFrame): mean dataframe with 'cell', col, and val columns
+        col (str, optional): column with the condition. Defaults to 'ori'.
+        val (str, optional): column with the response. Defaults to 'df'.
+
+    Returns:
+        np.array of (cells, conditions, trials)
+        np.array of conditions
+    """
+    cells, cell_idx = np.unique(data['cell'].values, return_inverse=True)
+    conds, cond_idx = np.unique(data[col].values, return_inverse=True)
+    trial_idx = data.groupby(['cell', col]).cumcount().values
+    
+    tensor = np.full((cells.size, conds.size, trial_idx.max() + 1), np.nan)
+    tensor[cell_idx, cond_idx, trial_idx] = data[val].values
+    
+    return tensor, conds
 
-    f_val = np.empty(data.cell.nunique())
-    p_val = np.empty(data.cell.nunique())
+def _vis_resp_anova(data, col='ori', **kwargs):
+    """Determine visual responsiveness by 1-way ANOVA."""
+    return resp_test(trial_tensor(data, col)[0], 'anova')
 
-    for cell in data.cell.unique():
-        temp3 = data[data.cell==cell]
-        temp4 = temp3[['ori', 'trial', 'df']].set_index(['ori','trial'])
-        samples = [col for col_name, col in temp4.groupby('ori')['df']]
-        f_val[cell], p_val[cell] = stats.f_oneway(*samples)
+def _vis_resp_kruskal(data, col='ori', **kwargs):
+    """Determine visual responsiveness by Kruskal-Wallis H-test."""
+    return resp_test(trial_tensor(data, col)[0], 'kruskal')
 
-    return p_val
\ No newline at end of file
+def _vis_resp_shuffle(data, col='ori', **kwargs):
+    """Determine visual responsiveness by shuffling condition labels (permutation test of ANOVA F)."""
+    return resp_test(trial_tensor(data, col)[0], 'shuffle', **kwargs)
@@ -0,0 +1,97 @@
+"""
+Spatial and temporal binning for the realtime workers, and the transforms needed to match
+(Ain, CoM) and undo them (traces back on the acquisition timebase).
+"""
+
+import numpy as np
+
+
+def bin_frame(frame, factor):
+    """
+    Mean bin a (y, x) frame or (t, y, x) movie spatially by factor. Edges that don't fill a whole
+    bin are cropped off.
+    """
+    if factor == 1:
+        return frame
+    *lead, h, w = frame.shape
+    h, w = h - h % factor, w - w % factor
+    binned = frame[..., :h, :w].reshape(*lead, h // factor, factor, w // factor, factor)
+    return binned.mean(axis=(-3, -1), dtype=np.float32)
+
+def bin_movie(mov, spatial=1, temporal=1):
+    """
+    Bin a (t, y, x) movie spatially and temporally (mean of each temporal frames). Frames that
+    don't fill a whole temporal bin at the end are dropped.
+    """
+    mov = bin_frame(mov, spatial)
+    if temporal > 1:
+        t = mov.shape[0] - mov.shape[0] % temporal
+        mov = mov[:t].reshape(t // temporal, temporal, *mov.shape[1:]).mean(axis=1, dtype=np.float32)
+    return mov
+
+def bin_ain(A, dims, factor):
+    """
+    Bin spatial components (pixels, cells) flattened in 'F' order from dims. Boolean masks (eg. from
+    makeMasks3D) stay boolean, a binned pixel is in the mask if any of its pixels are. Float
+    components are mean binned.
+    """
+    if factor == 1:
+        return A
+    ncells = A.shape[1]
+    A3 = np.asarray(A).reshape(*dims, ncells, order='F')
+    h, w = dims[0] - dims[0] % factor, dims[1] - dims[1] % factor
+    A3 = A3[:h, :w].reshape(h // factor, factor, w // factor, factor, ncells)
+    if A3.dtype == bool:
+        A3 = A3.any(axis=(1, 3))
+    else:
+        A3 = A3.mean(axis=(1, 3))
+    return A3.reshape(-1, ncells, order='F')
+
+def unbin_coords(coords, factor):
+    """(y, x) coordinates in binned pixels to full resolution pixels (center of the bin)."""
+    return np.asarray(coords) * factor + (factor - 1) / 2
+
+def upsample_traces(traces, bin_sizes, axis=-1):
+    """
+    Put binned traces back on the acquisition timebase by holding each value for the number of
+    frames in its bin.
+
+    Args:
+        traces (np.array): traces, with bins along axis
+        bin_sizes (array-like): number of acquired frames in each bin
+        axis (int, optional): time axis. Defaults to -1.
+
+    Returns:
+        np.array with sum(bin_sizes) frames along axis
+    """
+    return np.repeat(traces, bin_sizes, axis=axis)
+
+
+class TemporalBinner:
+    """Averages incoming frames k at a time."""
+
+    def __init__(self, k):
+        self.k = k
+        self._sum = None
+        self.n = 0
+
+    def add(self, frame):
+        """Add a frame. Returns the mean frame when the bin is full, otherwise None."""
+        if self.k == 1:
+            return frame
+        if self._sum is None:
+            self._sum = np.zeros(frame.shape, dtype=np.float32)
+        self._sum += frame
+        self.n += 1
+        if self.n == self.k:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Returns the mean of a partial bin (None if empty) and starts a new bin."""
+        if self.n == 0:
+            return None
+        mean = self._sum / self.n
+        self._sum[:] = 0
+        self.n = 0
+        return mean
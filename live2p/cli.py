@@ -32,6 +32,11 @@ def make_args():
                         default=DEFAULT_PORT,
                         help='set port for server to run on.')
     
+    # prints where start-up time goes and quits without starting the server
+    parser.add_argument('--profile-imports',
+                        action='store_true',
+                        help='profile the imports at start-up and in the background warm-up, then exit.')
+    
     return parser
 
 
@@ -41,6 +46,11 @@ def main():
     parser = make_args()
     args = parser.parse_args()
     
+    if args.profile_imports:
+        from .warmup import profile_imports
+        print(profile_imports())
+        return
+    
     rigfile = importlib.import_module('rig_files.' + args.rigfile)
     
     # add cli logger
@@ -0,0 +1,115 @@
+"""
+Adaptive degradation for planes that can't keep up in real time. Steps down through tiers of
+cheaper processing when the queue backs up and back up when it clears.
+"""
+
+import logging
+
+logger = logging.getLogger('live2p')
+
+# in the order they are turned on
+TIERS = ('no_deconv', 'reduce_mc', 'skip')
+
+
+class DegradePolicy:
+    """Decides the processing tier of a worker from its queue depth and time per frame."""
+
+    def __init__(self, tiers=TIERS, backlog_high=50, backlog_low=5, frame_budget=None,
+                 cooldown=100, smoothing=0.05, plane=None):
+        """
+        Each step down turns on the next tier, so at level 2 of the default tiers both
+        deconvolution is skipped and motion correction is reduced.
+
+        Tiers:
+            * 'no_deconv' = skip deconvolution (C is the denoised trace, no OASIS)
+            * 'reduce_mc' = only estimate motion every few frames, reuse the last shift in between
+            * 'skip' = only process every Nth frame, traces are NaN for the skipped frames
+
+        Steps down when the backlog is over backlog_high, or when the time per frame is over
+        frame_budget and the backlog isn't clear. Steps up when the backlog is at or under
+        backlog_low. Waits at least cooldown frames between steps so the effect of a step shows
+        up in the backlog before the next one.
+
+        Args:
+            tiers (tuple, optional): tiers to step through, in order. Defaults to all of TIERS.
+            backlog_high (int, optional): queue size (frames) to step down at. Defaults to 50.
+            backlog_low (int, optional): queue size (frames) to step up at. Defaults to 5.
+            frame_budget (float, optional): seconds per frame to stay under, usually 1/fr.
+                                            Defaults to None (only the backlog is used).
+            cooldown (int, optional): min frames between steps. Defaults to 100.
+            smoothing (float, optional): weight of the newest frame in the running mean frame
+                                         time. Defaults to 0.05.
+            plane (int, optional): plane for log messages. Defaults to None.
+        """
+        unknown = set(tiers) - set(TIERS)
+        if unknown:
+            raise ValueError(f'Unknown degrade tiers {unknown}. Use any of {TIERS}.')
+        self.tiers = tuple(tiers)
+        self.backlog_high = backlog_high
+        self.backlog_low = backlog_low
+        self.frame_budget = frame_budget
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.plane = plane
+
+        self.level = 0
+        self.frame_time = None
+        self.transitions = []
+        self._last_change = None
+
+    @property
+    def tier(self):
+        """Name of the lowest tier that's on, or 'full'."""
+        return self.tiers[self.level - 1] if self.level > 0 else 'full'
+
+    def active(self, tier):
+        """True if a tier is turned on."""
+        return tier in self.tiers[:self.level]
+
+    def update(self, t, backlog, frame_time=None):
+        """
+        Update with the latest frame and step if needed.
+
+        Args:
+            t (int): frame number
+            backlog (int): number of items waiting in the queue
+            frame_time (float, optional): seconds the last frame took. Defaults to None.
+
+        Returns:
+            int of the step taken, -1 (down), 0 or 1 (up)
+        """
+        if frame_time is not None:
+            if self.frame_time is None:
+                self.frame_time = frame_time
+            else:
+                self.frame_time += self.smoothing * (frame_time - self.frame_time)
+
+        if self._last_change is not None and t - self._last_change < self.cooldown:
+            return 0
+
+        too_slow = (self.frame_budget is not None and self.frame_time is not None
+                    and self.frame_time > self.frame_budget and backlog > self.backlog_low)
+
+        if (backlog > self.backlog_high or too_slow) and self.level < len(self.tiers):
+            self._step(t, 1, backlog)
+            return -1
+        if backlog <= self.backlog_low and self.level > 0:
+            self._step(t, -1, backlog)
+            return 1
+        return 0
+
+    def _step(self, t, change, backlog):
+        old = self.tier
+        self.level += change
+        self._last_change = t
+        self.transitions.append({
+            't': int(t),
+            'from': old,
+            'to': self.tier,
+            'level': self.level,
+            'backlog': int(backlog),
+            'frame_time': self.frame_time,
+        })
+        direction = 'down' if change > 0 else 'up'
+        logger.warning(f"Stepped {direction} from '{old}' to '{self.tier}' at frame {t} with {backlog} "
+                       f"frames queued. (Queue {self.plane})")
@@ -0,0 +1,177 @@
+"""
+ScanImage metadata. Reads only the ScanImage header block at the start of the tiff and parses the
+MATLAB values into Python types (no eval). Parsed metadata is cached per file.
+"""
+
+import logging
+import re
+import struct
+import threading
+from pathlib import Path
+
+from ScanImageTiffReader import ScanImageTiffReader
+
+logger = logging.getLogger('live2p')
+
+# ScanImage BigTIFF header, after the 16 byte tiff header:
+# magic, version, length of the non-varying frame data, length of the ROI group data (uint32s)
+SI_MAGIC = 117637889
+_SI_HEADER = struct.Struct('<IIII')
+_SI_HEADER_OFFSET = 16
+
+_cache = {}
+_lock = threading.Lock()
+
+_NUMBER = re.compile(r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+
+
+def read_si_header(path):
+    """
+    Get the non-varying frame data (the 'SI.' lines) of a ScanImage tiff as a string. Reads just
+    the ScanImage header block if the file has one, otherwise falls back to ScanImageTiffReader.
+
+    Args:
+        path (str or Path): path to the tiff
+
+    Returns:
+        str of the frame data
+    """
+    with open(path, 'rb') as f:
+        head = f.read(_SI_HEADER_OFFSET + _SI_HEADER.size)
+        if len(head) == _SI_HEADER_OFFSET + _SI_HEADER.size and head[:4] == b'II+\x00':
+            magic, _, frame_len, _ = _SI_HEADER.unpack(head[_SI_HEADER_OFFSET:])
+            if magic == SI_MAGIC:
+                return f.read(frame_len).rstrip(b'\x00').decode('utf-8', errors='replace')
+
+    # older ScanImage or not a BigTIFF
+    with ScanImageTiffReader(str(path)) as reader:
+        return reader.metadata()
+
+def parse_metadata(text):
+    """
+    Parse ScanImage frame data into a dict of full field name -> value, eg.
+    {'SI.hChannels.channelSave': [1, 2], ...}. ROI data (the JSON after the SI fields) is ignored.
+    """
+    meta = {}
+    for line in text.splitlines():
+        if not line.startswith('SI.') or ' = ' not in line:
+            continue
+        key, value = line.split(' = ', 1)
+        meta[key.strip()] = parse_value(value)
+    return meta
+
+def parse_value(value):
+    """
+    Convert a MATLAB literal to a Python value. Handles numbers (incl. NaN/Inf), true/false,
+    'strings', [arrays] and {cell arrays}. Rows of a matrix become nested lists, except row and
+    column vectors which become flat lists. Anything else is returned as the stripped string.
+    """
+    value = value.strip()
+    if not value:
+        return value
+    if value in ('true', 'false'):
+        return value == 'true'
+    if value[0] == "'" and value[-1] == "'" and len(value) > 1:
+        return value[1:-1].replace("''", "'")
+    if value[0] in '[{' and value[-1] in ']}':
+        return _parse_array(value[1:-1])
+    number = _parse_number(value)
+    return value if number is None else number
+
+def si_metadata(path):
+    """
+    Parsed ScanImage metadata of a tiff (see parse_metadata). Cached, so only the first call for a
+    file reads it.
+    """
+    key = str(Path(path).resolve())
+    with _lock:
+        if key in _cache:
+            return _cache[key]
+    meta = parse_metadata(read_si_header(path))
+    with _lock:
+        _cache[key] = meta
+    return meta
+
+def clear_cache():
+    """Forget all cached metadata."""
+    with _lock:
+        _cache.clear()
+
+def get_field(path, name, default=None):
+    """
+    Get a single metadata value by full name ('SI.hRoiManager.scanVolumeRate') or by the last
+    part of the name ('scanVolumeRate').
+    """
+    meta = si_metadata(path)
+    if name in meta:
+        return meta[name]
+    for key, value in meta.items():
+        if key.split('.')[-1] == name:
+            return value
+    return default
+
+def get_nchannels(path):
+    """Number of channels saved."""
+    chans = get_field(path, 'SI.hChannels.channelSave', 1)
+    return len(chans) if isinstance(chans, list) else 1
+
+def get_zs(path):
+    """z-positions of the planes, as a list."""
+    zs = get_field(path, 'SI.hStackManager.zs', 0)
+    return zs if isinstance(zs, list) else [zs]
+
+def get_nplanes(path):
+    """Number of z-planes (volumes)."""
+    return len(get_zs(path))
+
+def get_fr(path):
+    """Volume rate, the frame rate of each plane."""
+    return get_field(path, 'SI.hRoiManager.scanVolumeRate')
+
+def _parse_number(value):
+    if _NUMBER.match(value):
+        return int(value) if re.fullmatch(r'[-+]?\d+', value) else float(value)
+    lowered = value.lower()
+    if lowered in ('nan', '+nan', '-nan'):
+        return float('nan')
+    if lowered in ('inf', '+inf'):
+        return float('inf')
+    if lowered == '-inf':
+        return float('-inf')
+    return None
+
+def _parse_array(body):
+    rows = [_split_row(row) for row in _split_top(body, ';')]
+    rows = [[parse_value(v) for v in row] for row in rows if row]
+    if len(rows) == 0:
+        return []
+    if len(rows) == 1:
+        return rows[0]
+    if all(len(r) == 1 for r in rows):
+        return [r[0] for r in rows]
+    return rows
+
+def _split_row(row):
+    # MATLAB elements are split by commas or whitespace
+    return [v for part in _split_top(row, ',') for v in _split_top(part, ' ') if v.strip()]
+
+def _split_top(text, sep):
+    # split on sep outside of quotes and nested brackets
+    parts = []
+    depth = 0
+    quoted = False
+    start = 0
+    for i, c in enumerate(text):
+        if c == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif c in '[{':
+            depth += 1
+        elif c in ']}':
+            depth -= 1
+        elif depth == 0 and (c == sep or (sep == ' ' and c.isspace())):
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return [p.strip() for p in parts]
@@ -0,0 +1,230 @@
+"""
+Rigid motion correction with FFT cross-correlation, for when live2p registers frames itself instead
+of through OnACID's mc_next, and sharing of rigid shifts between the planes of a volume.
+"""
+
+import logging
+import threading
+
+import numpy as np
+import scipy.fft
+
+logger = logging.getLogger('live2p')
+
+
+class RigidRegistration:
+    """Rigid registration of frames to a template by FFT cross-correlation."""
+
+    def __init__(self, template, max_shift=10, update_every=200, update_weight=0.2, workers=None):
+        """
+        Shifts are (rows, cols) in pixels and are the correction that was applied to the frame, the
+        same convention as the rigid shifts OnACID saves. Subpixel shifts come from a parabola fit
+        around the cross-correlation peak. Pixels shifted in from outside the frame take the value of
+        the nearest edge pixel.
+
+        Args:
+            template (np.array): (y, x) template, eg. the mean of the init movie
+            max_shift (int, optional): max shift in pixels. Defaults to 10.
+            update_every (int, optional): blend the mean of this many corrected frames into the
+                                          template, 0 keeps the template fixed. Defaults to 200.
+            update_weight (float, optional): weight of the new mean in the blend. Defaults to 0.2.
+            workers (int, optional): threads for the FFTs, split over frames in a batch. Defaults
+                                     to None (scipy's default, 1).
+        """
+        self.max_shift = int(max_shift)
+        self.workers = workers
+        self.update_every = update_every
+        self.update_weight = update_weight
+        self.shifts = []
+
+        self.set_template(template)
+        self._sum = np.zeros(self.dims, dtype=np.float64)
+        self._nsum = 0
+
+    def register(self, frame):
+        """
+        Register one frame.
+
+        Args:
+            frame (np.array): (y, x) frame
+
+        Returns:
+            corrected frame, shift (rows, cols)
+        """
+        frames_cor, shifts = self.register_batch(frame[None])
+        return frames_cor[0], shifts[0]
+
+    def register_batch(self, frames):
+        """
+        Register a block of frames to the current template at once, the FFTs and peak search are
+        vectorized over frames. Much faster per frame than register when frames are queued up.
+
+        Args:
+            frames (np.array): (t, y, x) frames
+
+        Returns:
+            (t, y, x) corrected frames, (t, 2) shifts (rows, cols)
+        """
+        F = scipy.fft.rfft2(np.asarray(frames, dtype=np.float32), workers=self.workers)
+        shifts = self._find_shift(F)
+        frames_cor = self._apply(F, shifts)
+        self._track(frames_cor, shifts)
+        return frames_cor, shifts
+
+    def register_movie(self, mov, chunk=64):
+        """
+        Register a (t, y, x) movie (eg. the init batch) to the template and use the mean of the
+        registered movie as the new template. Shifts of the movie aren't kept.
+
+        Args:
+            mov (np.array): (t, y, x) movie
+            chunk (int, optional): frames registered at once. Defaults to 64.
+
+        Returns:
+            registered movie
+        """
+        out = np.empty(mov.shape, dtype=np.float32)
+        for start in range(0, mov.shape[0], chunk):
+            F = scipy.fft.rfft2(np.asarray(mov[start:start + chunk], dtype=np.float32), workers=self.workers)
+            out[start:start + chunk] = self._apply(F, self._find_shift(F))
+        self.set_template(out.mean(axis=0))
+        return out
+
+    def set_template(self, template):
+        """Register to a new (y, x) template from now on."""
+        template = np.asarray(template, dtype=np.float32)
+        self.template = template
+        self.dims = template.shape
+        self._template_fft = np.conj(scipy.fft.rfft2(template, workers=self.workers))
+        # drop the mean so brightness doesn't bias the peak
+        self._template_fft[0, 0] = 0
+        ky = np.fft.fftfreq(self.dims[0])[:, None]
+        kx = np.fft.rfftfreq(self.dims[1])[None, :]
+        self._ky, self._kx = ky.astype(np.float32), kx.astype(np.float32)
+        # rows and cols of the cross-correlation within max_shift, in shift order
+        ms = min(self.max_shift, self.dims[0] // 2 - 1, self.dims[1] // 2 - 1)
+        self._window = np.arange(-ms, ms + 1)
+
+    def _find_shift(self, F):
+        # cross-correlation of each frame (n, y, x//2+1) with the template. not whitened (phase only),
+        # that falls apart on the edges of shifted frames
+        cc = scipy.fft.irfft2(F * self._template_fft, s=self.dims, workers=self.workers)
+
+        # peak within max_shift, wrapped indices are negative shifts
+        w = self._window
+        block = cc[:, w[:, None] % self.dims[0], w[None, :] % self.dims[1]]
+        n, size = block.shape[0], w.size
+        peak = block.reshape(n, -1).argmax(axis=1)
+        iy, ix = np.unravel_index(peak, (size, size))
+
+        dy = w[iy] + _parabola(block, iy, ix, axis=1)
+        dx = w[ix] + _parabola(block, iy, ix, axis=2)
+        # the peak is where the frame moved to, correct by moving it back
+        return -np.stack([dy, dx], axis=1)
+
+    def _apply(self, F, shifts):
+        # the phase ramp is separable, (n, y, 1) x (n, 1, x) instead of a full exp per frame
+        shifts = shifts.astype(np.float32)
+        ramp_y = np.exp(-2j * np.pi * self._ky[None] * shifts[:, 0, None, None])
+        ramp_x = np.exp(-2j * np.pi * self._kx[None] * shifts[:, 1, None, None])
+        G = F * ramp_y
+        G *= ramp_x
+        out = scipy.fft.irfft2(G, s=self.dims, workers=self.workers).astype(np.float32, copy=False)
+        for frame, shift in zip(out, shifts):
+            _fill_edges(frame, shift)
+        return out
+
+    def _track(self, frames_cor, shifts):
+        self.shifts.extend(shifts.tolist())
+        if not self.update_every:
+            return
+        self._sum += frames_cor.sum(axis=0)
+        self._nsum += frames_cor.shape[0]
+        if self._nsum >= self.update_every:
+            mean = (self._sum / self._nsum).astype(np.float32)
+            self.set_template((1 - self.update_weight) * self.template + self.update_weight * mean)
+            self._sum[:] = 0
+            self._nsum = 0
+
+
+def _parabola(block, iy, ix, axis):
+    # subpixel offset of the peak along one axis from the peak and its 2 neighbors
+    n = np.arange(block.shape[0])
+    size = block.shape[axis]
+    i = iy if axis == 1 else ix
+    lo, hi = np.clip(i - 1, 0, size - 1), np.clip(i + 1, 0, size - 1)
+    if axis == 1:
+        c0, cm, cp = block[n, iy, ix], block[n, lo, ix], block[n, hi, ix]
+    else:
+        c0, cm, cp = block[n, iy, ix], block[n, iy, lo], block[n, iy, hi]
+    denom = cm - 2 * c0 + cp
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where((denom < 0) & (lo != i) & (hi != i), 0.5 * (cm - cp) / denom, 0)
+    return offset
+
+def _fill_edges(frame, shift):
+    # fft shifts wrap around, replace the wrapped in pixels with the nearest edge pixel
+    sy, sx = int(np.ceil(abs(shift[0]))), int(np.ceil(abs(shift[1])))
+    if sy:
+        if shift[0] > 0:
+            frame[:sy] = frame[sy]
+        else:
+            frame[-sy:] = frame[-sy - 1]
+    if sx:
+        if shift[1] > 0:
+            frame[:, :sx] = frame[:, sx, None]
+        else:
+            frame[:, -sx:] = frame[:, -sx - 1, None]
+
+
+class MotionShare:
+    """
+    Rigid shifts estimated on a reference plane, shared with the other planes of the volume. With
+    piezo z-scanning the lateral motion is nearly the same in every plane of a volume, so the other
+    planes can apply the reference plane's shifts instead of estimating their own.
+    """
+
+    def __init__(self, ref_plane=0, timeout=0.05, max_frames=10000):
+        """
+        Args:
+            ref_plane (int, optional): plane that estimates the shifts. Defaults to 0.
+            timeout (float, optional): seconds a plane waits for the reference plane's shift before
+                                       estimating its own. Defaults to 0.05.
+            max_frames (int, optional): shifts of the last max_frames frames are kept, a plane
+                                        further behind than that estimates its own. Defaults to 10000.
+        """
+        self.ref_plane = ref_plane
+        self.timeout = timeout
+        self.max_frames = max_frames
+        self._shifts = {} # frame -> shift, in the order they were published
+        self._dropped = -1 # newest frame dropped from _shifts
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def publish(self, frame, shift):
+        """Share the shift of an acquired frame (None if the reference plane has no shift for it)."""
+        with self._cond:
+            self._shifts[frame] = None if shift is None else tuple(float(s) for s in shift)
+            # ring buffer, frames come in order so the first one is the oldest
+            while len(self._shifts) > self.max_frames:
+                oldest = next(iter(self._shifts))
+                del self._shifts[oldest]
+                self._dropped = max(self._dropped, oldest)
+            self._cond.notify_all()
+
+    def get(self, frame, timeout=None):
+        """
+        Shift of an acquired frame, waits up to timeout (default self.timeout) for the reference
+        plane to get to it. Returns None if it isn't available (or was already dropped).
+        """
+        timeout = self.timeout if timeout is None else timeout
+        with self._cond:
+            self._cond.wait_for(lambda: frame in self._shifts or frame <= self._dropped or self._closed,
+                                timeout=timeout)
+            return self._shifts.get(frame)
+
+    def close(self):
+        """The reference plane is done, stop waiting on it."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
@@ -0,0 +1,198 @@
+"""
+Streams the registered frames of a plane to a chunked, compressed movie on disk (HDF5 or zarr)
+during the session, so the motion corrected movie doesn't have to be made again offline. Frames go
+through a bounded buffer to a writer thread, if the disk can't keep up only every nth frame is kept
+(a decimated movie) instead of ever making the realtime loop wait.
+"""
+
+import logging
+import queue
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+try:
+    # comes with caiman
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+logger = logging.getLogger('live2p')
+
+
+class H5Store:
+    """Movie in an HDF5 file, 'mov' (frames, y, x) chunked in time and 'frames' with the frame numbers."""
+
+    suffix = '.h5'
+
+    def __init__(self, path, shape, dtype, chunk_frames=100):
+        self.path = path
+        self.file = h5py.File(path, 'w')
+        self.mov = self.file.create_dataset('mov', shape=(0, *shape), maxshape=(None, *shape), dtype=dtype,
+                                            chunks=(chunk_frames, *shape), compression='lzf')
+        self.frames = self.file.create_dataset('frames', shape=(0,), maxshape=(None,), dtype='int64',
+                                               chunks=(chunk_frames,))
+
+    def append(self, block, frames):
+        n = self.mov.shape[0]
+        self.mov.resize(n + block.shape[0], axis=0)
+        self.mov[n:] = block
+        self.frames.resize(n + len(frames), axis=0)
+        self.frames[n:] = frames
+
+    def close(self):
+        self.file.close()
+
+
+class ZarrStore:
+    """Movie in a zarr group, 'mov' (frames, y, x) chunked in time and 'frames' with the frame numbers."""
+
+    suffix = '.zarr'
+
+    def __init__(self, path, shape, dtype, chunk_frames=100):
+        self.path = path
+        group = zarr.open_group(str(path), mode='w')
+        # create_dataset in zarr 2, create_array in zarr 3 (both compress by default)
+        create = getattr(group, 'create_array', None) or group.create_dataset
+        self.mov = create('mov', shape=(0, *shape), chunks=(chunk_frames, *shape), dtype=dtype)
+        self.frames = create('frames', shape=(0,), chunks=(chunk_frames,), dtype='int64')
+
+    def append(self, block, frames):
+        self.mov.append(block, axis=0)
+        self.frames.append(np.asarray(frames, dtype='int64'), axis=0)
+
+    def close(self):
+        pass
+
+
+def open_store(path, shape, dtype, chunk_frames=100, backend='auto'):
+    """
+    Open a movie store at path (the suffix is set by the backend).
+
+    Args:
+        path (str or Path): file or folder name without a suffix
+        shape (tuple): frame shape
+        dtype (np.dtype): frame dtype
+        chunk_frames (int, optional): frames per chunk. Defaults to 100.
+        backend (str, optional): 'h5', 'zarr' or 'auto' (h5 if installed, then zarr). Defaults to 'auto'.
+
+    Returns:
+        H5Store or ZarrStore
+    """
+    if backend == 'auto':
+        backend = 'h5' if h5py is not None else 'zarr'
+    if backend == 'h5':
+        if h5py is None:
+            raise ImportError('h5py is needed to save the registered movie as HDF5.')
+        store = H5Store
+    elif backend == 'zarr':
+        if zarr is None:
+            raise ImportError('zarr is needed to save the registered movie as zarr.')
+        store = ZarrStore
+    else:
+        raise ValueError(f"Unknown movie backend '{backend}', use 'h5', 'zarr' or 'auto'.")
+    return store(Path(path).with_suffix(store.suffix), shape, dtype, chunk_frames)
+
+
+class MovieWriter:
+    """
+    Appends frames to a store from a background thread. put() never blocks, when the buffer is full
+    the writer halves the frame rate it keeps (up to max_step) and goes back up once the buffer has
+    drained.
+    """
+
+    def __init__(self, store, chunk_frames=100, buffer_frames=300, max_step=8):
+        """
+        Args:
+            store (H5Store or ZarrStore): where the frames go, anything with append(block, frames)
+                                          and close()
+            chunk_frames (int, optional): frames written at once. Defaults to 100.
+            buffer_frames (int, optional): frames held in memory waiting to be written. Defaults
+                                           to 300.
+            max_step (int, optional): keep at least every max_step-th frame. Defaults to 8.
+        """
+        self.store = store
+        self.chunk_frames = chunk_frames
+        self.max_step = max_step
+        self.step = 1
+        self.step_log = [] # (frame, step) when the decimation changed
+        self.written = 0
+        self.dropped = 0
+        self.write_time = 0.0
+        self._q = queue.Queue(maxsize=buffer_frames)
+        self._thread = threading.Thread(target=self._run, name='live2p-movie', daemon=True)
+        self._thread.start()
+
+    def put(self, frame, t):
+        """Queue frame number t to be written (or skip it if the movie is decimated). Never blocks."""
+        if t % self.step != 0:
+            return
+        try:
+            # copy, the caller's frame can change after this
+            self._q.put_nowait((t, np.array(frame)))
+        except queue.Full:
+            self.dropped += 1
+            if self.step < self.max_step:
+                self._set_step(t, self.step * 2)
+
+    def _set_step(self, t, step):
+        if step > self.step:
+            logger.warning(f'Registered movie writer is behind, keeping every {step} frames.')
+        else:
+            logger.info(f'Registered movie writer caught up, keeping every {step} frames.')
+        self.step = step
+        self.step_log.append((int(t), step))
+
+    def _run(self):
+        done = False
+        while not done:
+            item = self._q.get()
+            items = []
+            while item is not None:
+                items.append(item)
+                if len(items) == self.chunk_frames:
+                    break
+                try:
+                    item = self._q.get(timeout=0.5)
+                except queue.Empty:
+                    break
+            done = item is None
+
+            if items:
+                start = time.perf_counter()
+                frames, block = zip(*items)
+                try:
+                    self.store.append(np.stack(block), list(frames))
+                    self.written += len(frames)
+                except Exception:
+                    logger.exception('Failed to write registered frames.')
+                    self.dropped += len(frames)
+                self.write_time += time.perf_counter() - start
+
+            # caught up, keep more frames again
+            if self.step > 1 and self._q.qsize() < self._q.maxsize // 4:
+                self._set_step(frames[-1] if items else 0, self.step // 2)
+
+    def close(self):
+        """Write what's left in the buffer and close the store."""
+        self._q.put(None)
+        self._thread.join()
+        self.store.close()
+        logger.info(f'Registered movie: {self.written} frames written, {self.dropped} dropped, '
+                    f'{self.write_time:.1f} s writing.')
+
+    def summary(self):
+        return {
+            'path': str(getattr(self.store, 'path', '')),
+            'written': self.written,
+            'dropped': self.dropped,
+            'step_log': self.step_log,
+            'write_time': self.write_time,
+        }
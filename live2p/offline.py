@@ -4,35 +4,28 @@ from pathlib import Path
 from multiprocessing import Process, Queue
 import json
 
-from ScanImageTiffReader import ScanImageTiffReader
-
+from .readers import PrefetchReader
+from .tiffindex import index_tiff
 from .utils import get_nchannels, get_nvols, get_tslice, slice_movie
 from .workers import RealTimeQueue
 
 logger = logging.getLogger('live2p')
 
-def append_to_queue(q, tiff_folder, tslice, add_rate=1):
+def append_to_queue(q, tiff_folder, tslice, add_rate=1, ahead=2, max_bytes=None):
     
     tiff_list = Path(tiff_folder).glob('*.tif*')
     lengths = []
     
-    for i,t in enumerate(tiff_list):
-        # open data
+    # read ahead in a background thread so disk I/O overlaps with adding to the queue
+    reader = PrefetchReader(tiff_list, [tslice], ahead=ahead, max_bytes=max_bytes, min_frames=15)
+    
+    for i,(t, (mov,)) in enumerate(reader):
         logger.debug(f'Adding tiff {i}.')
-        with ScanImageTiffReader(str(t)) as reader:
-           data = reader.data()
-           
-        # check if valid tiff
-        if data.shape[0] > 15:    
-            # slice movie for this plane
-            mov = data[tslice, :, :]
-            lengths.append(mov.shape[0])
-            
-            # add frames to the queue
-            for f in mov:
-                q.put(f.squeeze())         
-        else:
-            continue   
+        lengths.append(mov.shape[0])
+        
+        # add frames to the queue
+        for f in mov:
+            q.put(f.squeeze())         
         # so we don't overload memory
         time.sleep(add_rate)  
             
@@ -56,13 +49,14 @@ def run_plane_offline(plane, tiff_folder, params, x_start, x_end,
         logger.error(f'No makeMasks3D found at: {mm3d_file}')
         raise FileNotFoundError
     
-    init_list, nchannels, nplanes, tslice = prepare_init(plane, n_init, tiff_files)    
+    init_list, nchannels, nplanes, tslice = prepare_init(plane, n_init, tiff_files, 
+                                                         kwargs.get('seed_strategy'))    
     
     # once you have gotten the tiffs for init, run the queue
     print('starting initialization...')
     worker = RealTimeQueue(init_list, plane, nchannels, nplanes, params, q,
                            num_frames_max=max_frames, Ain_path=mm3d_file,
-                           xslice=xslice, **kwargs)
+                           xslice=xslice, n_init=n_init, **kwargs)
         
     print('starting queue...')
     queue_p = Process(target=append_to_queue, args=(q, tiff_folder, tslice, add_rate))
@@ -77,17 +71,31 @@ def run_plane_offline(plane, tiff_folder, params, x_start, x_end,
     
     return result
 
-def prepare_init(plane: int, n_init: int, tiff_files: list):
+def prepare_init(plane: int, n_init: int, tiff_files: list, seed_strategy=None):
+    """
+    Get the tiffs for initialization and the number of channels and planes. Without a seed 
+    strategy, tiffs are taken in order until there are n_init frames. With one, all tiffs are 
+    returned for the seed builder to sample from.
+    """
+    tiff_files = iter(tiff_files)
     nframes = 0
     init_list = []
     print('getting files for initialization....')
-    while nframes < n_init:
-        tiff = next(tiff_files)
-        if nframes == 0:
+    while nframes < n_init or seed_strategy is not None:
+        tiff = next(tiff_files, None)
+        if tiff is None:
+            break
+        if len(init_list) == 0:
             nchannels = get_nchannels(str(tiff))
             nplanes = get_nvols(str(tiff))
             tslice = get_tslice(plane, 0, nchannels, nplanes)
-        length = slice_movie(str(tiff), slice(None), slice(None), tslice).shape[0]
+        # count frames from the header only
+        idx = index_tiff(tiff)
+        if idx is not None:
+            length = len(range(*tslice.indices(len(idx))))
+            idx.close()
+        else:
+            length = slice_movie(str(tiff), slice(None), slice(None), tslice).shape[0]
         init_list.append(tiff)
         nframes += length
     return init_list,nchannels,nplanes,tslice
@@ -105,13 +113,14 @@ def run_plane_offline_multifolder(plane, tiff_folders, params, x_start, x_end,
         raise FileNotFoundError
     
     # fix this  to take multi folders!!!
-    init_list, nchannels, nplanes, tslice = prepare_init(plane, n_init, tiff_files_init) 
+    init_list, nchannels, nplanes, tslice = prepare_init(plane, n_init, tiff_files_init, 
+                                                         kwargs.get('seed_strategy')) 
     
     # once you have gotten the tiffs for init, run the queue
     print('starting initialization...')
     worker = RealTimeQueue(init_list, plane, nchannels, nplanes, params, q,
                            num_frames_max=max_frames, Ain_path=mm3d_file,
-                           xslice=xslice, **kwargs)
+                           xslice=xslice, n_init=n_init, **kwargs)
     
     print('starting queue...')
     queue_p = Process(target=append_to_queue_multifolder, args=(q, tiff_folders, tslice, add_rate))
@@ -126,42 +135,31 @@ def run_plane_offline_multifolder(plane, tiff_folders, params, x_start, x_end,
     
     # return result
 
-def append_to_queue_multifolder(q, tiff_folders, tslice, add_rate=1):
-    # first, iterate through the epochs
-    files_per_epoch = []
-    lengths_list = []
-    for tiff_folder in tiff_folders:
-        tiff_list = Path(tiff_folder).glob('*.tif*')
-        f_count =  0
-        lengths = []
-        # then through files in each epoch
-        for i,t in enumerate(tiff_list):
-            # open data
-            logger.debug(f'Adding tiff {i}.')
-            with ScanImageTiffReader(str(t)) as reader:
-                data = reader.data()
-                
-            # check if valid tiff
-            if data.shape[0] > 15:    
-                # slice movie for this plane
-                mov = data[tslice, :, :]
-                lengths.append(mov.shape[0])
-                f_count += 1
-                # add frames to the queue
-                for f in mov:
-                    q.put(f.squeeze())         
-            else:
-                continue   
-            # so we don't overload memory
-            time.sleep(add_rate)
-        
-        # append the file count per epoch
-        files_per_epoch.append(f_count)
-        lengths_list.append(lengths)
+def append_to_queue_multifolder(q, tiff_folders, tslice, add_rate=1, ahead=2, max_bytes=None):
+    # one reader across all epochs so the next epoch is already loading at epoch boundaries
+    tiff_lists = [list(Path(tiff_folder).glob('*.tif*')) for tiff_folder in tiff_folders]
+    all_tiffs = [t for tiff_list in tiff_lists for t in tiff_list]
+    epoch_of = {str(t):e for e, tiff_list in enumerate(tiff_lists) for t in tiff_list}
+    reader = PrefetchReader(all_tiffs, [tslice], ahead=ahead, max_bytes=max_bytes, min_frames=15)
+    
+    files_per_epoch = [0] * len(tiff_folders)
+    lengths_list = [[] for _ in tiff_folders]
+    
+    # iterate through files in all epochs
+    for i,(t, (mov,)) in enumerate(reader):
+        logger.debug(f'Adding tiff {i}.')
+        e = epoch_of[t]
+        lengths_list[e].append(mov.shape[0])
+        files_per_epoch[e] += 1
+        # add frames to the queue
+        for f in mov:
+            q.put(f.squeeze())         
+        # so we don't overload memory
+        time.sleep(add_rate)
                 
     fname = Path(tiff_folders[0],'file_lengths.json')
     data = dict(lengths=lengths_list, files_per_epoch=files_per_epoch)
     with open(fname, 'w') as f:
         json.dump(data, f)
         
-    q.put('STOP')
\ No newline at end of file
+    q.put('STOP')
@@ -0,0 +1,296 @@
+"""
+Readers for streaming tiff data into the processing queues.
+"""
+
+import logging
+import os
+import queue
+import threading
+from pathlib import Path
+
+from ScanImageTiffReader import ScanImageTiffReader
+
+from .tiffindex import index_tiff
+from .utils import tic, toc
+
+logger = logging.getLogger('live2p')
+
+# marks the end of the file stream inside the reader queues
+_END = None
+
+
+class PrefetchReader:
+    """Reads tiffs ahead of the consumer in a background thread."""
+
+    def __init__(self, files=None, tslices=None, ahead=2, max_bytes=None, min_frames=0):
+        """
+        Reads ahead up to 'ahead' files (and/or 'max_bytes' worth of data) in a background thread so
+        disk I/O overlaps with processing. Iterating yields (path, planes) in the order files were
+        added, where planes is a list of arrays, one per tslice. Files that fail to open or have
+        too few frames are logged and skipped.
+
+        If files is given, the reader is closed after adding them. Otherwise files can be fed in
+        as they arrive with add() and the stream is ended with close().
+
+        Args:
+            files (list, optional): list of str or Path of tiffs to read. Defaults to None.
+            tslices (list, optional): list of time slices, typically one per plane. Defaults to
+                                      None, which yields the full movie.
+            ahead (int, optional): max number of files to hold in memory. Defaults to 2.
+            max_bytes (int, optional): max bytes (on disk) to hold in memory. A single file
+                                       larger than this is still read. Defaults to None (no limit).
+            min_frames (int, optional): skip tiffs with this many frames or less (all planes and
+                                        channels). Defaults to 0.
+        """
+        self.tslices = tslices if tslices is not None else [slice(None)]
+        self.ahead = max(1, ahead)
+        self.max_bytes = max_bytes
+        self.min_frames = min_frames
+
+        self._files = queue.Queue()
+        self._out = queue.Queue()
+        self._budget = threading.Condition()
+        self._held_files = 0
+        self._held_bytes = 0
+        self._last_size = 0
+
+        # timing stats
+        self.read_time = 0.
+        self.io_wait = 0.
+        self.compute_time = 0.
+        self.nfiles = 0
+        self._t_yield = None
+
+        self._thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self._thread.start()
+
+        if files is not None:
+            for f in files:
+                self.add(f)
+            self.close()
+
+    def add(self, path):
+        """Add a tiff to the end of the read queue."""
+        self._files.put(str(path))
+
+    def close(self):
+        """No more files will be added. Iteration stops after the last added file."""
+        self._files.put(_END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        t = tic()
+        if self._t_yield is not None:
+            # time since last yield is time the consumer spent on the previous file
+            self.compute_time += t - self._t_yield
+            self._release(self._last_size)
+
+        item = self._out.get()
+        self.io_wait += toc(t)
+
+        if item is _END:
+            self._t_yield = None
+            self._thread.join()
+            self.report()
+            raise StopIteration
+
+        path, planes, self._last_size = item
+        self.nfiles += 1
+        self._t_yield = tic()
+        return path, planes
+
+    def report(self):
+        """Log the time spent waiting on disk vs. processing. Returns the stats as a dict."""
+        stats = {
+            'nfiles': self.nfiles,
+            'read_time': self.read_time,
+            'io_wait': self.io_wait,
+            'compute_time': self.compute_time,
+        }
+        logger.info(f'Prefetch reader: {self.nfiles} files, {self.read_time:.2f}s reading, '
+                    f'{self.io_wait:.2f}s waiting on I/O, {self.compute_time:.2f}s compute.')
+        return stats
+
+    def _release(self, size):
+        with self._budget:
+            self._held_files -= 1
+            self._held_bytes -= size
+            self._budget.notify()
+
+    def _has_room(self, size):
+        if self._held_files == 0:
+            return True
+        if self._held_files >= self.ahead:
+            return False
+        if self.max_bytes is not None and self._held_bytes + size > self.max_bytes:
+            return False
+        return True
+
+    def _read_ahead(self):
+        while True:
+            path = self._files.get()
+            if path is _END:
+                self._out.put(_END)
+                return
+
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+
+            with self._budget:
+                self._budget.wait_for(lambda: self._has_room(size))
+                self._held_files += 1
+                self._held_bytes += size
+
+            t = tic()
+            try:
+                with ScanImageTiffReader(path) as reader:
+                    data = reader.data()
+            except Exception: # ScanImage can't open file is a generic exception
+                logger.warning(f'Failed to read {Path(path).name}. If this was the last acq, this is expected. Otherwise something is wrong.')
+                self._release(size)
+                continue
+            finally:
+                self.read_time += toc(t)
+                
+            if data.shape[0] <= self.min_frames:
+                logger.warning(f'A tiff that was too short (<{self.min_frames} frames total) was skipped: {Path(path).name}')
+                self._release(size)
+                continue
+            
+            planes = [data[tslice] for tslice in self.tslices]
+
+            self._out.put((path, planes, size))
+
+
+
+class TiffTailer:
+    """Follows the tiff ScanImage is writing and adds frames to the plane queues as they land."""
+
+    def __init__(self, folder, qs, nchannels, nplanes, channel=0, poll_interval=0.02,
+                 on_trial_end=None, skip_existing=True):
+        """
+        Tails the newest tiff in an epoch folder, reading new IFDs as they are appended, and puts
+        each completed frame into the queue for its plane right away. A new tiff showing up marks
+        the end of the previous trial, so 'TRIAL START' and 'TRIAL END' are added at file
+        boundaries.
+
+        Args:
+            folder (str or Path): epoch folder to watch
+            qs (list): list of queues, one per plane
+            nchannels (int): number of channels saved by ScanImage
+            nplanes (int): number of z-planes
+            channel (int, optional): channel to add to the queues. Defaults to 0.
+            poll_interval (float, optional): seconds between polls. Defaults to 0.02.
+            on_trial_end (callable, optional): called with (path, nframes) for each finished tiff,
+                                               where nframes is the number of frames per plane.
+            skip_existing (bool, optional): ignore tiffs already in the folder. Defaults to True.
+        """
+        self.folder = Path(folder)
+        self.qs = qs
+        self.nchannels = nchannels
+        self.nplanes = nplanes
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.on_trial_end = on_trial_end
+
+        self.done = set(self._list_tiffs()) if skip_existing else set()
+        self.lengths = []
+
+        self.index = None
+        self._name = None
+        self._sent = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start tailing in a background thread."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logger.info(f'Tailing tiffs in {self.folder}.')
+
+    def stop(self):
+        """Stop tailing and finish the current tiff."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.poll(final=True)
+        logger.info(f'Stopped tailing {self.folder}. Got {len(self.lengths)} trials.')
+
+    def poll(self, final=False):
+        """
+        Add any new frames to the queues and handle file boundaries.
+
+        Args:
+            final (bool, optional): end the current trial after adding its frames. Defaults to False.
+        """
+        names = [n for n in self._list_tiffs() if n not in self.done and n != self._name]
+
+        if self.index is None:
+            self._open(names)
+        if self.index is not None:
+            self._push_frames()
+
+        # ScanImage writes one file at a time, a new file means the current one is done
+        while self.index is not None and names:
+            self._finish()
+            self._open(names)
+            if self.index is not None:
+                self._push_frames()
+
+        if final and self.index is not None:
+            self._finish()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Error while tailing tiffs.')
+            self._stop.wait(self.poll_interval)
+
+    def _list_tiffs(self):
+        with os.scandir(self.folder) as it:
+            names = [e.name for e in it if e.is_file() and '.tif' in e.name.lower()]
+        return sorted(names)
+
+    def _open(self, names):
+        if not names:
+            return
+        # the header might not be written yet, try again next poll
+        self.index = index_tiff(self.folder/names[0])
+        if self.index is None:
+            return
+        self._name = names.pop(0)
+        self._sent = 0
+        for q in self.qs:
+            q.put('TRIAL START')
+
+    def _push_frames(self):
+        self.index.update()
+        for page in range(self._sent, len(self.index)):
+            if page % self.nchannels != self.channel:
+                continue
+            plane = (page // self.nchannels) % self.nplanes
+            self.qs[plane].put(self.index.page(page))
+        self._sent = len(self.index)
+
+    def _finish(self):
+        self._push_frames()
+        for q in self.qs:
+            q.put('TRIAL END')
+
+        # frames in the first plane, same as slicing the full tiff
+        nframes = len(range(self.channel, len(self.index), self.nchannels * self.nplanes))
+        self.lengths.append(nframes)
+        if self.on_trial_end is not None:
+            self.on_trial_end(self.index.path, nframes)
+
+        self.index.close()
+        self.done.add(self._name)
+        self.index = None
+        self._name = None
@@ -0,0 +1,139 @@
+"""
+Background re-fitting of the OnACID model. A seeded CNMF is run on the most recent motion corrected
+frames in another process and the refined footprints are swapped into the live model between
+frames, so the realtime loop never waits on the re-fit.
+"""
+
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+logger = logging.getLogger('live2p')
+
+
+class RefitBuffer:
+    """Ring buffer of the last motion corrected frames, kept in a memmap so another process can read it."""
+
+    def __init__(self, path, nframes, dims):
+        """
+        Args:
+            path (str or Path): path of the memmap file (put it in the worker's temp folder)
+            nframes (int): number of frames to keep
+            dims (tuple): (y, x) size of the frames
+        """
+        self.path = str(path)
+        self.nframes = nframes
+        self.dims = tuple(dims)
+        self.head = 0
+        self._buf = np.memmap(self.path, dtype=np.float32, mode='w+', shape=(nframes, *self.dims))
+
+    @property
+    def n_valid(self):
+        return min(self.head, self.nframes)
+
+    def add(self, frame):
+        """Add a frame, overwriting the oldest one when full."""
+        self._buf[self.head % self.nframes] = frame
+        self.head += 1
+
+    def job(self):
+        """What a process needs to read the buffer in order (see read_buffer)."""
+        self._buf.flush()
+        return dict(path=self.path, nframes=self.nframes, dims=self.dims, head=self.head)
+
+    def close(self):
+        del self._buf
+        Path(self.path).unlink(missing_ok=True)
+
+
+def read_buffer(path, nframes, dims, head):
+    """Read the frames of a RefitBuffer, oldest to newest, from another process."""
+    buf = np.memmap(path, dtype=np.float32, mode='r', shape=(nframes, *dims))
+    n_valid = min(head, nframes)
+    order = (np.arange(head - n_valid, head)) % nframes
+    return np.array(buf[order])
+
+
+def refit_model(buffer_job, Ain, params, nb):
+    """
+    Seeded CNMF on the buffered frames. Runs in a separate process.
+
+    Args:
+        buffer_job (dict): from RefitBuffer.job()
+        Ain (scipy.sparse matrix): (pixels, cells) current footprints used as the seed
+        params (CNMFParams): params of the live model
+        nb (int): number of background components
+
+    Returns:
+        dict with refined 'A' (sparse, pixels x cells), 'b' (pixels x nb), the number of seeds
+        'nseeds', 'nframes' and 'fit_time'
+    """
+    # only imported in the child process
+    from caiman.source_extraction.cnmf import cnmf
+
+    t = time.perf_counter()
+    images = read_buffer(**buffer_job)
+
+    # keep the seeds as they are, no patches or merging so cell indices stay the same
+    params.change_params(dict(fnames=None, dims=images.shape[1:], nb=nb, rf=None,
+                              only_init=False, merge_thr=1.0, K=Ain.shape[1]))
+    cnm = cnmf.CNMF(n_processes=1, params=params, Ain=Ain)
+    cnm.fit(images)
+
+    return {
+        'A': scipy.sparse.csc_matrix(cnm.estimates.A),
+        'b': np.asarray(cnm.estimates.b),
+        'nseeds': Ain.shape[1],
+        'nframes': images.shape[0],
+        'fit_time': time.perf_counter() - t,
+    }
+
+
+def swap_footprints(estimates, A, b, nb):
+    """
+    Swap refined footprints and background into the live OnACID estimates and recompute what
+    fit_next depends on (AtA, AtY_buf, ind_A, groups, Ab_dense). Must be called between frames.
+    New footprints are scaled to the norm of the ones they replace so traces don't jump. Cells
+    OnACID added since the re-fit started are kept as they are. A must have one column per seed, in
+    the order of the seeds, or the footprints would be swapped into the wrong cells.
+
+    Args:
+        estimates (Estimates): estimates of the live OnACID object
+        A (scipy.sparse matrix): (pixels, cells) refined footprints
+        b (np.array): (pixels, nb) refined background
+        nb (int): number of background components
+
+    Returns:
+        time the swap took in seconds
+    """
+    t = time.perf_counter()
+    Ab = scipy.sparse.csc_matrix(estimates.Ab)
+    ncells = A.shape[1]
+    if nb + ncells > Ab.shape[1]:
+        raise ValueError(f'Re-fit has {ncells} cells but the model only has {Ab.shape[1] - nb}.')
+
+    from caiman.source_extraction.cnmf.utilities import update_order
+
+    new = scipy.sparse.hstack([scipy.sparse.csc_matrix(b), A]).tocsc()
+    old_norms = scipy.sparse.linalg.norm(Ab[:, :nb + ncells], axis=0)
+    new_norms = scipy.sparse.linalg.norm(new, axis=0)
+    scale = np.divide(old_norms, new_norms, out=np.ones_like(old_norms), where=new_norms > 0)
+    new = new @ scipy.sparse.diags(scale)
+
+    Ab = scipy.sparse.hstack([new, Ab[:, nb + ncells:]]).tocsc()
+    Ab.eliminate_zeros()
+
+    estimates.Ab = Ab
+    estimates.AtA = (Ab.T @ Ab).toarray()
+    estimates.ind_A = [Ab.indices[Ab.indptr[m]:Ab.indptr[m + 1]] for m in range(nb, Ab.shape[1])]
+    estimates.groups = list(map(list, update_order(Ab)[0]))
+    if getattr(estimates, 'Yr_buf', None) is not None:
+        estimates.AtY_buf = Ab.T.dot(np.asarray(estimates.Yr_buf).T)
+    if getattr(estimates, 'Ab_dense', None) is not None:
+        estimates.Ab_dense[:, :Ab.shape[1]] = Ab.toarray()
+
+    return time.perf_counter() - t
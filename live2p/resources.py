@@ -0,0 +1,157 @@
+"""
+CPU layout for the realtime workers. Each plane worker gets its own set of cores and a matching BLAS
+thread limit, and a few cores are kept free for MATLAB/ScanImage and the event loop, so the planes
+don't oversubscribe the CPU (which shows up as jitter in the time per frame).
+"""
+
+import contextlib
+import ctypes
+import logging
+import os
+import sys
+
+import numpy as np
+
+try:
+    # comes with scikit-learn (a caiman dependency)
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+logger = logging.getLogger('live2p')
+
+# read by BLAS/OpenMP when they load, so processes started later (tiles, re-fits) get the limit too
+BLAS_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+def available_cores():
+    """Cores this process is allowed to run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def n_worker_cores(reserve=2):
+    """Number of cores left for processing after reserving some for MATLAB and the event loop."""
+    return max(1, len(available_cores()) - reserve)
+
+def pin_thread(cores):
+    """
+    Pin the calling thread to cores (Linux and Windows, a no-op elsewhere).
+
+    Args:
+        cores (list): core numbers
+
+    Returns:
+        list of the cores the thread was allowed on before, or None if pinning isn't supported
+    """
+    cores = sorted(int(c) for c in cores)
+    if hasattr(os, 'sched_setaffinity'):
+        # pid 0 is the calling thread on Linux
+        previous = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, cores)
+        return previous
+    if sys.platform == 'win32':
+        kernel32 = ctypes.windll.kernel32
+        kernel32.GetCurrentThread.restype = ctypes.c_void_p
+        kernel32.SetThreadAffinityMask.restype = ctypes.c_size_t
+        kernel32.SetThreadAffinityMask.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+        mask = sum(1 << c for c in cores)
+        previous = kernel32.SetThreadAffinityMask(kernel32.GetCurrentThread(), mask)
+        if previous == 0:
+            logger.warning(f'Failed to pin thread to cores {cores}.')
+            return None
+        return [c for c in range(previous.bit_length()) if previous >> c & 1]
+    logger.debug('Thread pinning is not supported on this platform.')
+    return None
+
+def pin_process(cores):
+    """
+    Pin a helper process (tiles, re-fits) to cores, call it first thing in the new process (eg. as
+    a ProcessPoolExecutor initializer). Threads it starts afterwards get the same cores. Nothing if
+    cores is None.
+    """
+    if cores is not None:
+        pin_thread(cores)
+
+@contextlib.contextmanager
+def pinned(cores):
+    """Pin the calling thread to cores inside the with block (nothing if cores is None)."""
+    previous = pin_thread(cores) if cores is not None else None
+    try:
+        yield
+    finally:
+        if previous is not None:
+            pin_thread(previous)
+
+def limit_blas(threads):
+    """
+    Limit BLAS/OpenMP threads for the whole process (they are global, not per thread) and for
+    processes started from it.
+
+    Returns:
+        threadpoolctl limiter (call .restore_original_limits() to undo) or None if threadpoolctl isn't installed
+    """
+    for var in BLAS_ENV_VARS:
+        os.environ[var] = str(threads)
+    if threadpool_limits is None:
+        logger.warning('threadpoolctl is not installed, BLAS threads are only limited for new processes.')
+        return None
+    return threadpool_limits(limits=threads)
+
+
+class ResourceLayout:
+    """Which cores each plane worker (and MATLAB/the event loop) runs on."""
+
+    def __init__(self, nplanes, reserve=2, cores=None):
+        """
+        The first reserve cores are kept for MATLAB and the event loop. The rest are split into
+        contiguous blocks, one per plane. If there are more planes than cores, planes share.
+
+        Args:
+            nplanes (int): number of plane workers
+            reserve (int, optional): cores kept free for MATLAB and the event loop. Defaults to 2.
+            cores (list, optional): cores to lay out. Defaults to all cores this process can use.
+        """
+        cores = available_cores() if cores is None else sorted(cores)
+        reserve = max(0, min(reserve, len(cores) - 1))
+        self.ncores = len(cores)
+        self.reserved = cores[:reserve]
+        usable = cores[reserve:]
+        if nplanes <= len(usable):
+            self.planes = [block.tolist() for block in np.array_split(usable, nplanes)]
+        else:
+            self.planes = [[usable[p % len(usable)]] for p in range(nplanes)]
+        # BLAS limits are process wide, so use the smallest core set
+        self.blas_threads = max(1, min(len(c) for c in self.planes))
+        self.limiter = None
+
+    def apply(self):
+        """
+        Set the BLAS thread limit. The event loop isn't pinned, new threads and processes inherit
+        the cores of the thread that starts them, so the executor threads, tiles and re-fits would
+        all end up on the reserved cores. The plane workers pin their own loop and helper processes
+        to their cores instead.
+        """
+        self.limiter = limit_blas(self.blas_threads)
+
+    def describe(self):
+        """The layout as a printable table."""
+        lines = [f'CPU layout ({self.ncores} cores, {self.blas_threads} BLAS threads per plane):']
+        lines.append(f'  MATLAB/event loop: {_format_cores(self.reserved) or "none reserved"}')
+        for p, cores in enumerate(self.planes):
+            lines.append(f'  plane {p}: {_format_cores(cores)}')
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return f'ResourceLayout(reserved={self.reserved}, planes={self.planes}, blas_threads={self.blas_threads})'
+
+
+def _format_cores(cores):
+    # [0, 1, 2, 5] -> '0-2, 5'
+    ranges = []
+    for c in cores:
+        if ranges and c == ranges[-1][1] + 1:
+            ranges[-1][1] = c
+        else:
+            ranges.append([c, c])
+    return ', '.join(str(a) if a == b else f'{a}-{b}' for a, b in ranges)
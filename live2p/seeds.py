@@ -0,0 +1,137 @@
+"""
+Build seed (init) movies for OnACID by sampling frames across many tiffs. Only the header of each
+tiff and the sampled pages are read.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .tiffindex import index_tiff
+from .utils import tic, toc
+
+logger = logging.getLogger('live2p')
+
+
+def index_tiffs(files, max_workers=8):
+    """Index the headers of many tiffs in parallel. Tiffs that can't be indexed are dropped."""
+    files = [str(f) for f in files]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        indexes = list(pool.map(index_tiff, files))
+    for f, idx in zip(files, indexes):
+        if idx is None:
+            logger.warning(f'Could not read the header of {f}. It will not be used for the seed.')
+    return [idx for idx in indexes if idx is not None]
+
+
+def build_seed(files, plane, nchannels, nplanes, n_init=500, strategy='even', channel=0,
+               x_slice=slice(None), y_slice=slice(None), **kwargs):
+    """
+    Make a seed movie of n_init frames for one plane, sampled across a list of tiffs.
+
+    Strategies:
+        * 'even' = n_init frames evenly spaced across all tiffs
+        * 'first' = the first n_init frames (in file order)
+        * 'variance' = whole trials with the highest variance over time, kept in file order
+
+    Args:
+        files (list): list of str or Path of tiffs to sample from
+        plane (int): plane to get frames from
+        nchannels (int): number of channels saved in the tiffs
+        nplanes (int): number of z-planes in the tiffs
+        n_init (int, optional): number of frames in the seed. Defaults to 500.
+        strategy (str, optional): how to choose frames (see above). Defaults to 'even'.
+        channel (int, optional): channel to get frames from. Defaults to 0.
+        x_slice (slice, optional): slice along x-axis. Defaults to slice(None).
+        y_slice (slice, optional): slice along y-axis. Defaults to slice(None).
+        **kwargs: passed to the strategy (eg. n_probe for 'variance')
+
+    Returns:
+        np.array of (frames, y, x)
+    """
+    t = tic()
+    indexes = index_tiffs(files)
+    if len(indexes) == 0:
+        raise FileNotFoundError('No readable tiffs to build the seed from.')
+
+    # page numbers of this plane + channel in each tiff
+    step = nchannels * nplanes
+    first = plane * nchannels + channel
+    pages = [np.arange(first, len(idx), step) for idx in indexes]
+
+    try:
+        choose = _STRATEGIES[strategy]
+    except KeyError:
+        raise ValueError(f"Seed strategy '{strategy}' does not exist. Use one of {list(_STRATEGIES)}.")
+    picks = choose(indexes, pages, n_init, x_slice=x_slice, y_slice=y_slice, **kwargs)
+
+    # read just the chosen pages, cropped
+    shape = np.empty(indexes[0].shape)[y_slice, x_slice].shape
+    seed = np.empty((sum(p.size for p in picks), *shape), dtype=indexes[0].dtype)
+    i = 0
+    for idx, pick in zip(indexes, picks):
+        for page in pick:
+            seed[i] = idx.page(page)[y_slice, x_slice]
+            i += 1
+        idx.close()
+
+    logger.info(f'Built {seed.shape[0]} frame seed for plane {plane} from {sum(p.size > 0 for p in picks)} '
+                f'of {len(indexes)} tiffs ({strategy}) in {toc(t):.3f}s.')
+
+    if seed.shape[0] < n_init:
+        logger.warning(f'Only {seed.shape[0]} frames were available for the seed (wanted {n_init}).')
+
+    return seed
+
+
+def _first(indexes, pages, n_init, **kwargs):
+    picks = []
+    remaining = n_init
+    for p in pages:
+        picks.append(p[:max(remaining, 0)])
+        remaining -= p.size
+    return picks
+
+
+def _even(indexes, pages, n_init, **kwargs):
+    counts = np.array([p.size for p in pages])
+    total = counts.sum()
+    if total <= n_init:
+        return pages
+
+    # evenly spaced frames over the concatenated movie, then split back into tiffs
+    frames = np.unique(np.linspace(0, total - 1, n_init).round().astype(int))
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    which = np.searchsorted(bounds, frames, side='right') - 1
+    return [p[frames[which == i] - bounds[i]] for i, p in enumerate(pages)]
+
+
+def _variance(indexes, pages, n_init, x_slice=slice(None), y_slice=slice(None), n_probe=8, **kwargs):
+    # score each tiff from a few probe frames, mean over pixels of the temporal std
+    scores = np.zeros(len(pages))
+    for i, (idx, p) in enumerate(zip(indexes, pages)):
+        if p.size < 2:
+            continue
+        probe = p[np.linspace(0, p.size - 1, min(n_probe, p.size)).round().astype(int)]
+        probe = idx.pages(probe)[:, y_slice, x_slice].astype(np.float32)
+        scores[i] = probe.std(axis=0).mean()
+
+    # take whole tiffs from the highest score down, keep them in file order
+    keep = np.zeros(len(pages), dtype=bool)
+    nframes = 0
+    for i in np.argsort(scores)[::-1]:
+        if nframes >= n_init:
+            break
+        keep[i] = True
+        nframes += pages[i].size
+
+    picks = [p if k else p[:0] for p, k in zip(pages, keep)]
+    return _first(indexes, picks, n_init)
+
+
+_STRATEGIES = {
+    'even': _even,
+    'first': _first,
+    'variance': _variance,
+}
@@ -0,0 +1,51 @@
+"""
+Snapshots of a running worker (recent traces, shifts, mean image) for queries from clients. The
+worker builds a new snapshot every few frames and swaps it in, readers only ever see a finished one
+and never block the worker.
+"""
+
+import numpy as np
+
+from .binning import bin_frame
+
+
+class SnapshotBuffer:
+    """
+    Double buffer for snapshots. The worker builds the back snapshot from fresh copies and publishes
+    it by swapping the reference (atomic under the GIL), so readers don't need a lock and a
+    snapshot is never changed after it's published.
+    """
+
+    def __init__(self):
+        self._front = None
+        self.version = 0
+
+    def publish(self, snapshot):
+        """Make a finished snapshot (dict) the current one."""
+        self._front = snapshot
+        self.version += 1
+
+    def get(self):
+        """The latest snapshot, or None if there isn't one yet."""
+        return self._front
+
+
+class RunningMeanImage:
+    """Exponential running mean of frames, downsampled so it's cheap to keep and send."""
+
+    def __init__(self, ds=4, frames=100):
+        """
+        Args:
+            ds (int, optional): spatial downsampling factor. Defaults to 4.
+            frames (int, optional): about how many frames the mean is over. Defaults to 100.
+        """
+        self.ds = ds
+        self.alpha = 1 / frames
+        self.image = None
+
+    def add(self, frame):
+        small = bin_frame(np.asarray(frame, dtype=np.float32), self.ds)
+        if self.image is None:
+            self.image = small.copy()
+        else:
+            self.image += self.alpha * (small - self.image)
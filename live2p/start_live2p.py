@@ -1,9 +1,9 @@
 import logging
 import warnings
-from importlib_metadata import version
-from sklearn.exceptions import ConvergenceWarning
+from importlib.metadata import version
 
-warnings.simplefilter('ignore', category=ConvergenceWarning)
+# sklearn's ConvergenceWarning is filtered by the warm-up once sklearn is imported (live2p.warmup),
+# importing it here would hold up the server by seconds
 warnings.simplefilter('ignore', category=DeprecationWarning)
 
 DEFAULT_IP = 'localhost'
@@ -0,0 +1,259 @@
+"""
+Lightweight tiff header index. Parses the IFD chain of (Big)TIFF files to get the location of
+each page's pixel data without reading the pixel data itself.
+"""
+
+import logging
+import mmap
+import os
+import struct
+
+import numpy as np
+
+logger = logging.getLogger('live2p')
+
+# tiff field types -> (struct code, size in bytes)
+_TYPES = {
+    1: ('B', 1),  # BYTE
+    2: ('c', 1),  # ASCII
+    3: ('H', 2),  # SHORT
+    4: ('I', 4),  # LONG
+    6: ('b', 1),  # SBYTE
+    7: ('B', 1),  # UNDEFINED
+    8: ('h', 2),  # SSHORT
+    9: ('i', 4),  # SLONG
+    11: ('f', 4), # FLOAT
+    12: ('d', 8), # DOUBLE
+    16: ('Q', 8), # LONG8
+    17: ('q', 8), # SLONG8
+    18: ('Q', 8), # IFD8
+}
+
+# tags needed to locate and interpret page data
+_WIDTH = 256
+_LENGTH = 257
+_BITS = 258
+_COMPRESSION = 259
+_STRIP_OFFSETS = 273
+_SAMPLES = 277
+_STRIP_BYTES = 279
+_SAMPLE_FORMAT = 339
+
+_SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+_FORMAT_TAGS = {_WIDTH, _LENGTH, _BITS, _COMPRESSION, _STRIP_OFFSETS, _SAMPLES, _STRIP_BYTES, _SAMPLE_FORMAT}
+_STRIP_TAGS = {_STRIP_OFFSETS, _STRIP_BYTES}
+
+
+class TiffIndex:
+    """Index of page (frame) locations in a tiff file, built from the IFD chain only."""
+
+    def __init__(self, path):
+        """
+        Parses the tiff header and all IFDs currently on disk. Call update() to pick up pages
+        appended since the last parse (eg. for a tiff that ScanImage is still writing).
+
+        Args:
+            path (str or Path): path to the tiff
+        """
+        self.path = str(path)
+        self.offsets = []
+        self.shape = None
+        self.dtype = None
+        self.nbytes = None
+
+        self._next_ifd = None
+        self._next_pos = None # where _next_ifd was read from, patched when a page is appended
+        self._last_end = 0
+        self._mmap = None
+        self._fmt = None
+
+        with open(self.path, 'rb') as f:
+            self._read_header(f)
+        self.update()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def complete(self):
+        """True if the last IFD ends the chain and its pixel data is on disk."""
+        return self._next_ifd == 0 and self._last_end <= os.path.getsize(self.path)
+
+    def update(self):
+        """
+        Parse IFDs written since the last call. Stops at the end of the chain or at the first IFD
+        (or page data) that isn't fully on disk yet. ScanImage appends a page by patching the
+        last IFD's next offset, so at the end of the chain it's read again in case it has been.
+
+        Returns:
+            int: number of new pages found
+        """
+        n_before = len(self.offsets)
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            if self._next_ifd == 0:
+                # the size may not change when the pointer is patched, so it's always read
+                offset_size = struct.calcsize(self._fmt['offset'])
+                f.seek(self._next_pos)
+                raw = f.read(offset_size)
+                if len(raw) < offset_size:
+                    return 0
+                self._next_ifd = struct.unpack(self._fmt['bo'] + self._fmt['offset'], raw)[0]
+                
+            while self._next_ifd:
+                try:
+                    page = self._read_ifd(f, self._next_ifd, size)
+                except (KeyError, struct.error):
+                    # IFD space is allocated but not filled in yet
+                    page = None
+                if page is None:
+                    break
+                data_offset, next_ifd, next_pos = page
+                self.offsets.append(data_offset)
+                self._last_end = data_offset + self.nbytes
+                self._next_ifd = next_ifd
+                self._next_pos = next_pos
+
+        return len(self.offsets) - n_before
+
+    def page(self, idx):
+        """Returns a single page as an array (copied out of the file)."""
+        return self.pages([idx])[0]
+
+    def pages(self, idxs):
+        """
+        Read only the requested pages through a memory map of the file.
+
+        Args:
+            idxs (array-like or slice): page indices to read
+
+        Returns:
+            np.array of (pages, y, x)
+        """
+        if isinstance(idxs, slice):
+            idxs = range(*idxs.indices(len(self)))
+        idxs = list(idxs)
+        buf = self._get_mmap()
+        out = np.empty((len(idxs), *self.shape), dtype=self.dtype)
+        for i, idx in enumerate(idxs):
+            off = self.offsets[idx]
+            out[i] = np.frombuffer(buf, dtype=self.dtype, count=out[i].size, offset=off).reshape(self.shape)
+        return out
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _get_mmap(self):
+        # remap if the file has grown past the current map
+        if self._mmap is None or len(self._mmap) < self._last_end:
+            self.close()
+            with open(self.path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _read_header(self, f):
+        head = f.read(16)
+        if head[:2] == b'II':
+            bo = '<'
+        elif head[:2] == b'MM':
+            bo = '>'
+        else:
+            raise ValueError(f'{self.path} is not a tiff file.')
+
+        version = struct.unpack(bo + 'H', head[2:4])[0]
+        if version == 42:
+            self._fmt = dict(bo=bo, ntags='H', count='I', offset='I', tag_size=12, inline=4)
+            self._next_ifd = struct.unpack(bo + 'I', head[4:8])[0]
+            self._next_pos = 4
+        elif version == 43:
+            self._fmt = dict(bo=bo, ntags='Q', count='Q', offset='Q', tag_size=20, inline=8)
+            self._next_ifd = struct.unpack(bo + 'Q', head[8:16])[0]
+            self._next_pos = 8
+        else:
+            raise ValueError(f'{self.path} has an unknown tiff version ({version}).')
+        
+        # tag entries are (code, type, count, value or offset to value)
+        self._entry = struct.Struct(f'{bo}HH{self._fmt["count"]}{self._fmt["inline"]}s')
+
+    def _read_ifd(self, f, ifd_offset, size):
+        fmt = self._fmt
+        bo = fmt['bo']
+        ntags_size = struct.calcsize(fmt['ntags'])
+        offset_size = struct.calcsize(fmt['offset'])
+
+        if ifd_offset + ntags_size > size:
+            return None
+        f.seek(ifd_offset)
+        ntags = struct.unpack(bo + fmt['ntags'], f.read(ntags_size))[0]
+        ifd_size = ntags * fmt['tag_size'] + offset_size
+        if ifd_offset + ntags_size + ifd_size > size:
+            return None
+        raw = f.read(ifd_size)
+
+        # once the page format is known only the strip tags are needed
+        wanted = _STRIP_TAGS if self.shape is not None else _FORMAT_TAGS
+        tags = {}
+        for code, typ, count, value in self._entry.iter_unpack(raw[:-offset_size]):
+            if code in wanted:
+                tags[code] = self._tag_values(f, value, typ, count)
+        next_ifd = struct.unpack(bo + fmt['offset'], raw[-offset_size:])[0]
+
+        if self.shape is None:
+            self._set_page_format(tags)
+
+        strip_offsets = tags[_STRIP_OFFSETS]
+        strip_bytes = tags[_STRIP_BYTES]
+        data_offset = strip_offsets[0]
+
+        # pages must be stored as one contiguous block to be indexed
+        if len(strip_offsets) > 1:
+            ends = [o + b for o, b in zip(strip_offsets, strip_bytes)]
+            if strip_offsets[1:] != ends[:-1]:
+                raise ValueError(f'{self.path} has non-contiguous page data and cannot be indexed.')
+        if sum(strip_bytes) != self.nbytes:
+            raise ValueError(f'{self.path} has page data that does not match the page size.')
+
+        if data_offset + self.nbytes > size:
+            return None
+
+        return data_offset, next_ifd, ifd_offset + ntags_size + ifd_size - offset_size
+
+    def _tag_values(self, f, value_field, typ, count):
+        if count == 1 and typ in (3, 4, 16):
+            # fast path for single ints
+            return [int.from_bytes(value_field[:_TYPES[typ][1]], 'little' if self._fmt['bo'] == '<' else 'big')]
+        bo = self._fmt['bo']
+        code, size = _TYPES.get(typ, ('B', 1))
+        nbytes = size * count
+        if nbytes <= self._fmt['inline']:
+            data = value_field[:nbytes]
+        else:
+            offset = struct.unpack(bo + self._fmt['offset'], value_field[:self._fmt['inline']])[0]
+            pos = f.tell()
+            f.seek(offset)
+            data = f.read(nbytes)
+            f.seek(pos)
+        return list(struct.unpack(bo + code * count, data))
+
+    def _set_page_format(self, tags):
+        if tags.get(_COMPRESSION, [1])[0] != 1:
+            raise ValueError(f'{self.path} is compressed and cannot be indexed.')
+        if tags.get(_SAMPLES, [1])[0] != 1:
+            raise ValueError(f'{self.path} has more than 1 sample per pixel and cannot be indexed.')
+        bits = tags.get(_BITS, [8])[0]
+        kind = _SAMPLE_KINDS[tags.get(_SAMPLE_FORMAT, [1])[0]]
+        self.dtype = np.dtype(f'{self._fmt["bo"]}{kind}{bits // 8}')
+        self.shape = (tags[_LENGTH][0], tags[_WIDTH][0])
+        self.nbytes = self.shape[0] * self.shape[1] * self.dtype.itemsize
+
+
+def index_tiff(path):
+    """Returns a TiffIndex for path, or None if it can't be indexed (yet)."""
+    try:
+        return TiffIndex(path)
+    except (OSError, ValueError, KeyError, struct.error):
+        logger.debug(f'Could not index {path}.')
+        return None
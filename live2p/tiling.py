@@ -0,0 +1,409 @@
+"""
+Tiled processing of a single plane. The FOV is split into overlapping tiles that each get their own
+OnACID in a separate process, so a dense plane isn't limited to one core in fit_next. Motion is
+estimated once on the full frame and the registered tiles are sent to the tile processes.
+Components are put back in the full FOV and de-duplicated in the overlaps at the end.
+"""
+
+import copy
+import logging
+import multiprocessing as mp
+import queue
+import time
+import traceback
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse
+
+from .motion import RigidRegistration
+from .resources import pin_process
+
+logger = logging.getLogger('live2p')
+
+
+def tile_layout(dims, tiles, overlap):
+    """
+    Split a (y, x) FOV into a grid of overlapping tiles.
+
+    Args:
+        dims (tuple): (y, x) size of the FOV
+        tiles (tuple): number of tiles as (rows, cols)
+        overlap (int): pixels neighboring tiles share
+
+    Returns:
+        list of (yslice, xslice) of each tile and list of (yslice, xslice) of each tile's core, the
+        part of the tile it owns. Cores don't overlap and cover the FOV. Tiles are in row major order.
+    """
+    bounds = []
+    for size, n in zip(dims, tiles):
+        edges = np.linspace(0, size, n + 1).round().astype(int)
+        cores = [slice(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:])]
+        padded = [slice(max(0, c.start - overlap // 2), min(size, c.stop + overlap - overlap // 2))
+                  for c in cores]
+        bounds.append((padded, cores))
+    (ys, ycores), (xs, xcores) = bounds
+    layout = [(y, x) for y in ys for x in xs]
+    cores = [(y, x) for y in ycores for x in xcores]
+    return layout, cores
+
+def embed_tile(A, tile, dims):
+    """
+    Put spatial components of a tile (tile pixels, cells; 'F' order) into the full FOV.
+
+    Args:
+        A (np.array or scipy.sparse matrix): components of the tile
+        tile (tuple): (yslice, xslice) of the tile
+        dims (tuple): (y, x) size of the full FOV
+
+    Returns:
+        scipy.sparse.csc_matrix of (pixels, cells) in the full FOV, 'F' order
+    """
+    ys, xs = tile
+    rows = np.arange(ys.start, ys.stop)
+    cols = np.arange(xs.start, xs.stop)
+    # full FOV index of each tile pixel, both in 'F' order
+    pix = (rows[:, None] + cols[None, :] * dims[0]).ravel(order='F')
+    A = scipy.sparse.csc_matrix(A)
+    return scipy.sparse.csc_matrix((A.data, pix[A.indices], A.indptr),
+                                   shape=(dims[0] * dims[1], A.shape[1]))
+
+def component_centers(A, dims):
+    """Weighted (y, x) center of each component of A (pixels, cells; 'F' order)."""
+    A = scipy.sparse.csc_matrix(A)
+    y, x = np.unravel_index(np.arange(A.shape[0]), dims, order='F')
+    total = np.asarray(A.sum(axis=0)).ravel()
+    total[total == 0] = 1
+    cy = np.asarray(A.T @ y).ravel() / total
+    cx = np.asarray(A.T @ x).ravel() / total
+    return np.stack([cy, cx], axis=1)
+
+def dedupe_components(A, tile_idx, cores, dims, thr=0.7):
+    """
+    Find which components to keep after merging tiles. Every component belongs to the tile whose
+    core has its center. Components found by their own tile are all kept. Components found by a
+    neighbor (in the overlap) are only kept if they don't overlap a kept component, so cells a
+    tile missed near its edge are still picked up from its neighbor.
+
+    Args:
+        A (scipy.sparse matrix): (pixels, cells) components of all tiles in the full FOV
+        tile_idx (np.array): tile each component came from
+        cores (list): (yslice, xslice) cores from tile_layout
+        dims (tuple): (y, x) size of the full FOV
+        thr (float, optional): cosine similarity of footprints above which two components are the
+                               same cell. Defaults to 0.7.
+
+    Returns:
+        bool np.array of components to keep
+    """
+    tile_idx = np.asarray(tile_idx)
+    ncells = A.shape[1]
+    if ncells == 0:
+        return np.zeros(0, dtype=bool)
+
+    centers = component_centers(A, dims)
+    owner = np.full(ncells, -1)
+    for i, (ys, xs) in enumerate(cores):
+        inside = ((centers[:, 0] >= ys.start - 0.5) & (centers[:, 0] < ys.stop - 0.5) &
+                  (centers[:, 1] >= xs.start - 0.5) & (centers[:, 1] < xs.stop - 0.5))
+        owner[inside & (owner == -1)] = i
+    keep = owner == tile_idx
+
+    # cosine similarity of every component to the kept ones
+    A = scipy.sparse.csc_matrix(A, dtype=np.float64)
+    norms = np.sqrt(np.asarray(A.multiply(A).sum(axis=0)).ravel())
+    norms[norms == 0] = 1
+    An = A @ scipy.sparse.diags(1 / norms)
+
+    # greedy over the rest, most compact (highest peak) first
+    peaks = np.asarray(An.max(axis=0).todense()).ravel()
+    for j in np.flatnonzero(~keep)[np.argsort(-peaks[~keep])]:
+        kept = np.flatnonzero(keep)
+        if kept.size == 0 or (An[:, kept].T @ An[:, j]).max() < thr:
+            keep[j] = True
+    return keep
+
+
+def run_tile(idx, mov, params, Ain, num_frames_max, mmap_path, in_q, out_q, cpus=None):
+    """
+    OnACID on one tile. Runs in its own process, fitting registered tile frames from in_q until it
+    gets None, then puts its model on out_q.
+
+    Args:
+        idx (int): tile number
+        mov (np.array): (t, y, x) registered init movie of the tile
+        params (CNMFParams): params for the tile
+        Ain (np.array or None): seed components of the tile
+        num_frames_max (int): max frames OnACID allocates for
+        mmap_path (str): where to save the init mmap
+        in_q (mp.Queue): tile frames, None to stop
+        out_q (mp.Queue): ('ready', idx, ncells), ('done', idx, model) or ('error', idx, traceback)
+        cpus (list, optional): CPU cores to pin the process to. Defaults to None (not pinned).
+    """
+    pin_process(cpus)
+    try:
+        # only imported in the child process
+        import caiman as cm
+        from caiman.source_extraction.cnmf.online_cnmf import OnACID
+
+        fname = cm.movie(mov.astype('float32')).save(mmap_path, order='C')
+        params.change_params(dict(fnames=str(fname), init_batch=mov.shape[0], motion_correct=False))
+        acid = OnACID(dview=None, params=params)
+        acid.estimates.A = Ain
+        acid.initialize_online(T=num_frames_max)
+
+        nb = params.get('init', 'nb')
+        t = frame_start = mov.shape[0] + 1
+        out_q.put(('ready', idx, acid.M - nb))
+
+        fit_time = 0.0
+        while True:
+            frame = in_q.get()
+            if frame is None:
+                break
+            tic = time.perf_counter()
+            acid.fit_next(t, frame.ravel(order='F'))
+            fit_time += time.perf_counter() - tic
+            t += 1
+
+        est = acid.estimates
+        out_q.put(('done', idx, {
+            'A': scipy.sparse.csc_matrix(est.Ab[:, nb:acid.M]),
+            'b': est.Ab[:, :nb].toarray(),
+            'C': est.C_on[nb:acid.M, frame_start:t],
+            'f': est.C_on[:nb, frame_start:t],
+            'nC': est.noisyC[nb:acid.M, frame_start:t],
+            'nframes': t - frame_start,
+            'fit_time': fit_time,
+        }))
+    except Exception:
+        out_q.put(('error', idx, traceback.format_exc()))
+
+
+class TiledPlane:
+    """Runs one plane as overlapping tiles, each with its own OnACID process."""
+
+    # seconds between checks that the tile processes are still alive while waiting on them
+    poll_interval = 1.0
+
+    def __init__(self, mov, params, tiles, overlap=32, Ain=None, num_frames_max=10000,
+                 temp_path='.', plane=0, merge_thr=0.7, init_timeout=None, cpus=None,
+                 max_backlog=500):
+        """
+        The init movie is registered to its mean first so the tiles start from the same reference
+        as the live frames. Blocks until every tile is initialized.
+
+        Args:
+            mov (np.array): (t, y, x) init movie of the plane (cropped and binned)
+            params (CNMFParams): params of the plane, motion correction is done here not in the tiles
+            tiles (tuple): number of tiles as (rows, cols)
+            overlap (int, optional): pixels neighboring tiles share, should be about 2 cell
+                                     diameters. Defaults to 32.
+            Ain (np.array, optional): (pixels, cells) seed components of the full plane. Defaults
+                                      to None.
+            num_frames_max (int, optional): max frames for each tile's OnACID. Defaults to 10000.
+            temp_path (str or Path, optional): folder for the tile init mmaps. Defaults to '.'.
+            plane (int, optional): plane for file names and log messages. Defaults to 0.
+            merge_thr (float, optional): footprint similarity of duplicates (see
+                                         dedupe_components). Defaults to 0.7.
+            init_timeout (float, optional): seconds to wait for the tiles to initialize. Defaults
+                                            to None (wait forever).
+            cpus (list, optional): CPU cores the tile processes are pinned to (the plane's cores).
+                                   Defaults to None (not pinned).
+            max_backlog (int, optional): frames queued for a tile before fit waits on it.
+                                         Defaults to 500.
+        """
+        self.dims = mov.shape[1:]
+        self.tiles, self.cores = tile_layout(self.dims, tiles, overlap)
+        self.plane = plane
+        self.merge_thr = merge_thr
+        self.nb = params.get('init', 'nb')
+        self._results = None
+        self.wait_time = [0.0] * len(self.tiles) # seconds fit waited on each tile's full queue
+
+        max_shift = params.get('online', 'max_shifts_online') or 10
+        self.registration = RigidRegistration(mov.mean(axis=0), max_shift=max_shift)
+        mov = self.registration.register_movie(mov)
+
+        ctx = mp.get_context('spawn')
+        self._out_q = ctx.Queue()
+        self._in_qs = []
+        self._procs = []
+        npix = self.dims[0] * self.dims[1]
+        for i, (ys, xs) in enumerate(self.tiles):
+            tile_dims = (ys.stop - ys.start, xs.stop - xs.start)
+            tile_params = _tile_params(params, tile_dims, tile_dims[0] * tile_dims[1] / npix)
+            tile_Ain = self._tile_ain(Ain, (ys, xs))
+            in_q = ctx.Queue(maxsize=max_backlog)
+            proc = ctx.Process(target=run_tile, daemon=True, name=f'live2p-plane{plane}-tile{i}',
+                               args=(i, np.ascontiguousarray(mov[:, ys, xs]), tile_params, tile_Ain,
+                                     num_frames_max, str(Path(temp_path)/f'initplane{plane}_tile{i}.mmap'),
+                                     in_q, self._out_q, cpus))
+            proc.start()
+            self._in_qs.append(in_q)
+            self._procs.append(proc)
+
+        self.ncells = [0] * len(self.tiles)
+        for _ in self.tiles:
+            kind, idx, value = self._out_q.get(timeout=init_timeout)
+            if kind == 'error':
+                self.stop(timeout=1)
+                raise RuntimeError(f'Tile {idx} of plane {plane} failed to initialize:\n{value}')
+            self.ncells[idx] = value
+
+        logger.info(f'Initialized {len(self.tiles)} tiles ({tiles[0]}x{tiles[1]}, {overlap} px overlap) '
+                    f'with {self.ncells} cells. (Queue {plane})')
+
+    def fit(self, frame, registered=False):
+        """
+        Register a (cropped, binned) frame and send its tiles out to be fit. Frames already put
+        through self.registration (eg. in a batch) are sent as they are if registered.
+        """
+        frame_cor = frame if registered else self.registration.register(frame)[0]
+        for i, (ys, xs) in enumerate(self.tiles):
+            if not self._put(i, np.ascontiguousarray(frame_cor[ys, xs])):
+                raise RuntimeError(f'Tile {i} of plane {self.plane} stopped.')
+
+    def _put(self, i, item):
+        # waits while the tile's queue is full, False if the tile died
+        try:
+            self._in_qs[i].put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        logger.warning(f'Tile {i} is behind, waiting on it. (Queue {self.plane})')
+        start = time.perf_counter()
+        try:
+            while self._procs[i].is_alive():
+                try:
+                    self._in_qs[i].put(item, timeout=self.poll_interval)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            self.wait_time[i] += time.perf_counter() - start
+
+    def stop(self, timeout=None):
+        """
+        Stop the tile processes and collect their models. Waits for every tile to finish its
+        queued frames, tiles whose process died are given up on.
+
+        Args:
+            timeout (float, optional): seconds to wait on each tile. Defaults to None (wait as long
+                                       as the tiles are alive).
+
+        Returns:
+            dict of tile number -> model of the tiles that finished
+        """
+        if self._results is not None:
+            return self._results
+        for i in range(len(self._in_qs)):
+            self._put(i, None)
+
+        results = {}
+        pending = {i for i, p in enumerate(self._procs)}
+        dead = set()
+        waited = 0.0
+        while pending:
+            try:
+                kind, idx, value = self._out_q.get(timeout=self.poll_interval)
+            except queue.Empty:
+                waited += self.poll_interval
+                # a tile is only given up on after a whole poll without its result, it could have
+                # sent it just before exiting
+                failed = dead & pending
+                if failed:
+                    logger.error(f'Tiles {sorted(failed)} stopped without a result. (Queue {self.plane})')
+                    pending -= failed
+                dead = {i for i in pending if not self._procs[i].is_alive()}
+                if timeout is not None and waited >= timeout and pending:
+                    logger.error(f'Tiles {sorted(pending)} did not finish. (Queue {self.plane})')
+                    break
+                continue
+            waited = 0.0
+            if kind == 'done':
+                results[idx] = value
+            elif kind == 'error':
+                logger.error(f'Tile {idx} failed. (Queue {self.plane})\n{value}')
+            else:
+                continue
+            pending.discard(idx)
+
+        for proc in self._procs:
+            proc.join(timeout=1)
+            if proc.is_alive():
+                proc.terminate()
+        self._results = results
+        return results
+
+    def get_model(self):
+        """
+        Merge the tile models into one model of the plane, same keys as RealTimeQueue.get_model
+        (without YrA). Stops the tiles if they are still running.
+        """
+        results = self.stop()
+        npix = self.dims[0] * self.dims[1]
+        nframes = min((r['nframes'] for r in results.values()), default=0)
+
+        A, b, C, f, nC, tile_idx = [], [], [], [], [], []
+        for i in sorted(results):
+            r = results[i]
+            A.append(embed_tile(r['A'], self.tiles[i], self.dims))
+            b.append(embed_tile(r['b'], self.tiles[i], self.dims))
+            C.append(r['C'][:, :nframes])
+            f.append(r['f'][:, :nframes])
+            nC.append(r['nC'][:, :nframes])
+            tile_idx.append(np.full(r['A'].shape[1], i))
+
+        if not A:
+            A, b = scipy.sparse.csc_matrix((npix, 0)), scipy.sparse.csc_matrix((npix, 0))
+            C = f = nC = np.zeros((0, nframes))
+            tile_idx = np.zeros(0, dtype=int)
+        else:
+            A, b = scipy.sparse.hstack(A).tocsc(), scipy.sparse.hstack(b).tocsc()
+            C, f, nC = np.vstack(C), np.vstack(f), np.vstack(nC)
+            tile_idx = np.concatenate(tile_idx)
+
+        keep = dedupe_components(A, tile_idx, self.cores, self.dims, thr=self.merge_thr)
+        self.tile_log = [{
+            'y': [self.tiles[i][0].start, self.tiles[i][0].stop],
+            'x': [self.tiles[i][1].start, self.tiles[i][1].stop],
+            'ncells': int((tile_idx == i).sum()),
+            'kept': int((keep & (tile_idx == i)).sum()),
+            'fit_time': results[i]['fit_time'] if i in results else None,
+            'wait_time': self.wait_time[i],
+        } for i in range(len(self.tiles))]
+        logger.info(f'Merged tiles into {int(keep.sum())} cells, dropped {int((~keep).sum())} duplicates. '
+                    f'(Queue {self.plane})')
+
+        return {
+            'A': A[:, keep].toarray(),
+            'b': b.toarray(),
+            'C': C[keep],
+            'f': f,
+            'nC': nC[keep],
+            'shifts': np.array(self.registration.shifts[:nframes]).reshape(-1, 2),
+        }
+
+    def _tile_ain(self, Ain, tile):
+        # seeds with their center in the tile
+        if Ain is None:
+            return None
+        centers = component_centers(scipy.sparse.csc_matrix(Ain, dtype=np.float32), self.dims)
+        ys, xs = tile
+        inside = ((centers[:, 0] >= ys.start) & (centers[:, 0] < ys.stop) &
+                  (centers[:, 1] >= xs.start) & (centers[:, 1] < xs.stop))
+        A3 = np.asarray(Ain).reshape(*self.dims, -1, order='F')[ys, xs][..., inside]
+        return A3.reshape(-1, A3.shape[-1], order='F')
+
+
+def _tile_params(params, dims, fraction):
+    # copy of the plane's params for a tile, K (cells per patch) scaled by the tile's share of pixels
+    tile_params = copy.deepcopy(params)
+    changes = dict(dims=dims)
+    K = params.get('init', 'K')
+    if K:
+        changes['K'] = max(1, int(np.ceil(K * fraction)))
+    tile_params.change_params(changes)
+    return tile_params
@@ -0,0 +1,241 @@
+"""
+Bounded memory trace storage for long sessions. OnACID's C_on/noisyC only hold a fixed window of
+recent frames, older frames are spilled in chunks to a file on disk and read back from there, so
+memory doesn't grow with the session and there is no hard cap on frames.
+
+OnACID's frame count t is also the number of samples in its running statistics (CC, CY, ...), so it
+has to keep counting from the start of the session. The windowed arrays are indexed by global frame
+(WindowedTraces) and only the storage is windowed.
+"""
+
+import logging
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger('live2p')
+
+
+# OnACID grows C_on/noisyC with vstack when components are added, the result stays windowed
+_STACKING = (np.vstack, np.concatenate)
+
+
+class WindowedTraces(np.ndarray):
+    """
+    (components, window) trace array indexed by global frame. Ints and slices on the frame axis are
+    shifted by the window's offset, writes that start before the window drop the spilled part and
+    reads before it raise an IndexError. Anything read out of it is a plain array.
+    """
+
+    def __new__(cls, arr, window):
+        obj = np.asarray(arr).view(cls)
+        obj.window = window
+        return obj
+
+    def __array_finalize__(self, obj):
+        self.window = getattr(obj, 'window', None)
+
+    def _local(self, key):
+        # (key with the frame axis in window columns, number of leading frames that were spilled)
+        if self.window is None or not isinstance(key, tuple) or len(key) != 2:
+            return key, 0
+        rows, cols = key
+        offset = self.window.offset
+        if isinstance(cols, (int, np.integer)):
+            if cols < offset:
+                raise IndexError(f'Frame {cols} was spilled to disk (window starts at {offset}).')
+            return (rows, cols - offset), 0
+        if isinstance(cols, slice) and cols.step in (None, 1):
+            start = None if cols.start is None else cols.start - offset
+            stop = None if cols.stop is None else max(cols.stop - offset, 0)
+            spilled = 0
+            if start is not None and start < 0:
+                spilled, start = -start, 0
+            return (rows, slice(start, stop)), spilled
+        return key, 0
+
+    def __getitem__(self, key):
+        local, spilled = self._local(key)
+        if spilled:
+            raise IndexError(f'Frames before {self.window.offset} were spilled to disk.')
+        out = self.view(np.ndarray)[local]
+        # a row selection still covers the whole window, keep it windowed
+        if local is key and isinstance(out, np.ndarray):
+            return WindowedTraces(out, self.window)
+        return out
+
+    def __setitem__(self, key, value):
+        local, spilled = self._local(key)
+        if spilled:
+            value = np.asarray(value)
+            if value.ndim:
+                value = value[..., spilled:]
+        self.view(np.ndarray)[local] = value
+
+    def __array_function__(self, func, types, args, kwargs):
+        # numpy functions work on the plain window (their own indexing isn't by global frame)
+        out = func(*(_plain(a) for a in args), **kwargs)
+        if func in _STACKING and isinstance(out, np.ndarray) and out.ndim == 2 and out.shape[1] == self.shape[1]:
+            return WindowedTraces(out, self.window)
+        return out
+
+    def __repr__(self):
+        offset = self.window.offset if self.window is not None else 0
+        return f'WindowedTraces(offset={offset}, {self.view(np.ndarray)!r})'
+
+    def __array_wrap__(self, arr, context=None, return_scalar=False):
+        if return_scalar:
+            return arr[()]
+        return arr.view(np.ndarray)
+
+
+def _plain(arg):
+    if isinstance(arg, WindowedTraces):
+        return arg.view(np.ndarray)
+    if isinstance(arg, (list, tuple)):
+        return type(arg)(_plain(a) for a in arg)
+    return arg
+
+
+class TraceStore:
+    """(components, frames) traces appended to a file in chunks of frames and read back as memmaps."""
+
+    def __init__(self, path):
+        """
+        Chunks can have more rows than earlier ones (components added during the session), rows a
+        chunk doesn't have read back as 0.
+
+        Args:
+            path (str or Path): file to store the traces in (usually in the worker's temp folder)
+        """
+        self.path = Path(path)
+        self.dtype = None
+        self.nframes = 0
+        self.chunks = [] # (first frame, nframes, nrows, byte offset)
+        self._file = None
+
+    def append(self, block):
+        """Append a (components, frames) block."""
+        if self._file is None:
+            self.dtype = block.dtype
+            self._file = open(self.path, 'wb')
+        block = np.ascontiguousarray(block, dtype=self.dtype)
+        offset = self._file.tell()
+        self._file.write(block.tobytes())
+        self._file.flush()
+        self.chunks.append((self.nframes, block.shape[1], block.shape[0], offset))
+        self.nframes += block.shape[1]
+
+    def read(self, rows, start, stop):
+        """
+        Read frames [start, stop) of rows (a slice with a start and stop).
+
+        Returns:
+            np.array of (rows, frames)
+        """
+        out = np.zeros((rows.stop - rows.start, stop - start), dtype=self.dtype or np.float64)
+        for first, n, nrows, offset in self.chunks:
+            a, b = max(start, first), min(stop, first + n)
+            r = min(rows.stop, nrows)
+            if a >= b or r <= rows.start:
+                continue
+            chunk = np.memmap(self.path, dtype=self.dtype, mode='r', offset=offset, shape=(nrows, n))
+            out[:r - rows.start, a - start:b - start] = chunk[rows.start:r, a - first:b - first]
+        return out
+
+    def close(self):
+        """Close and delete the file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.path.unlink(missing_ok=True)
+
+
+class TraceWindow:
+    """
+    Keeps the traces of OnACID estimates (C_on, noisyC) to a fixed window of frames. When the window
+    fills up, everything but the last keep frames is spilled to a TraceStore and the window is
+    shifted back. The trace arrays are swapped for WindowedTraces, so they are still indexed by
+    global frame (from the start of the session) and OnACID's t doesn't change.
+    """
+
+    def __init__(self, estimates, folder, start, keep=200, names=('C_on', 'noisyC'), tag=''):
+        """
+        Args:
+            estimates (Estimates): OnACID estimates with the (components, window) trace arrays
+            folder (str or Path): folder for the store files
+            start (int): first frame to keep (eg. the first frame after the init batch), earlier
+                         frames are dropped when spilled
+            keep (int, optional): frames that stay in the window after a spill, OnACID looks back
+                                  over the last minibatch_shape frames (and mc over 50). Defaults
+                                  to 200.
+            names (tuple, optional): trace arrays of estimates to window. Defaults to
+                                     ('C_on', 'noisyC').
+            tag (str, optional): added to the store file names, eg. the plane. Defaults to ''.
+        """
+        self.estimates = estimates
+        self.start = start
+        self.keep = keep
+        self.size = getattr(estimates, names[0]).shape[1]
+        if keep >= self.size - 1:
+            raise ValueError(f'keep ({keep}) has to be less than the window ({self.size} frames).')
+        self.offset = 0 # global frame of column 0
+        self.stores = {name: TraceStore(Path(folder)/f'{name}{tag}.traces') for name in names}
+        for name in names:
+            self._array(name)
+            
+    def _array(self, name):
+        # plain view of the window, the estimates' array is (re)wrapped if it was replaced
+        arr = getattr(self.estimates, name)
+        if not isinstance(arr, WindowedTraces) or arr.window is not self:
+            if self.offset:
+                logger.warning(f'{name} lost its trace window after frames were spilled.')
+            setattr(self.estimates, name, WindowedTraces(arr, self))
+        return np.asarray(arr)
+
+    def local(self, t):
+        """Column of global frame t."""
+        return t - self.offset
+
+    def full(self, t):
+        """True if global frame t is at the end of the window."""
+        return self.local(t) >= self.size - 1
+
+    def spill(self, t, nrows):
+        """
+        Spill the window up to the last keep frames before global frame t to disk and shift the
+        rest to the front.
+
+        Args:
+            t (int): current global frame (not written yet)
+            nrows (int): rows in use (OnACID's M)
+        """
+        shift = self.local(t) - self.keep
+        first = max(self.start - self.offset, 0)
+        for name, store in self.stores.items():
+            arr = self._array(name)
+            if shift > first:
+                store.append(arr[:nrows, first:shift])
+            arr[:, :self.size - shift] = arr[:, shift:]
+            arr[:, self.size - shift:] = 0
+        self.offset += shift
+        logger.debug(f'Spilled {shift - first} frames of traces to disk, {self.offset} frames total.')
+
+    def read(self, name, rows, start, stop):
+        """
+        Global frames [start, stop) of rows (slice with a start and stop) of a trace array, from
+        the store and the window.
+        """
+        parts = []
+        if start < self.offset:
+            parts.append(self.stores[name].read(rows, start - self.start, min(stop, self.offset) - self.start))
+        if stop > self.offset:
+            arr = self._array(name)
+            parts.append(arr[rows, self.local(max(start, self.offset)):self.local(stop)])
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts, axis=1)
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
@@ -18,6 +18,8 @@ import pandas as pd
 import scipy.io as sio
 from ScanImageTiffReader import ScanImageTiffReader
 
+from . import metadata
+
 with warnings.catch_warnings():
     warnings.simplefilter('ignore', category=FutureWarning)
     import caiman as cm
@@ -127,22 +129,10 @@ def get_tiff_lengths(movie_list, x_slice, y_slice, t_slice):
     return np.concatenate(data)
             
 def get_nchannels(file):
-    with ScanImageTiffReader(file) as reader:
-        metadata = reader.metadata()
-    channel_pass_1 = metadata.split('channelSave = [')
-    if len(channel_pass_1)==1:
-        nchannels = 1
-    else:
-        nchannels = len(metadata.split('channelSave = [')[1].split(']')[0].split(';'))
-    return nchannels
+    return metadata.get_nchannels(file)
 
 def get_nvols(file):
-    with ScanImageTiffReader(file) as reader:
-        metadata = reader.metadata()
-    if metadata.split('hStackManager.zs = ')[1][0]=='0':
-        return 1
-    nvols = len(metadata.split('hStackManager.zs = [')[1].split(']')[0].split(' '))
-    return nvols
+    return metadata.get_nplanes(file)
 
 def random_view(arr, length, n=1):
     """
@@ -0,0 +1,137 @@
+"""
+Fast start-up. The server only imports what it needs to open the socket, the heavy modules
+(caiman and tensorflow, scipy.stats, sklearn, pandas) are imported in a background thread while
+ScanImage is being set up, and are ready by the time SETUP starts the workers.
+"""
+
+import importlib
+import logging
+import subprocess
+import sys
+import threading
+import time
+import warnings
+from collections import defaultdict
+
+logger = logging.getLogger('live2p')
+
+# imported before the server opens the socket
+STARTUP_MODULES = ('live2p.cli', 'live2p.websockets.server')
+
+# imported in the background, slowest first
+HEAVY_MODULES = (
+    'caiman',
+    'live2p.workers',
+    'live2p.analysis.traces',
+    'live2p.readers',
+    'live2p.motion',
+    'scipy.io',
+)
+
+
+class Warmup:
+    """Imports modules in a background thread."""
+
+    def __init__(self, modules=HEAVY_MODULES):
+        self.modules = modules
+        self.timings = {} # module -> seconds
+        self.errors = {} # module -> exception
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='live2p-warmup', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        for name in self.modules:
+            start = time.perf_counter()
+            try:
+                importlib.import_module(name)
+            except Exception as e:
+                # it fails again (with the real error) where it's used
+                logger.debug(f'Warm-up import of {name} failed: {e}')
+                self.errors[name] = e
+            self.timings[name] = time.perf_counter() - start
+        _quiet_sklearn()
+        self._done.set()
+        logger.debug(self.describe())
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the imports to finish. Returns True if they did."""
+        return self._done.wait(timeout)
+
+    def describe(self):
+        total = sum(self.timings.values())
+        lines = [f'Warm-up imports ({total:.1f} s):']
+        for name, t in self.timings.items():
+            status = ' (failed)' if name in self.errors else ''
+            lines.append(f'  {name}: {t*1000:.0f} ms{status}')
+        return '\n'.join(lines)
+
+
+def _quiet_sklearn():
+    # OnACID's NMF init warns a lot, filtered once sklearn is imported
+    try:
+        from sklearn.exceptions import ConvergenceWarning
+    except ImportError:
+        return
+    warnings.simplefilter('ignore', category=ConvergenceWarning)
+
+
+def profile_imports(startup=STARTUP_MODULES, heavy=HEAVY_MODULES, top=10):
+    """
+    Profile the start-up and warm-up imports in a fresh interpreter with python -X importtime.
+
+    Args:
+        startup (tuple, optional): modules imported before the socket is open. Defaults to
+                                   STARTUP_MODULES.
+        heavy (tuple, optional): modules imported in the background. Defaults to HEAVY_MODULES.
+        top (int, optional): number of packages to list per phase. Defaults to 10.
+
+    Returns:
+        str report of the time per phase and the slowest packages in each
+    """
+    marker = 'live2p-warmup-starts'
+    code = [f'import {m}' for m in startup]
+    code.append(f'import sys; print({marker!r}, file=sys.stderr, flush=True)')
+    for m in heavy:
+        code += ['try:', f'    import {m}', 'except Exception:', '    pass']
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', '\n'.join(code)],
+                          capture_output=True, text=True)
+
+    phases = {'start-up': defaultdict(int), 'warm-up': defaultdict(int)}
+    phase = 'start-up'
+    for line in proc.stderr.splitlines():
+        if line.strip() == marker:
+            phase = 'warm-up'
+            continue
+        parsed = _parse_importtime(line)
+        if parsed is not None:
+            self_us, name = parsed
+            phases[phase][name.split('.')[0]] += self_us
+
+    lines = ['Import profile (python -X importtime):']
+    if proc.returncode != 0:
+        error = proc.stderr.strip().splitlines()[-1:] or ['unknown error']
+        lines.append(f'  start-up imports failed: {error[0]}')
+    for phase, packages in phases.items():
+        total = sum(packages.values()) / 1e6
+        lines.append(f'  {phase}: {total:.2f} s')
+        for name, us in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+            lines.append(f'    {name:<24} {us/1000:8.0f} ms')
+    return '\n'.join(lines)
+
+
+def _parse_importtime(line):
+    # 'import time:       self |  cumulative | [indent]module', None for the header and other output
+    if not line.startswith('import time:'):
+        return None
+    fields = line[len('import time:'):].split('|')
+    if len(fields) != 3 or not fields[0].strip().isdigit():
+        return None
+    return int(fields[0]), fields[2].strip()
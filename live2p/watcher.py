@@ -0,0 +1,171 @@
+"""
+Watches an epoch folder for new tiffs and hands them off once ScanImage is done writing them.
+"""
+
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from .tiffindex import index_tiff
+
+logger = logging.getLogger('live2p')
+
+
+class EpochWatcher:
+    """Polls an epoch folder and calls back with each completed tiff, once, in acquisition order."""
+
+    def __init__(self, folder, callback, poll_interval=0.2, stable_polls=2,
+                 pattern='.tif', skip_existing=True):
+        """
+        A tiff is considered complete when the header index finds a valid final IFD (end of the
+        IFD chain with all page data on disk) and the file size hasn't changed for 'stable_polls'
+        polls. A tiff is also complete as soon as a later tiff shows up, since ScanImage only
+        writes one file at a time. Tiffs are handed off in filename order (which is acquisition
+        order for ScanImage) and an incomplete tiff holds back the ones after it.
+
+        Args:
+            folder (str or Path): epoch folder to watch
+            callback (callable): called with the str path of each complete tiff
+            poll_interval (float, optional): seconds between polls. Defaults to 0.2.
+            stable_polls (int, optional): number of polls the size must not change for. Defaults to 2.
+            pattern (str, optional): file extension to look for. Defaults to '.tif' (also gets .tiff).
+            skip_existing (bool, optional): ignore tiffs already in the folder (eg. the seed
+                                            tiffs). Defaults to True.
+        """
+        self.folder = Path(folder)
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.stable_polls = stable_polls
+        self.pattern = pattern
+
+        self.done = set(self._list_tiffs()) if skip_existing else set()
+        self.n_found = 0
+
+        # name -> [index, last size, number of polls at that size]
+        self._pending = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start polling in a background thread."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        logger.info(f'Watching {self.folder} for new tiffs.')
+
+    def stop(self, flush=True, timeout=2):
+        """
+        Stop polling. If flush, hands off any remaining tiffs that have a valid final IFD, which
+        should be all of them once ScanImage has aborted. Waits up to timeout (s) for the last
+        tiff to be finished.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if flush:
+            t_end = time.perf_counter() + timeout
+            self.poll(final=True)
+            while self._remaining() and time.perf_counter() < t_end:
+                time.sleep(self.poll_interval)
+                self.poll(final=True)
+            for name in self._remaining():
+                logger.warning(f'Tiff {name} was never finished and was skipped.')
+        logger.info(f'Stopped watching {self.folder}. Found {self.n_found} tiffs.')
+
+    def poll(self, final=False):
+        """
+        Check the folder once and hand off newly completed tiffs.
+
+        Args:
+            final (bool, optional): don't wait on the file size to be stable. Defaults to False.
+
+        Returns:
+            list of str paths that were completed on this poll
+        """
+        names = self._remaining()
+        completed = []
+
+        for i, name in enumerate(names):
+            later_exists = i < len(names) - 1
+            if not self._is_complete(name, later_exists or final):
+                if later_exists and self._pending.get(name, [None, -1, 0])[2] >= self.stable_polls:
+                    # a later tiff exists and this one stopped growing, it's never getting finished
+                    logger.warning(f'Tiff {name} could not be read and was skipped.')
+                    self._finish(name)
+                    continue
+                break
+            self._finish(name)
+            path = str(self.folder/name)
+            completed.append(path)
+            self.n_found += 1
+            self.callback(path)
+
+        return completed
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Error while polling the epoch folder.')
+            self._stop.wait(self.poll_interval)
+
+    def _list_tiffs(self):
+        with os.scandir(self.folder) as it:
+            names = [e.name for e in it if e.is_file() and self.pattern in e.name.lower()]
+        return sorted(names)
+
+    def _remaining(self):
+        return [n for n in self._list_tiffs() if n not in self.done]
+
+    def _finish(self, name):
+        entry = self._pending.pop(name, None)
+        if entry is not None and entry[0] is not None:
+            entry[0].close()
+        self.done.add(name)
+
+    def _is_complete(self, name, closed):
+        path = self.folder/name
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return False
+
+        # count stable polls first, a file that can't be indexed is skipped once it stops growing
+        entry = self._pending.setdefault(name, [None, -1, 0])
+        if size == entry[1]:
+            entry[2] += 1
+        else:
+            entry[1], entry[2] = size, 0
+
+        if entry[0] is None:
+            entry[0] = index_tiff(path)
+            if entry[0] is None:
+                return False
+        else:
+            # only parse IFDs added since the last poll
+            entry[0].update()
+
+        if not entry[0].complete:
+            return False
+
+        return closed or entry[2] >= self.stable_polls
+
+
+def wait_for_tiff(path, timeout=5, poll_interval=0.05):
+    """
+    Block until a tiff has a valid final IFD or timeout (s) is reached. Returns the TiffIndex or
+    None if it timed out.
+    """
+    t_end = time.perf_counter() + timeout
+    idx = None
+    while time.perf_counter() < t_end:
+        if idx is None:
+            idx = index_tiff(path)
+        if idx is not None:
+            idx.update()
+            if idx.complete:
+                return idx
+        time.sleep(poll_interval)
+    return None
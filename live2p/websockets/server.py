@@ -3,18 +3,22 @@ import concurrent.futures
 import json
 import logging
 import queue
+from datetime import datetime
 from pathlib import Path
 from collections import defaultdict
 
 import numpy as np
-import scipy.io as sio
-from ScanImageTiffReader import ScanImageTiffReader
 
 from ..alerts import Alert
-from ..analysis.traces import process_data
-from ..guis import openfilesgui
-from ..utils import now
-from ..workers import RealTimeQueue
+from ..resources import ResourceLayout
+from ..tiffindex import index_tiff
+from ..warmup import Warmup
+from ..watcher import EpochWatcher, wait_for_tiff
+from ..writer import ResultWriter, dump_json, save_mat, save_npy, write_bytes
+
+# caiman (workers), scipy.stats and sklearn (analysis.traces) and pandas (utils) take seconds to
+# import, they are imported where they're used and warmed up in the background after the socket
+# is open (see live2p.warmup)
 
 import websockets
 
@@ -44,6 +48,39 @@ class Live2pServer:
         self.kwargs = kwargs
         self.kwargs.setdefault('num_frames_max', 20000)
         
+        # tiff prefetching, reads ahead of the queues in a background thread
+        self.reader = None
+        self.prefetch_ahead = self.kwargs.pop('prefetch_ahead', 2)
+        self.prefetch_bytes = self.kwargs.pop('prefetch_bytes', None)
+        
+        # 'acqdone' adds tiffs on ACQDONE events, 'watch' polls the epoch folder for finished tiffs,
+        # 'tail' adds frames from the tiff that is being written as soon as they are on disk
+        self.ingest_mode = self.kwargs.pop('ingest_mode', 'acqdone')
+        self.watcher = None
+        self.tailer = None
+        
+        # cross-plane motion sharing, motion_ref_plane estimates rigid shifts for the whole volume and
+        # the other planes only apply them
+        self.motion_share = None
+        motion_ref_plane = self.kwargs.pop('motion_ref_plane', 0)
+        share_timeout = self.kwargs.pop('share_timeout', 0.05)
+        if self.kwargs.pop('share_motion', False):
+            from ..motion import MotionShare
+            self.motion_share = MotionShare(ref_plane=motion_ref_plane, timeout=share_timeout)
+        
+        # CPU layout, each plane gets its own cores and a BLAS thread limit to match, reserve_cores are
+        # kept for MATLAB and the event loop. Set up once the number of planes is known.
+        self.use_resources = self.kwargs.pop('resources', False)
+        self.reserve_cores = self.kwargs.pop('reserve_cores', 2)
+        self.layout = None
+        
+        # results are written in the background by writer_threads threads, each format is serialized
+        # once and written to all the output folders at the same time
+        self.writer = ResultWriter(max_workers=self.kwargs.pop('writer_threads', 4))
+        
+        # live tuning summaries are sent to all clients every tuning_interval seconds (None is off)
+        self.tuning_interval = self.kwargs.pop('tuning_interval', 60)
+        self._running = False
         
         # custom settings
         self.use_init_gui = use_init_gui
@@ -71,6 +108,9 @@ class Live2pServer:
             wslogs = logging.getLogger('websockets')
             wslogs.setLevel(logging.DEBUG)
         
+        # import the heavy modules in the background while ScanImage is set up
+        self.warmup = Warmup().start() if self.kwargs.pop('warmup', True) else None
+        
         self._start_ws_server()
         
         
@@ -127,10 +167,10 @@ class Live2pServer:
         
         # ! I think this could go in context manager for graceful failures
         async for payload in websocket:
-            await self.route(payload)
+            await self.route(payload, websocket)
             
             
-    async def route(self, payload):
+    async def route(self, payload, websocket=None):
         """
         Route the incoming message to the appropriate consumer/message handler. Incoming
         data should be a JSON that is parsed into a Python dictionary (aka MATLAB struct). You can 
@@ -156,10 +196,19 @@ class Live2pServer:
                        
         SETUP ->
         
+        TUNING -> query for the live tuning, replies to the sender with a TUNING event. Set 'plane'
+                  to only get one plane and 'full' to true to get per-cell curves and stats
+                  instead of the summary. calls 'self.send_tuning()'
+                  
+        SNAPSHOT -> query for a snapshot of the running workers, replies to the sender with a
+                    SNAPSHOT event with the recent C/noisyC traces, shifts, and downsampled mean
+                    image of each plane. Optional 'plane', 'cells' (list of component indices) and
+                    'frames' (last n frames). calls 'self.send_snapshot()'
         
 
         Args:
             payload (str): incoming string, formatted as a JSON
+            websocket (optional): websocket the message came from, for replies. Defaults to None.
         """
         data = json.loads(payload)
         
@@ -171,8 +220,10 @@ class Live2pServer:
             
         ###-----Route events and data here-----###
         if event_type == 'ACQDONE':
-            self.trialtimes_all.append(now())
-            await self.put_tiff_frames_in_queue(tiff_name=data.get('filename', None))
+            self.trialtimes_all.append(datetime.now().strftime('%H:%M:%S'))
+            # in watch or tail mode tiffs are already added from the epoch folder
+            if self.watcher is None and self.tailer is None:
+                await self.put_tiff_frames_in_queue(tiff_name=data.get('filename', None))
             
         elif event_type == 'SESSIONDONE':
             await self.stop_queues()
@@ -187,6 +238,12 @@ class Live2pServer:
             
         elif event_type == 'LOG':
             self.add_to_log(data)  
+            
+        elif event_type == 'TUNING':
+            await self.send_tuning(websocket, **data)
+            
+        elif event_type == 'SNAPSHOT':
+            await self.send_snapshot(websocket, **data)
         
         ##-----Other useful messages-----###
         
@@ -217,9 +274,13 @@ class Live2pServer:
         # either glob the tiffs from the epoch folder or get them from a GUI
         tiffs = list(Path(self.folder).glob('*.tif*'))
         
-        # get from GUI pop-up if no tiffs present
-        if len(tiffs) == 0 or self.use_init_gui:
+        # get from GUI pop-up if no tiffs present, with a seed strategy the seed is sampled from
+        # the tiffs already in the epoch folder
+        use_gui = self.use_init_gui and self.kwargs.get('seed_strategy') is None
+        if len(tiffs) == 0 or use_gui:
             # do GUI in seperate thread, openfilesgui should return a list/tuple
+            # (tkinter is only imported when it's needed)
+            from ..guis import openfilesgui
             tiffs = await self.loop.run_in_executor(None, openfilesgui, 
                                              Path(self.folder).parent,
                                              'Select seed image.')
@@ -231,31 +292,74 @@ class Live2pServer:
                 
         self.init_files = tiffs
         
+        if self.motion_share is not None and self.motion_share.ref_plane >= self.nplanes:
+            logger.warning(f'Motion reference plane {self.motion_share.ref_plane} is not in the {self.nplanes} '
+                           f'planes. Using plane 0.')
+            self.motion_share.ref_plane = 0
+        
+        if self.use_resources:
+            self.layout = ResourceLayout(self.nplanes, reserve=self.reserve_cores)
+            self.layout.apply()
+            Alert(self.layout.describe(), 'info')
+        
+        # caiman has to be imported before the workers start
+        if self.warmup is not None and not self.warmup.done:
+            Alert('Still loading caiman...', 'info')
+            await self.loop.run_in_executor(None, self.warmup.wait)
+        
         # spawn queues and workers (without launching queue)
         # self.workers = [self.start_worker(p) for p in range(self.nplanes)]
         tasks = [self.loop.run_in_executor(None, self.start_worker, p) for p in range(self.nplanes)]
         self.workers = await asyncio.gather(*tasks)
         
+        from ..readers import PrefetchReader, TiffTailer
+        
+        # reader gets tiffs as they come in from ACQDONE and slices them into planes
+        tslices = [slice(p*self.nchannels, None, self.nchannels*self.nplanes) for p in range(self.nplanes)]
+        self.reader = PrefetchReader(tslices=tslices, ahead=self.prefetch_ahead, 
+                                     max_bytes=self.prefetch_bytes,
+                                     min_frames=self.short_tiff_threshold)
+        
+        # seed tiffs already in the folder are skipped
+        if self.ingest_mode == 'watch':
+            self.watcher = EpochWatcher(self.folder, self.reader.add)
+            self.watcher.start()
+        elif self.ingest_mode == 'tail':
+            self.tailer = TiffTailer(self.folder, self.qs, self.nchannels, self.nplanes,
+                                     on_trial_end=self.log_trial)
+            self.tailer.start()
+        
         # finished setup, ready to go
         Alert("Ready to process online!", 'success')
             
                 
     async def run_queues(self):
+        self._running = True
+        if self.tuning_interval:
+            self.loop.create_task(self.send_tuning_summaries())
+        
         # start the queues on their loop and wait for them to return a result
         tasks = [self.loop.run_in_executor(None, w.process_frame_from_queue) for w in self.workers]
+        # feed the queues from the prefetching reader, the tailer feeds them directly
+        if self.tailer is None:
+            tasks.append(self.loop.run_in_executor(None, self.feed_queues))
         results = await asyncio.gather(*tasks)
+        results = results[:len(self.workers)]
+        self._running = False
         
         # from here do final analysis
         # results will be a list of dicts
         Alert('Processing and saving final data.', 'info')
         
-        if self.folder is not None:
-            # added to make sure in some weird case self.folder doesn't get assigned
-            self.process_and_save(results, save_path=self.folder)
+        # added to make sure in some weird case self.folder doesn't get assigned
+        # output folder is optional, if not specified, don't save it!
+        save_paths = [p for p in (self.folder, self.output_folder) if p is not None]
+        if save_paths:
+            await self.loop.run_in_executor(None, self.process_and_save, results, save_paths)
         
-        if self.output_folder is not None:
-            # if not specified, don't save it!
-            self.process_and_save(results)
+        # the workers' OnACID hdf5s might still be writing
+        await self.loop.run_in_executor(None, self.writer.close)
+        Alert(self.writer.report(), 'info')
         
         # Return True to release back to main loop
         # return True
@@ -265,143 +369,262 @@ class Live2pServer:
         self.loop.stop()
          
          
+    def get_tuning(self, plane=None, full=False):
+        """Live tuning of each plane (or one plane), see RealTimeQueue.get_tuning."""
+        workers = self.workers or []
+        if plane is not None:
+            workers = workers[int(plane):int(plane)+1]
+        
+        tuning = []
+        for w in workers:
+            t = w.get_tuning(summary=not full)
+            if t is not None and full:
+                t = {k: _jsonable(v) for k, v in t.items()}
+                t['plane'] = int(w.plane)
+            tuning.append(t)
+        return tuning
+    
+    async def send_tuning(self, websocket, plane=None, full=False, **kwargs):
+        """Reply to a TUNING query with the live tuning."""
+        if websocket is None:
+            return
+        try:
+            tuning = await self.loop.run_in_executor(None, self.get_tuning, plane, full)
+        except Exception:
+            logger.exception('Failed to get the live tuning.')
+            tuning = []
+        await websocket.send(json.dumps({'EVENTTYPE': 'TUNING', 'planes': tuning}))
+        
+    def get_snapshots(self, plane=None, cells=None, frames=None):
+        """Latest snapshot of each plane (or one plane), see RealTimeQueue.get_snapshot."""
+        workers = self.workers or []
+        if plane is not None:
+            workers = workers[int(plane):int(plane)+1]
+        
+        snapshots = []
+        for w in workers:
+            snap = w.get_snapshot(cells=cells, frames=frames)
+            if snap is not None:
+                snap = {k: _jsonable(v) for k, v in snap.items()}
+            snapshots.append(snap)
+        return snapshots
+    
+    async def send_snapshot(self, websocket, plane=None, cells=None, frames=None, **kwargs):
+        """Reply to a SNAPSHOT query with the latest snapshot of each plane."""
+        if websocket is None:
+            return
+        try:
+            snapshots = await self.loop.run_in_executor(None, self.get_snapshots, plane, cells, frames)
+        except ValueError as e:
+            logger.warning(f'Bad SNAPSHOT query: {e}')
+            snapshots = []
+        except Exception:
+            logger.exception('Failed to get the snapshots.')
+            snapshots = []
+        await websocket.send(json.dumps({'EVENTTYPE': 'SNAPSHOT', 'planes': snapshots}))
+        
+    async def send_tuning_summaries(self):
+        """Send a tuning summary to every client every tuning_interval seconds while running."""
+        while True:
+            await asyncio.sleep(self.tuning_interval)
+            if not self._running:
+                return
+            try:
+                tuning = await self.loop.run_in_executor(None, self.get_tuning)
+            except Exception:
+                logger.exception('Failed to get the live tuning.')
+                continue
+            
+            tuning = [t for t in tuning if t is not None]
+            if not tuning:
+                continue
+            n_resp = sum(t['n_responsive'] for t in tuning)
+            n_cells = sum(t['n_cells'] for t in tuning)
+            Alert(f'Live tuning: {n_resp} of {n_cells} cells visually responsive.', 'info')
+            
+            message = json.dumps({'EVENTTYPE': 'TUNINGSUMMARY', 'planes': tuning})
+            for client in list(self.clients):
+                try:
+                    await client.send(message)
+                except websockets.ConnectionClosed:
+                    self.clients.discard(client)
+         
     def start_worker(self, plane):
+        from ..workers import RealTimeQueue
+        
         self.qs.append(queue.Queue())
         Alert(f'Starting RealTimeWorker {plane}', 'info')
         
         worker = RealTimeQueue(self.init_files, plane, self.nchannels, self.nplanes,
-                               self.params, self.qs[plane], Ain_path=self.Ain_path, **self.kwargs)
+                               self.params, self.qs[plane], Ain_path=self.Ain_path, 
+                               stim_log=self.stim_log, psth_key=self.vis_cond_key,
+                               motion_share=self.motion_share, writer=self.writer,
+                               cores=self.layout.planes[plane] if self.layout is not None else None,
+                               reserve_cores=self.reserve_cores,
+                               **self.kwargs)
         return worker
 
     async def put_tiff_frames_in_queue(self, tiff_name=None):
-        # added sleep because last tiff isn't closed in time I think
-        await asyncio.sleep(0.5)
-        
         try:
-            # TODO:  fold this into below so there is less opening and closing of tiffs
             if tiff_name is None:
                 tiff_name = self.get_last_tiff()
+        except Exception:
+            logger.warning('Failed to find the last tiff. It was not added to the queue.')
+            return
+        
+        # last tiff isn't always closed in time, wait for its final IFD to be written
+        idx = await self.loop.run_in_executor(None, wait_for_tiff, tiff_name)
+        if idx is None:
+            logger.warning(f'{Path(tiff_name).name} was not finished in time. Trying to add it anyway.')
+        else:
+            idx.close()
+        
+        # the reader opens it in the background and feed_queues adds it to the queues
+        self.reader.add(tiff_name)
+        
+    def feed_queues(self):
+        """
+        Adds tiffs from the prefetching reader to the plane queues in the order they were received.
+        Puts a stop signal in the queues after the reader is closed and all tiffs are added.
+        """
+        for tiff, movs in self.reader:
+            # log trial time and get lengths for one plane only/once per tiff
+            self.log_trial(tiff, movs[0].shape[0])
             
-            # open data 
-            with ScanImageTiffReader(str(tiff_name)) as reader:
-                data = reader.data()
-            
-            # check if valid tiff
-            if data.shape[0] > self.short_tiff_threshold:    
-                # first, log trial time
-                self.trialtimes_success.append(now())
-                # iterate through planes to get lengths and add to queue
-                for p in range(self.nplanes):
-                    # slice movie for this plane
-                    self.qs[p].put('TRIAL START')
-                    t_slice = slice(p*self.nchannels,None,self.nchannels*self.nplanes)
-                    mov = data[t_slice, :, :]
-                    
-                    # get lengths for one plane only/once per tiff
-                    if p==0:
-                        self.lengths.append(mov.shape[0])
-                    
-                    # add frames to the queue
-                    for f in mov:
-                        self.qs[p].put(f.squeeze())
-                    
-                    # finally, add the trial done notification into the queue
-                    self.qs[p].put('TRIAL END')
-
-            else:
-                logger.warning(f'A tiff that was too short (<{self.short_tiff_threshold} frames total) was attempted to be added to the queue and was skipped.')
-                return
-            
-        except Exception: # ScanImage can't open file is a generic exception
-            # this will skip the last file since we can't open it until ScanImage aborts
-            logger.warning('Failed to add tiff to queue. If this was the last acq, this is expected. Otherwise something is wrong.')
-
+            # iterate through planes to add to queue
+            for q, mov in zip(self.qs, movs):
+                q.put('TRIAL START')
+                
+                # add frames to the queue
+                for f in mov:
+                    q.put(f.squeeze())
+                
+                # finally, add the trial done notification into the queue
+                q.put('TRIAL END')
+                
+        for q in self.qs:
+            q.put('STOP')
+    
+    def log_trial(self, tiff, nframes):
+        """Log the trial time and length (in frames per plane) of a tiff added to the queues."""
+        # not utils.now, utils imports caiman
+        self.trialtimes_success.append(datetime.now().strftime('%H:%M:%S'))
+        self.lengths.append(nframes)
     
     # ? does this need to be async??
     async def stop_queues(self):
         Alert('Recieved acqAbort. Workers will continue running until all frames are completed.', 'info')
-        for q in self.qs:
-            q.put('STOP')            
+        if self.watcher is not None:
+            # hand off the last tiff(s) before closing the reader
+            await self.loop.run_in_executor(None, self.watcher.stop)
+        if self.tailer is not None:
+            # finish the last trial, then stop
+            await self.loop.run_in_executor(None, self.tailer.stop)
+            for q in self.qs:
+                q.put('STOP')
+        elif self.reader is not None:
+            # STOP is added by feed_queues after the last tiff is read
+            self.reader.close()
+        else:
+            for q in self.qs:
+                q.put('STOP')            
             
     def get_last_tiff(self):
         """Get the last tiff and make sure it's the correct size."""
         
         last_tiffs = list(Path(self.folder).glob('*.tif*'))[-4:-2]
         
-        # pull the last few tiffs to make sure none are weirdos and get trial lengths
-        for tiff in last_tiffs:
-            with ScanImageTiffReader(str(tiff)) as reader:
-                data = reader.data()
-                # check for bad tiffs
-                if data.shape[0] < 10: 
-                    last_tiffs.remove(tiff)
+        # check the last few tiffs from their headers to make sure none are weirdos
+        last_tiffs = [tiff for tiff in last_tiffs if len(index_tiff(tiff) or []) >= 10]
 
         return str(last_tiffs[-1])
     
     
-    def process_and_save(self, results, save_path=None):
+    def process_and_save(self, results, save_paths=None):
         """
         Concatenate 'C' data across planes from results. Saves the raw data C and trial lengths, then
         processes the data, making it trialwise, min subtracting, and scaling. Saves output data in 
         several formats including json, npy, and mat.
+        
+        Each format is serialized once and written to all save_paths in the background writer. The
+        raw data is written first (and waited for) so it's on disk even if the processing fails.
 
         Args:
             results (list): list of results returned by plane workers
-            save_path (str, optional): Path to save data. Defaults to None which saves in the
-                                       self.output_folder directory
+            save_paths (list, optional): folders to save data in. Defaults to None which saves in
+                                         the self.output_folder directory
         """
         
-        if save_path is None:
-            save_path = self.output_folder
-        else:
-            save_path = Path(save_path)
+        if save_paths is None:
+            save_paths = [self.output_folder]
+        # the same folder twice (eg. the epoch folder is the output folder) would be written by two
+        # threads at once
+        save_paths = list(dict.fromkeys(Path(p).resolve() for p in save_paths))
+        
+        from ..analysis.traces import process_data
         
         c_list = [r['C'] for r in results]
         c_all = np.concatenate(c_list, axis=0)
-        out = {
-            'raw_traces': c_all.tolist(),
-            'trial_lengths': self.lengths,
-            'trialtimes': self.trialtimes_success
-        }
         
         # first save the raw data in case it fails (concatentated)
         # added a try-except block here so the server will eventually quit if it fails
         try:
-            fname = save_path/'raw_data.json'
-            with open(fname, 'w') as f:
-                json.dump(out, f)
+            # frames skipped by degraded workers are NaN, save as null
+            raw = dump_json({
+                'raw_traces': _jsonable(c_all),
+                'trial_lengths': self.lengths,
+                'trialtimes': self.trialtimes_success
+            })
+            raw_futures = []
+            for path in save_paths:
+                raw_futures.append(self.writer.submit(str(path/'raw_data.json'), write_bytes, path/'raw_data.json', raw))
+                raw_futures.append(self.writer.submit(str(path/'traces.npy'), save_npy, path/'traces.npy', c_all))
             
-            # do proccessing and save trialwise json
+            # do proccessing and save trialwise json (while the raw data is written)
             # ! fix this, traces is actually getting psths and this is confusing AF
             # for now, take the first stim time only bc alignment can't handle variable stim times yet
             # stim_times = self.stim_log.get(self.stim_times_key)[0] # will return None and not do alignment if no stim times
-            _, traces = process_data(**out, normalizer='zscore', fr=self.fr, stim_times=None)
-            out = {
-                'traces': traces.tolist(),
-            }
-            fname = save_path/'traces_data.json'
-            with open(fname, 'w') as f:
-                json.dump(out, f)
-                
-            # save it as a npy also
-            fname = save_path/'traces.npy'
-            np.save(fname, c_all)
-            fname = save_path/'psths.npy'
-            np.save(fname, traces)
+            _, traces, psth_lengths = process_data(c_all, self.lengths, normalizer='zscore', fr=self.fr,
+                                                   stim_times=None, return_lengths=True)
+            self.writer.wait(raw_futures)
             
-            # save as matlab
-            fname = save_path/'data.mat'
+            # short trials are NaN padded, save NaN as null (NaN in MATLAB jsondecode)
+            # psth_lengths are the frames of each trial in the PSTHs, the rest is padding
+            traces_json = dump_json({
+                'traces': _jsonable(traces),
+                'trial_lengths': self.lengths,
+                'psth_lengths': psth_lengths.tolist(),
+            })
             mat = {
                 'onlineTraces': c_all,
                 'onlinePSTHs': traces,
                 'onlineTrialLengths': self.lengths,
+                'onlinePSTHLengths': psth_lengths,
                 # 'onlineStimCond': self.stim_log.get(self.stim_cond_key),
                 # 'onlineStimTimes': self.stim_log.get(self.stim_times_key),
                 # 'onlineVisCond': self.stim_log.get(self.vis_cond_key)
             }
-            sio.savemat(str(fname), mat)
+            futures = list(raw_futures)
+            for path in save_paths:
+                futures.append(self.writer.submit(str(path/'traces_data.json'), write_bytes, path/'traces_data.json', traces_json))
+                # save it as a npy also
+                futures.append(self.writer.submit(str(path/'psths.npy'), save_npy, path/'psths.npy', traces))
+                # save as matlab
+                futures.append(self.writer.submit(str(path/'data.mat'), save_mat, path/'data.mat', mat))
+            
+            if not self.writer.wait(futures):
+                Alert('Something with data saving has failed. Check printed error message.', 'error')
             
         except Exception:
             Alert('Something with data saving has failed. Check printed error message.', 'error')
             logger.exception('Saving data failed Check printed error message.')
- 
\ No newline at end of file
+ 
+
+
+def _jsonable(value):
+    """Arrays to lists with NaN as None (null)."""
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == 'f':
+            return np.where(np.isnan(value), None, value).tolist()
+        return value.tolist()
+    return value
@@ -1,5 +1,8 @@
+import copy
 import logging
 import os
+import queue
+from concurrent.futures import ProcessPoolExecutor
 import warnings
 import json
 from pathlib import Path
@@ -13,9 +16,23 @@ with warnings.catch_warnings():
     import caiman as cm
     from caiman.source_extraction.cnmf.online_cnmf import OnACID
     from caiman.source_extraction.cnmf.params import CNMFParams
+    from caiman.motion_correction import apply_shift_iteration
 
+from .binning import TemporalBinner, bin_ain, bin_frame, bin_movie, upsample_traces
+from .degrade import TIERS, DegradePolicy
+from .motion import RigidRegistration
+from .refit import RefitBuffer, refit_model, swap_footprints
+from .resources import n_worker_cores, pin_process, pinned
+from .seeds import build_seed
+from .snapshot import RunningMeanImage, SnapshotBuffer
+from .moviewriter import MovieWriter, open_store
+from .tiffindex import index_tiff
+from .tiling import TiledPlane
+from .tracestore import TraceWindow
 from .utils import format_json, make_ain, tic, toc, tiffs2array, tictoc
 from .analysis.spatial import find_com
+from .analysis.traces import PSTHAccumulator, RunningQuantile
+from .analysis.tuning import RunningTuning
 
 logger = logging.getLogger('live2p')
 
@@ -56,6 +73,9 @@ class Worker:
         self.dview = None
         self.n_processes = None
         
+        # cores the cluster leaves free for MATLAB, subclasses set it from their kwargs
+        self.reserve_cores = 2
+        
     @property
     def params(self):
         return self._params
@@ -76,7 +96,7 @@ class Worker:
     def _start_cluster(self, **kwargs):
         # get default values if not specified in kwargs
         kwargs.setdefault('backend', 'local')
-        kwargs.setdefault('n_processes', os.cpu_count()-2) # make room for matlab
+        kwargs.setdefault('n_processes', n_worker_cores(reserve=self.reserve_cores)) # make room for matlab
         kwargs.setdefault('single_thread', False)
         
         for key, value in kwargs.items():
@@ -133,17 +153,23 @@ class Worker:
         crap = []
         lengths = []
         
-        for tiff in self.files:
-            with ScanImageTiffReader(str(tiff)) as reader:
-                data = reader.data()
-                if data.shape[0] < bad_tiff_size:
-                    # remove them from the list of tiffs
-                    self.files.remove(tiff)
-                    # add them to the bad tiff list for removal from HD
-                    crap.append(tiff)
-                else:
-                    # otherwise we append the length of tiff to the lengths list
-                    lengths.append(data.shape[0])             
+        for tiff in list(self.files):
+            # get the number of pages from the header only
+            idx = index_tiff(tiff)
+            if idx is not None:
+                nframes = len(idx)
+                idx.close()
+            else:
+                with ScanImageTiffReader(str(tiff)) as reader:
+                    nframes = reader.shape()[0]
+            if nframes < bad_tiff_size:
+                # remove them from the list of tiffs
+                self.files.remove(tiff)
+                # add them to the bad tiff list for removal from HD
+                crap.append(tiff)
+            else:
+                # otherwise we append the length of tiff to the lengths list
+                lengths.append(nframes)             
         for crap_tiff in crap:
             os.remove(crap_tiff)
             
@@ -184,9 +210,23 @@ class RealTimeQueue(Worker):
         self.xslice = kwargs.get('xslice', slice(0, 512))
         self.yslice = kwargs.get('yslice', slice(0, 512))
 
+        # binning, spatial_bin x spatial_bin pixels and temporal_bin frames are averaged before
+        # processing, traces are put back on the acquisition timebase in the results
+        self.spatial_bin = kwargs.get('spatial_bin', 1)
+        self.temporal_bin = kwargs.get('temporal_bin', 1)
+        self.binner = TemporalBinner(self.temporal_bin)
+        self.bin_sizes = []
+        self.raw_frame_count = 0
+        self._binned_raw = 0
+        self._frame_raw = 0 # raw_frame_count of the frame being fit
+        self._trial_raw = 0
+
         # look for Ain
         if isinstance(Ain_path, str):
             self.Ain = make_ain(Ain_path, plane, self.xslice.start, self.xslice.stop)
+            if self.spatial_bin > 1:
+                width = self.xslice.stop - self.xslice.start
+                self.Ain = bin_ain(self.Ain, (self.Ain.shape[0] // width, width), self.spatial_bin)
         else:
             self.Ain = None
         
@@ -195,6 +235,142 @@ class RealTimeQueue(Worker):
         self.update_freq = 500
         self.use_prev_init = kwargs.get('use_prev_init', False)
         
+        # seed options, if seed_strategy is None all frames in files are used
+        self.seed_strategy = kwargs.get('seed_strategy', None)
+        self.n_init = kwargs.get('n_init', 500)
+        
+        # live dF/F, F0 is a running quantile of noisyC over the last dff_window frames
+        self.live_dff = kwargs.get('live_dff', True)
+        self.dff_window = kwargs.get('dff_window', 200)
+        self.dff_quantile = kwargs.get('dff_quantile', 0.2)
+        self.f0 = None
+        self.dff = None
+        
+        # trial averaged responses, updated at each TRIAL END with the condition from stim_log
+        # stim_log is shared with (and filled in by) the server from LOG events
+        self.stim_log = kwargs.get('stim_log', None)
+        self.psth_key = kwargs.get('psth_key', 'vis_id')
+        self.psths = PSTHAccumulator()
+        self._trial_t = None
+        self._pending_trials = []
+        
+        # live tuning from the same trials, window is (base start, base stop, resp start, resp stop)
+        # in frames from the trial start, None turns it off
+        # vis_id is a condition number, not an angle. vis_oris maps it to the orientation in degrees
+        # (the blank to -45), without it there's only per-condition curves and responsiveness
+        self.tuning_window = kwargs.get('tuning_window', None)
+        self.vis_oris = kwargs.get('vis_oris', None)
+        self.tuning = None
+        if self.tuning_window is not None:
+            self.tuning = RunningTuning(self.tuning_window, p=kwargs.get('tuning_p', 0.05),
+                                        test=kwargs.get('tuning_test', 'anova'),
+                                        oris=self.vis_oris is not None)
+        
+        # background re-fit, every refit_every frames a seeded CNMF is run on the last refit_frames
+        # motion corrected frames in another process and swapped in when done, None turns it off
+        self.refit_every = kwargs.get('refit_every', None)
+        self.refit_frames = kwargs.get('refit_frames', 1000)
+        self.refits = []
+        self._refit_buffer = None
+        self._refit_pool = None
+        self._refit_future = None
+        self._refit_start = None
+        
+        # adaptive degradation, steps down through cheaper processing tiers when the queue backs up
+        self.degrade = None
+        self.skipped_frames = []
+        self.degrade_skip = kwargs.get('degrade_skip', 2)
+        self.degrade_mc_every = kwargs.get('degrade_mc_every', 2)
+        self._deconv_p = None
+        if kwargs.get('degrade', False):
+            fr = self.params.get('data', 'fr')
+            self.degrade = DegradePolicy(tiers=kwargs.get('degrade_tiers', TIERS),
+                                         backlog_high=kwargs.get('degrade_backlog_high', 50),
+                                         backlog_low=kwargs.get('degrade_backlog_low', 5),
+                                         frame_budget=1/fr if fr else None,
+                                         cooldown=kwargs.get('degrade_cooldown', 100),
+                                         plane=self.plane)
+        
+        # batched motion correction, when mc_batch_backlog or more frames are queued up (eg. a whole
+        # trial after ACQDONE) up to mc_batch frames are registered at once with batched FFTs against
+        # the same template mc_next would use. None registers every frame with mc_next.
+        # mc_batch_workers threads split the FFTs of a batch
+        self.mc_batch = kwargs.get('mc_batch', None)
+        self.mc_batch_backlog = kwargs.get('mc_batch_backlog', 20)
+        self.mc_batch_workers = kwargs.get('mc_batch_workers', None)
+        self.mc_batches = []
+        self._batch_reg = None
+        self._held = None
+        
+        # cross-plane motion sharing, motion_share (a MotionShare shared by all the planes) has the
+        # shifts of its reference plane and the other planes only apply them. Every share_check_every
+        # frames they estimate their own too and flag it if they differ by more than share_max_divergence px
+        self.motion_share = kwargs.get('motion_share', None)
+        self.share_check_every = kwargs.get('share_check_every', 100)
+        self.share_max_divergence = kwargs.get('share_max_divergence', 1.5)
+        if self.motion_share is not None and self.params.get('motion', 'pw_rigid'):
+            logger.warning(f'Motion sharing is rigid only, turning it off for pw_rigid. (Queue {self.plane})')
+            self.motion_share = None
+        self._share_stats = {'shared': 0, 'own': 0, 'est_time': 0.0, 'apply_time': 0.0, 'checks': []}
+        
+        # bounded trace memory, OnACID only holds trace_window frames of traces (after the init batch)
+        # and older frames are spilled to disk, so there's no frame cap. None preallocates num_frames_max
+        self.trace_window = kwargs.get('trace_window', None)
+        self.traces = None
+        
+        # live snapshots for SNAPSHOT queries, every snapshot_every frames the last snapshot_frames frames
+        # of C/noisyC, the shifts, and a running mean of the registered frames (downsampled by
+        # snapshot_ds) are copied into a new snapshot. None turns it off
+        self.snapshot_every = kwargs.get('snapshot_every', None)
+        self.snapshot_frames = kwargs.get('snapshot_frames', 300)
+        self.snapshot = SnapshotBuffer()
+        self.mean_img = RunningMeanImage(ds=kwargs.get('snapshot_ds', 4)) if self.snapshot_every else None
+        
+        # stream the registered frames to out/registered_plane_{plane}.h5 (or .zarr), save_movie is
+        # True (h5 if h5py is installed, otherwise zarr), 'h5' or 'zarr'. The writer keeps up to
+        # movie_buffer frames waiting and decimates the movie if it falls behind
+        self.save_movie = kwargs.get('save_movie', False)
+        self.movie_chunk = kwargs.get('movie_chunk', 100)
+        self.movie_buffer = kwargs.get('movie_buffer', 300)
+        self.movie = None
+        
+        # background ResultWriter (from the server), the OnACID hdf5 is written in it at STOP instead
+        # of holding up the results
+        self.writer = kwargs.get('writer', None)
+        
+        # cores the processing loop and its helper processes are pinned to (None doesn't pin),
+        # usually from a ResourceLayout
+        self.cores = kwargs.get('cores', None)
+        self.reserve_cores = kwargs.get('reserve_cores', 2)
+        
+        # tiled mode, the plane is split into tiles x (rows, cols) overlapping tiles that are each fit
+        # by their own OnACID in a separate process, None runs the plane as one
+        self.tiles = kwargs.get('tiles', None)
+        self.tile_overlap = kwargs.get('tile_overlap', 32)
+        self.tile_merge_thr = kwargs.get('tile_merge_thr', 0.7)
+        self.tile_backlog = kwargs.get('tile_backlog', 500)
+        self.tiled = None
+        if self.tiles is not None:
+            off = [name for name, on in [('live_dff', self.live_dff), ('tuning', self.tuning is not None),
+                                         ('refit', self.refit_every), ('degrade', self.degrade is not None),
+                                         ('motion_share', self.motion_share is not None),
+                                         ('snapshot', self.snapshot_every),
+                                         ('save_movie', self.save_movie)] if on]
+            if off:
+                logger.warning(f'{off} not supported with tiles, turning them off. (Queue {self.plane})')
+            self.live_dff = False
+            self.tuning = None
+            self.refit_every = None
+            self.degrade = None
+            self.motion_share = None
+            self.snapshot_every = None
+            self.mean_img = None
+            self.save_movie = False
+        
+        # trials are only folded into psths/tuning on this thread, the server reads copies
+        self._trial_stats = SnapshotBuffer()
+        self._publish_trial_stats()
+        
         # setup initial parameters
         self.t = 0 # current frame is on
         self.live_frame_count = 0
@@ -229,25 +405,27 @@ class RealTimeQueue(Worker):
         # check for the fname so it's organized by plane
         if self.init_path.exists() and self.use_prev_init:
             self.acid = self._initialize_from_file()
+        elif self.tiles is not None:
+            logger.info(f'Starting tiled OnACID initialization for live2p.')
+            self.tiled = self._initialize_tiled()
         # or do the init        
         else:
             logger.info(f'Starting new OnACID initialization for live2p.')
             init_mmap = self.make_init_mmap()
             self.acid = self._initialize_new(init_mmap)
+            
+        if self.trace_window and self.acid is not None:
+            mbs = self.acid.params.get('online', 'minibatch_shape') or 100
+            # from frame 0 so the saved OnACID model has the whole session
+            self.traces = TraceWindow(self.acid.estimates, self.temp_path, 0,
+                                      keep=2 * max(mbs, 51), tag=f'_plane{self.plane}')
+            
+        if self.live_dff:
+            self._init_dff()
         
     def make_init_mmap(self):
         logger.debug('Making init memmap...')
-        self.init_dir.mkdir(exist_ok=True, parents=True)
-        self._validate_tiffs()
-        mov = tiffs2array(movie_list=self.files, 
-                          x_slice=self.xslice, 
-                          y_slice=self.yslice,
-                          t_slice=self.tslice)
-        
-        self.frame_start = mov.shape[0] + 1
-        self.t = mov.shape[0] + 1
-        
-        self.params.change_params(dict(init_batch=mov.shape[0]))
+        mov = self._load_init_movie()
         m = cm.movie(mov.astype('float32'))
         
         save_path = f'initplane{self.plane}.mmap'
@@ -258,6 +436,48 @@ class RealTimeQueue(Worker):
         
         return init_mmap
     
+    def _load_init_movie(self):
+        """Load the (cropped, binned) init movie and set the frame counters and init_batch to match."""
+        self.init_dir.mkdir(exist_ok=True, parents=True)
+        self._validate_tiffs()
+        if self.seed_strategy is None:
+            mov = tiffs2array(movie_list=self.files, 
+                              x_slice=self.xslice, 
+                              y_slice=self.yslice,
+                              t_slice=self.tslice)
+        else:
+            # sample frames across the tiffs, only reading the pages needed
+            mov = build_seed(self.files, self.plane, self.nchannels, self.nplanes,
+                             n_init=self.n_init,
+                             strategy=self.seed_strategy,
+                             x_slice=self.xslice,
+                             y_slice=self.yslice)
+        
+        if self.spatial_bin > 1 or self.temporal_bin > 1:
+            mov = bin_movie(mov, self.spatial_bin, self.temporal_bin)
+            self._bin_params()
+        
+        self.frame_start = mov.shape[0] + 1
+        self.t = mov.shape[0] + 1
+        
+        self.params.change_params(dict(init_batch=mov.shape[0]))
+        
+        return mov
+    
+    def _bin_params(self):
+        """Scale the pixel and frame based params to the binned data."""
+        gSig = self.params.get('init', 'gSig')
+        fr = self.params.get('data', 'fr')
+        max_shift = self.params.get('online', 'max_shifts_online')
+        changes = dict(gSig=[max(1, g // self.spatial_bin) for g in gSig])
+        if fr:
+            changes['fr'] = fr / self.temporal_bin
+        if max_shift:
+            changes['max_shifts_online'] = max(1, int(max_shift // self.spatial_bin))
+        self.params.change_params(changes)
+        logger.info(f'Binning {self.spatial_bin}x{self.spatial_bin} pixels and {self.temporal_bin} '
+                    f'frames. Params changed to {changes}. (Queue {self.plane})')
+    
     @tictoc
     def _initialize_new(self, fname_init):
         """
@@ -278,8 +498,12 @@ class RealTimeQueue(Worker):
         acid = OnACID(dview=None, params=self.params)
         acid.estimates.A = self.Ain
         
-        # do initialization
-        acid.initialize_online(T=self.num_frames_max)
+        # do initialization, with a trace window only the window is allocated after the init batch
+        if self.trace_window:
+            T = self.params.get('online', 'init_batch') + self.trace_window
+        else:
+            T = self.num_frames_max
+        acid.initialize_online(T=T)
         
         # save for next time to init path
         # need to update acid object for loading from init
@@ -289,6 +513,15 @@ class RealTimeQueue(Worker):
         
         return acid
     
+    @tictoc
+    def _initialize_tiled(self):
+        """Start the tile processes for tiled mode and initialize each tile's OnACID."""
+        mov = self._load_init_movie()
+        return TiledPlane(mov, self.params, self.tiles, overlap=self.tile_overlap, Ain=self.Ain,
+                          num_frames_max=self.num_frames_max, temp_path=self.temp_path,
+                          plane=self.plane, merge_thr=self.tile_merge_thr, cpus=self.cores,
+                          max_backlog=self.tile_backlog)
+    
     @tictoc
     def _initialize_from_file(self):
         """
@@ -331,51 +564,53 @@ class RealTimeQueue(Worker):
     def process_frame_from_queue(self):
         """
         The main loop. Pulls data from the queue and processes it, fitting data to the model. Stops
-        upon recieving a 'STOP' string.
+        upon recieving a 'STOP' string. Runs pinned to self.cores if set.
 
         Returns:
             json representation of the OnACID model
         """
+        with pinned(self.cores):
+            return self._process_queue()
         
+    def _process_queue(self):
         frame_time = []
         while True:
-            frame = self.q.get()
+            # a message that ended a batch goes first
+            if self._held is not None:
+                frame, self._held = self._held, None
+            else:
+                frame = self.q.get()
             
             ###-----FRAME DATA-----###
             if isinstance(frame, np.ndarray):
-                
-                t = tic()
-                
-                frame_ = frame[self.yslice, self.xslice].copy().astype(np.float32)
-                frame_cor = self.acid.mc_next(self.t, frame_)
-                self.acid.fit_next(self.t, frame_cor.ravel(order='F'))
-                
-                # update counters
-                self.t += 1
-                self.live_frame_count += 1
-                
-                frame_time.append(toc(t))
-                
-                if self.t % self.update_freq == 0:
-                    logger.info(f'Total of {self.t} frames processed. (Queue {self.plane})')
-                    # calculate average time to process
-                    mean_time = np.mean(frame_time) * 1000 # in ms
-                    mean_hz = round(1/np.mean(frame_time),2)
-                    logger.info(f'Average processing time: {int(mean_time)} ms. ({mean_hz} Hz) (Queue {self.plane})')
+                if self.mc_batch and self.q.qsize() >= self.mc_batch_backlog:
+                    self._process_batch(frame, frame_time)
+                    continue
+                frame_ = self._ingest(frame)
+                if frame_ is not None:
+                    self._process_frame(frame_, frame_time)
             
             ###-----STOP PROCESSING-----###
             elif isinstance(frame, str):
+                if frame in ('TRIAL START', 'TRIAL END', 'STOP'):
+                    # temporal bins don't cross trials
+                    self._flush_bin(frame_time)
+                
                 if frame == 'TRIAL START':
                     # will reflect the actual start frame of a trial
                     # add one as it has not been incr. yet
                     self.trial_starts.append(self.t + 1) 
+                    self._trial_t = self.t
+                    self._trial_raw = self.raw_frame_count
                 
                 elif frame == 'TRIAL END':
                     # will reflect the last frame + 1 of a trial (eg. for exclusive slicing)
                     # add one as it has not been incr. yet
                     self.trial_ends.append(self.t + 1)
-                    trial_length = self.trial_ends[-1] - self.trial_starts[-1]
+                    # in acquired frames, same as trial_ends - trial_starts without temporal binning
+                    trial_length = self.raw_frame_count - self._trial_raw
                     self.trial_lengths.append(trial_length)
+                    self._end_trial()
                     
                 elif frame == 'STOP':                 
                     logger.info('Stopping live2p....')
@@ -385,10 +620,30 @@ class RealTimeQueue(Worker):
                     logger.info('Getting final results...')
 
                     self.update_acid()
+                    self._stop_refit()
+                    if self._is_motion_ref:
+                        self.motion_share.close()
+                    elif self._applies_shared_motion:
+                        share = self.get_motion_share()
+                        if share['saved_s'] is not None:
+                            logger.info(f"Shared motion used on {share['shared_frames']} frames, saved "
+                                        f"{share['saved_ms_per_frame']:.1f} ms per frame ({share['saved_s']:.1f} s). "
+                                        f"{share['diverged']} of {len(share['checks'])} checks diverged. (Queue {self.plane})")
+                    
+                    # the rest of the registered movie, at most movie_buffer frames
+                    if self.movie is not None:
+                        self.movie.close()
                     
                     # save
                     try:
-                        self.save_acid()
+                        if self.tiled is not None:
+                            self.tiled.stop()
+                        elif self.writer is not None:
+                            # nothing changes the model after STOP, so it's saved while the results are made
+                            self.writer.submit(f'plane {self.plane} OnACID hdf5', self.save_acid,
+                                               self._acid_for_saving())
+                        else:
+                            self.save_acid(self._acid_for_saving())
                     except Exception:
                         # need to catch exception here because we want to complete the future and
                         # process the final data
@@ -396,6 +651,8 @@ class RealTimeQueue(Worker):
                         
                     # self.save_json()
                     data = self._model2dict()
+                    if self.traces is not None:
+                        self.traces.close()
 
                     break 
                 
@@ -405,26 +662,551 @@ class RealTimeQueue(Worker):
                  
         return data
                 
+    def _end_trial(self):
+        """Hold on to the finished trial and fold in every trial that has a logged condition."""
+        if self._trial_t is None or self.acid is None:
+            return
+        nb = self.acid.params.get('init', 'nb')
+        trial = np.array(self._read_traces('C_on', slice(nb, self.acid.M), self._trial_t, self.t))
+        trial = self._nan_skipped(trial, self._trial_t)
+        self._pending_trials.append((len(self.trial_lengths) - 1, trial))
+        self._trial_t = None
+        self._fold_pending_trials()
+        
+    def _fold_pending_trials(self):
+        # LOG events can arrive after the trial ends, so trials wait here until they have a condition.
+        # only called from the processing loop
+        if self.stim_log is None or not self._pending_trials:
+            return
+        conds = self.stim_log.get(self.psth_key, [])
+        waiting = []
+        for trial_idx, trial in self._pending_trials:
+            if trial_idx < len(conds):
+                self.psths.add(trial, conds[trial_idx])
+                if self.tuning is not None:
+                    self._add_tuning_trial(trial, conds[trial_idx])
+            else:
+                waiting.append((trial_idx, trial))
+        if len(waiting) < len(self._pending_trials):
+            self._pending_trials = waiting
+            self._publish_trial_stats()
+            
+    def _add_tuning_trial(self, trial, cond):
+        if self.vis_oris is None:
+            self.tuning.add(trial, cond)
+        elif cond in self.vis_oris:
+            self.tuning.add(trial, self.vis_oris[cond])
+        else:
+            logger.warning(f'{self.psth_key} {cond} is not in vis_oris, trial left out of the tuning. (Queue {self.plane})')
+            
+    def _publish_trial_stats(self):
+        # CoMs for the tuning summary are found here too, Ab changes in fit_next
+        coms = None
+        if self.tuning is not None and self.tuning.n_trials > 0:
+            nb = self.acid.params.get('init', 'nb')
+            coms = find_com(self.acid.estimates.Ab[:, nb:self.acid.M], self.acid.estimates.dims,
+                            self.xslice.start, bin_factor=self.spatial_bin)
+        self._trial_stats.publish({'psths': copy.deepcopy(self.psths), 'tuning': copy.deepcopy(self.tuning),
+                                   'coms': coms})
+        
+    def get_psths(self):
+        """
+        Returns the trial averaged responses so far as a dict with 'conditions', 'mean' and 'sem'
+        (conds x cells x frames), and the number of trials per condition. Reads the copy the
+        processing loop publishes, so it's safe to call from other threads.
+        """
+        psths = self._trial_stats.get()['psths']
+        conds = psths.conditions
+        return {
+            'conditions': conds,
+            'mean': psths.mean(),
+            'sem': psths.sem(),
+            'n_trials': [psths.n_trials[c] for c in conds],
+        }
+        
+    def _ingest(self, frame):
+        """Crop and bin a frame. Returns None while a temporal bin is filling up."""
+        self.raw_frame_count += 1
+        frame_ = frame[self.yslice, self.xslice].astype(np.float32)
+        if self.spatial_bin > 1:
+            frame_ = bin_frame(frame_, self.spatial_bin)
+        return self.binner.add(frame_)
+    
+    def _flush_bin(self, frame_time):
+        """Process a partially filled temporal bin."""
+        frame_ = self.binner.flush()
+        if frame_ is not None:
+            self._process_frame(frame_, frame_time)
+            
+    def _process_batch(self, frame, frame_time):
+        """
+        Pull up to mc_batch frames off the queue (stopping at the first message), register them
+        together and fit them one by one.
+        """
+        frames_ = []
+        raw_counts = [] # acquired frame count of each (binned) frame, _ingest runs ahead of the fits
+        while True:
+            frame_ = self._ingest(frame)
+            if frame_ is not None:
+                frames_.append(frame_)
+                raw_counts.append(self.raw_frame_count)
+            if len(frames_) >= self.mc_batch:
+                break
+            try:
+                frame = self.q.get_nowait()
+            except queue.Empty:
+                break
+            if not isinstance(frame, np.ndarray):
+                self._held = frame
+                break
+        if not frames_:
+            return
+        
+        t = tic()
+        frames_cor, shifts = self._register_batch(frames_)
+        reg_time = toc(t)
+        if frames_cor is None:
+            frames_cor = shifts = [None] * len(frames_)
+        else:
+            self.mc_batches.append({'t': int(self.t), 'nframes': len(frames_), 'time': reg_time})
+        
+        for frame_, frame_cor, shift, raw_count in zip(frames_, frames_cor, shifts, raw_counts):
+            self._process_frame(frame_, frame_time, frame_cor, shift, raw_count)
+    
+    def _register_batch(self, frames_):
+        """
+        Rigid registration of a block of frames with batched FFTs. The template is built from the
+        model the same way mc_next does it. Returns the registered frames and their shifts, or Nones
+        if mc_next has to be used (pw_rigid).
+        """
+        frames_ = np.stack(frames_)
+        if self.tiled is not None:
+            return self.tiled.registration.register_batch(frames_)
+        if self.acid.params.get('motion', 'pw_rigid') or self._applies_shared_motion:
+            return None, None
+        
+        est = self.acid.estimates
+        templ = est.Ab.dot(np.median(est.C_on[:self.acid.M, max(self.t - 51, 0):self.t - 1], axis=1))
+        templ = templ.reshape(est.dims, order='F')
+        if self.acid.params.get('online', 'normalize') and getattr(self.acid, 'img_norm', None) is not None:
+            templ = templ * self.acid.img_norm
+        
+        if self._batch_reg is None:
+            max_shift = self.acid.params.get('online', 'max_shifts_online') or 10
+            self._batch_reg = RigidRegistration(templ, max_shift=max_shift, update_every=0,
+                                                workers=self.mc_batch_workers)
+        else:
+            self._batch_reg.set_template(templ)
+        frames_cor, shifts = self._batch_reg.register_batch(frames_)
+        # the model keeps the shifts (see _process_frame)
+        self._batch_reg.shifts.clear()
+        return frames_cor, shifts
+    
+    def _process_frame(self, frame_, frame_time, frame_cor=None, shift=None, raw_count=None):
+        """
+        Motion correct and fit one (cropped, binned) frame. Frames registered in a batch come with
+        their frame_cor and shift, and the acquired frame count at the end of the frame (raw_count,
+        self.raw_frame_count is already past the batch).
+        """
+        t = tic()
+        self._frame_raw = self.raw_frame_count if raw_count is None else raw_count
+        
+        if self.temporal_bin > 1:
+            # number of acquired frames in this bin
+            self.bin_sizes.append(self._frame_raw - self._binned_raw)
+            self._binned_raw = self._frame_raw
+        
+        if self.tiled is not None:
+            self.tiled.fit(frame_ if frame_cor is None else frame_cor, registered=frame_cor is not None)
+        elif self.degrade is not None and self._skip_frame():
+            self._fill_skipped()
+            if self._is_motion_ref:
+                self.motion_share.publish(self._frame_raw, None)
+        else:
+            if frame_cor is None:
+                frame_cor = self._motion_correct(frame_)
+            else:
+                self.acid.estimates.shifts.append(list(shift))
+            if self._is_motion_ref:
+                self.motion_share.publish(self._frame_raw, self.acid.estimates.shifts[-1])
+            self.acid.fit_next(self.t, frame_cor.ravel(order='F'))
+            
+            if self.live_dff:
+                self._update_dff()
+                
+            if self.refit_every:
+                self._refit(frame_cor)
+                
+            if self.mean_img is not None:
+                self.mean_img.add(frame_cor)
+                
+            if self.save_movie:
+                self._write_movie(frame_cor)
+        
+        # update counters
+        self.t += 1
+        self.live_frame_count += 1
+        if self.traces is not None and self.traces.full(self.t):
+            self.traces.spill(self.t, self.acid.M)
+        if self.snapshot_every and self.live_frame_count % self.snapshot_every == 0:
+            self._refresh_snapshot()
+        # trials whose condition was logged after they ended
+        self._fold_pending_trials()
+        
+        frame_time.append(toc(t))
+        
+        if self.degrade is not None and self.degrade.update(self.t, self.q.qsize(), frame_time[-1]):
+            self._apply_tier()
+        
+        if self.t % self.update_freq == 0:
+            logger.info(f'Total of {self.t} frames processed. (Queue {self.plane})')
+            # calculate average time to process
+            mean_time = np.mean(frame_time) * 1000 # in ms
+            mean_hz = round(1/np.mean(frame_time),2)
+            logger.info(f'Average processing time: {int(mean_time)} ms. ({mean_hz} Hz) (Queue {self.plane})')
+    
+    def _motion_correct(self, frame_):
+        """mc_next, or reuse the last rigid shift on most frames in the 'reduce_mc' tier."""
+        if self._applies_shared_motion:
+            return self._apply_shared_motion(frame_)
+        
+        reuse = (self.degrade is not None and self.degrade.active('reduce_mc')
+                 and not self.acid.params.get('motion', 'pw_rigid')
+                 and self.live_frame_count % self.degrade_mc_every != 0
+                 and len(self.acid.estimates.shifts) > 0)
+        if not reuse:
+            return self.acid.mc_next(self.t, frame_)
+        
+        shift = self.acid.estimates.shifts[-1]
+        self.acid.estimates.shifts.append(shift)
+        return apply_shift_iteration(frame_, shift)
+    
+    def _write_movie(self, frame_cor):
+        """Hand the registered frame to the movie writer (opened on the first frame). Doesn't block."""
+        if self.movie is None:
+            backend = 'auto' if self.save_movie is True else self.save_movie
+            try:
+                store = open_store(self.out_path/f'registered_plane_{self.plane}', frame_cor.shape,
+                                   frame_cor.dtype, chunk_frames=self.movie_chunk, backend=backend)
+            except Exception:
+                logger.exception(f'Failed to open the registered movie, not saving it. (Queue {self.plane})')
+                self.save_movie = False
+                return
+            self.movie = MovieWriter(store, chunk_frames=self.movie_chunk, buffer_frames=self.movie_buffer)
+        self.movie.put(frame_cor, self.t)
+    
+    def _acid_for_saving(self):
+        """OnACID with the traces of the whole session (not just the trace window) to save."""
+        if self.traces is None:
+            return self.acid
+        acid = copy.copy(self.acid)
+        acid.estimates = copy.copy(self.acid.estimates)
+        for name in self.traces.stores:
+            nrows = getattr(self.acid.estimates, name).shape[0]
+            setattr(acid.estimates, name, np.array(self.traces.read(name, slice(0, nrows), 0, self.t)))
+        return acid
+    
+    def _read_traces(self, name, rows, start, stop):
+        """Frames [start, stop) of rows of C_on or noisyC, from the trace window and disk if spilled."""
+        if self.traces is None:
+            return getattr(self.acid.estimates, name)[rows, start:stop]
+        return self.traces.read(name, rows, start, stop)
+    
+    @property
+    def _is_motion_ref(self):
+        return self.motion_share is not None and self.motion_share.ref_plane == self.plane
+    
+    @property
+    def _applies_shared_motion(self):
+        return self.motion_share is not None and self.motion_share.ref_plane != self.plane
+    
+    def _apply_shared_motion(self, frame_):
+        """
+        Apply the reference plane's shift of this frame. Falls back to mc_next when it isn't
+        available in time, and on check frames where the two are compared.
+        """
+        stats = self._share_stats
+        # frames are matched across planes by acquired frame, the same in every plane
+        frame_idx = self._frame_raw
+        check = self.share_check_every and self.live_frame_count % self.share_check_every == 0
+        shift = None if check else self.motion_share.get(frame_idx)
+        
+        if shift is None:
+            t = tic()
+            frame_cor = self.acid.mc_next(self.t, frame_)
+            stats['est_time'] += toc(t)
+            stats['own'] += 1
+            if check:
+                self._check_shared_motion(frame_idx, self.acid.estimates.shifts[-1])
+            return frame_cor
+        
+        t = tic()
+        self.acid.estimates.shifts.append(list(shift))
+        frame_cor = apply_shift_iteration(frame_, shift)
+        stats['apply_time'] += toc(t)
+        stats['shared'] += 1
+        return frame_cor
+    
+    def _check_shared_motion(self, frame_idx, own_shift):
+        shared = self.motion_share.get(frame_idx)
+        if shared is None:
+            return
+        divergence = float(np.linalg.norm(np.subtract(own_shift, shared)))
+        self._share_stats['checks'].append([int(frame_idx), divergence])
+        if divergence > self.share_max_divergence:
+            logger.warning(f'Motion of plane {self.plane} differs from reference plane {self.motion_share.ref_plane} '
+                           f'by {divergence:.1f} px at frame {frame_idx}. (Queue {self.plane})')
+    
+    def get_motion_share(self):
+        """
+        Summary of motion sharing for the results: frames that used shared or their own shifts, the
+        mean time of estimating vs applying a shift, the time saved, and the divergence checks.
+        """
+        if self.motion_share is None:
+            return {}
+        if self._is_motion_ref:
+            return {'ref_plane': self.motion_share.ref_plane, 'reference': True}
+        
+        stats = self._share_stats
+        est_ms = 1000 * stats['est_time'] / stats['own'] if stats['own'] else None
+        apply_ms = 1000 * stats['apply_time'] / stats['shared'] if stats['shared'] else None
+        saved_ms = est_ms - apply_ms if est_ms is not None and apply_ms is not None else None
+        checks = stats['checks']
+        return {
+            'ref_plane': self.motion_share.ref_plane,
+            'reference': False,
+            'shared_frames': stats['shared'],
+            'own_frames': stats['own'],
+            'est_ms': est_ms,
+            'apply_ms': apply_ms,
+            'saved_ms_per_frame': saved_ms,
+            'saved_s': saved_ms * stats['shared'] / 1000 if saved_ms is not None else None,
+            'checks': checks,
+            'diverged': sum(d > self.share_max_divergence for _, d in checks),
+        }
+    
+    def _skip_frame(self):
+        return self.degrade.active('skip') and self.live_frame_count % self.degrade_skip != 0
+    
+    def _fill_skipped(self):
+        """
+        Skip a frame. The last frame's values are carried over so fit_next starts from them on the
+        next frame, and the frame is NaN in the results (see get_model).
+        """
+        est = self.acid.estimates
+        est.C_on[:, self.t] = est.C_on[:, self.t - 1]
+        est.noisyC[:, self.t] = est.noisyC[:, self.t - 1]
+        if len(est.shifts) > 0:
+            est.shifts.append(np.full(np.shape(est.shifts[-1]), np.nan))
+        self.skipped_frames.append(self.t)
+        
+    def _skipped_acquired(self):
+        """Acquired frames (from the first frame after init) of the skipped frames, each bin is all its frames."""
+        bins = [int(t - self.frame_start) for t in self.skipped_frames]
+        if self.temporal_bin <= 1:
+            return bins
+        edges = np.concatenate([[0], np.cumsum(self.bin_sizes)])
+        return [int(f) for b in bins if b < len(self.bin_sizes) for f in range(edges[b], edges[b + 1])]
+        
+    def _apply_tier(self):
+        """Turn deconvolution on or off to match the current tier."""
+        if self.degrade.active('no_deconv'):
+            if self._deconv_p is None:
+                self._deconv_p = self.acid.params.get('preprocess', 'p')
+                self.acid.params.set('preprocess', {'p': 0})
+        elif self._deconv_p is not None:
+            self.acid.params.set('preprocess', {'p': self._deconv_p})
+            self._deconv_p = None
+        
+    def _nan_skipped(self, arr, start):
+        """NaN the columns of arr (frames from start) that were skipped. Returns a copy if any are."""
+        skipped = np.array(self.skipped_frames, dtype=int) - start
+        skipped = skipped[(skipped >= 0) & (skipped < arr.shape[-1])]
+        if skipped.size == 0:
+            return arr
+        arr = np.array(arr, dtype=float)
+        arr[..., skipped] = np.nan
+        return arr
+        
+    def _refit(self, frame_cor):
+        """Buffer the frame, swap in a finished re-fit, and start a new one when it's time."""
+        if self._refit_buffer is None:
+            self._refit_buffer = RefitBuffer(self.temp_path/f'refitbuf_plane{self.plane}.mmap',
+                                             self.refit_frames, frame_cor.shape)
+            self._refit_pool = ProcessPoolExecutor(max_workers=1, initializer=pin_process,
+                                                   initargs=(self.cores,))
+        self._refit_buffer.add(frame_cor)
+        
+        # never wait on the re-fit, just check if it's done
+        if self._refit_future is not None and self._refit_future.done():
+            future, self._refit_future = self._refit_future, None
+            try:
+                self._swap_refit(future.result())
+            except Exception:
+                logger.exception(f'Background re-fit failed. (Queue {self.plane})')
+                
+        buffered = self._refit_buffer.head
+        if (self._refit_future is None and buffered >= self.refit_frames 
+                and buffered - (self._refit_start or 0) >= self.refit_every):
+            nb = self.acid.params.get('init', 'nb')
+            Ain = self.acid.estimates.Ab[:, nb:self.acid.M].tocsc()
+            self._refit_start = buffered
+            self._refit_future = self._refit_pool.submit(refit_model, self._refit_buffer.job(), 
+                                                         Ain, self.acid.params, nb)
+            logger.info(f'Started background re-fit on the last {self.refit_frames} frames at frame {self.t}. (Queue {self.plane})')
+            
+    def _swap_refit(self, result):
+        """Swap a finished re-fit into the live model (between frames)."""
+        nb = self.acid.params.get('init', 'nb')
+        ncells = self.acid.M - nb
+        # cells are matched to the seeds by index, if the fit dropped or added any they'd all shift
+        nseeds = result['nseeds']
+        if result['A'].shape[1] != nseeds or nseeds > ncells:
+            logger.warning(f"Re-fit has {result['A'].shape[1]} cells but was seeded with {nseeds} "
+                           f"(model has {ncells}). Not swapped. (Queue {self.plane})")
+            return
+        
+        swap_time = swap_footprints(self.acid.estimates, result['A'], result['b'], nb)
+        self.refits.append({
+            't': self.t,
+            'nframes': result['nframes'],
+            'ncells': result['A'].shape[1],
+            'fit_time': result['fit_time'],
+            'swap_time': swap_time,
+        })
+        logger.info(f"Swapped in re-fit of {result['A'].shape[1]} cells at frame {self.t}. Fit took "
+                    f"{result['fit_time']:.1f}s, swap took {swap_time*1000:.1f} ms. (Queue {self.plane})")
+    
+    def _stop_refit(self):
+        if self._refit_pool is not None:
+            self._refit_pool.shutdown(wait=False, cancel_futures=True)
+            self._refit_pool = None
+        if self._refit_buffer is not None:
+            self._refit_buffer.close()
+            self._refit_buffer = None
+        
+    def _refresh_snapshot(self):
+        """Copy the recent traces, shifts and mean image into a new snapshot and publish it."""
+        nb = self.acid.params.get('init', 'nb')
+        start = max(self.t - self.snapshot_frames, self.frame_start)
+        shifts = self.acid.estimates.shifts[max(len(self.acid.estimates.shifts) - (self.t - start), 0):]
+        mean_img = self.mean_img.image
+        self.snapshot.publish({
+            'plane': int(self.plane),
+            't': int(self.t),
+            'start': int(start),
+            'C': np.array(self._read_traces('C_on', slice(nb, self.acid.M), start, self.t)),
+            'nC': np.array(self._read_traces('noisyC', slice(nb, self.acid.M), start, self.t)),
+            'shifts': np.array(shifts, dtype=float),
+            'mean_img': None if mean_img is None else mean_img.copy(),
+            'mean_img_ds': self.mean_img.ds,
+        })
+        
+    def get_snapshot(self, cells=None, frames=None):
+        """
+        The latest snapshot (see _refresh_snapshot), or None if there isn't one. Never waits on the
+        processing loop.
+
+        Args:
+            cells (list, optional): component indices to include, ones that don't exist are left
+                                    out. Defaults to None (all).
+            frames (int, optional): only the last frames of the snapshot, must be > 0. Defaults to
+                                    None (all).
+
+        Returns:
+            dict with 'plane', 't', 'start', 'C', 'nC', 'shifts', 'mean_img', 'mean_img_ds'
+        """
+        if frames is not None and frames <= 0:
+            raise ValueError(f'frames must be positive, got {frames}.')
+        snap = self.snapshot.get()
+        if snap is None:
+            return None
+        snap = dict(snap)
+        if cells is not None:
+            # no negative indices, they'd silently count from the end
+            cells = [int(c) for c in cells if 0 <= c < snap['C'].shape[0]]
+            snap['C'], snap['nC'] = snap['C'][cells], snap['nC'][cells]
+        if frames is not None and frames < snap['C'].shape[1]:
+            snap['C'], snap['nC'] = snap['C'][:, -frames:], snap['nC'][:, -frames:]
+            snap['shifts'] = snap['shifts'][-frames:]
+            snap['start'] = snap['t'] - frames
+        return snap
+        
+    def get_tuning(self, summary=True):
+        """
+        Returns the live tuning so far (None if tuning_window isn't set). If summary, a short JSON
+        friendly summary with a PO map keyed to the CoM of each cell, otherwise the per-cell results
+        (see analysis.tuning.RunningTuning). Reads the copy the processing loop publishes, so it's
+        safe to call from other threads.
+        """
+        tuning = self._trial_stats.get()['tuning']
+        if tuning is None:
+            return None
+        if not summary:
+            return tuning.results()
+        out = tuning.summary(self._trial_stats.get()['coms'])
+        out['plane'] = int(self.plane)
+        return out
+        
+    def _init_dff(self):
+        """Set up the running F0 and warm it up with the end of the init batch."""
+        nb = self.acid.params.get('init', 'nb')
+        self.f0 = RunningQuantile(self.acid.M - nb, window=self.dff_window, q=self.dff_quantile)
+        for t in range(max(self.t - 1 - self.dff_window, 0), self.t - 1):
+            self.f0.update(self.acid.estimates.noisyC[nb:self.acid.M, t])
+        
+    def _update_dff(self):
+        """Update F0 with the newest frame of noisyC and compute dF/F for every component."""
+        nb = self.acid.params.get('init', 'nb')
+        # components can be added during the session
+        self.f0.resize(self.acid.M - nb)
+        f = self.acid.estimates.noisyC[nb:self.acid.M, self.t]
+        f0 = self.f0.update(f)
+        self.dff = (f - f0) / np.maximum(np.abs(f0), np.finfo(np.float32).eps)
+        
+    def get_dff(self):
+        """Returns the latest dF/F of every component (or None if live_dff is off)."""
+        return self.dff
+                
     def update_acid(self, **kwargs):
         # ! THIS ISN'T ACTUALLY CALLED ANYWHERE AND NO KWARGS ARE PASSED
         for k,v in kwargs.items():
             setattr(self.acid.estimates, k, v)
     
     def get_model(self):
+        if self.tiled is not None:
+            return self._finish_model(self.tiled.get_model())
+        
+        nb = self.acid.params.get('init', 'nb')
         model_dict = {
             # A = spatial component (cells)
-            'A': self.acid.estimates.Ab[:, self.acid.params.get('init', 'nb'):].toarray(),
+            'A': self.acid.estimates.Ab[:, nb:].toarray(),
             # b = background components (neuropil)
-            'b': self.acid.estimates.Ab[:, :self.acid.params.get('init', 'nb')].toarray(),
+            'b': self.acid.estimates.Ab[:, :nb].toarray(),
             # C = denoised trace for cells
-            'C': self.acid.estimates.C_on[self.acid.params.get('init', 'nb'):self.acid.M, self.frame_start:self.t],
+            'C': self._read_traces('C_on', slice(nb, self.acid.M), self.frame_start, self.t),
             # f = denoised neuropil signal
-            'f': self.acid.estimates.C_on[:self.acid.params.get('init', 'nb'), self.frame_start:self.t],
+            'f': self._read_traces('C_on', slice(0, nb), self.frame_start, self.t),
             # nC a.k.a noisyC very close to the raw F trace
-            'nC': self.acid.estimates.noisyC[self.acid.params.get('init', 'nb'):self.acid.M, self.frame_start:self.t],
+            'nC': self._read_traces('noisyC', slice(nb, self.acid.M), self.frame_start, self.t),
             # frame shifts, keep as list
             'shifts': np.array(self.acid.estimates.shifts)[self.frame_start:,:]
         }
+        return self._finish_model(model_dict)
+    
+    def _finish_model(self, model_dict):
+        # frames skipped by the 'skip' degrade tier are NaN
+        if self.skipped_frames:
+            for key in ('C', 'f', 'nC'):
+                model_dict[key] = self._nan_skipped(model_dict[key], self.frame_start)
+        
+        # back on the acquisition timebase, each value is held for the frames in its bin
+        if self.temporal_bin > 1:
+            for key in ('C', 'f', 'nC'):
+                model_dict[key] = upsample_traces(model_dict[key], self.bin_sizes)
+            shifts = model_dict['shifts']
+            model_dict['shifts'] = upsample_traces(shifts, self.bin_sizes[:shifts.shape[0]], axis=0)
+        
         # YrA = signal noise, important for dff calculation
         # computed from nC and C so do add to dict
         YrA = model_dict['nC'] - model_dict['C']
@@ -436,8 +1218,8 @@ class RealTimeQueue(Worker):
         model = self.get_model()
         model = format_json(**model)
         
-        coords = find_com(model['A'], self.acid.estimates.dims, self.xslice.start)
-        dims = self.acid.estimates.dims
+        dims = self.tiled.dims if self.tiled is not None else self.acid.estimates.dims
+        coords = find_com(model['A'], dims, self.xslice.start, bin_factor=self.spatial_bin)
         
         data = {
             'plane': int(self.plane),
@@ -445,6 +1227,17 @@ class RealTimeQueue(Worker):
             'CoM':coords.tolist(),
             'dims':dims,
             'trial_lengths': self.trial_lengths,
+            'refits': self.refits,
+            'degrade_log': self.degrade.transitions if self.degrade is not None else [],
+            # skipped frames on the acquisition timebase (like the traces) and as binned frames
+            'skipped_frames': self._skipped_acquired(),
+            'skipped_bins': [int(t - self.frame_start) for t in self.skipped_frames],
+            'spatial_bin': self.spatial_bin,
+            'temporal_bin': self.temporal_bin,
+            'tiles': self.tiled.tile_log if self.tiled is not None else [],
+            'mc_batches': self.mc_batches,
+            'motion_share': self.get_motion_share(),
+            'movie': self.movie.summary() if self.movie is not None else None,
         }
         
         data.update(model)
@@ -0,0 +1,96 @@
+"""
+Writes the results at the end of a session in the background. Artifacts (each file in each
+destination) are written by a pool of threads and timed, so saving several formats to several
+folders takes about as long as the slowest file instead of all of them one after another.
+"""
+
+import concurrent.futures
+import json
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger('live2p')
+
+
+class ResultWriter:
+    """Thread pool for writing result files, keeps how long each artifact took."""
+
+    def __init__(self, max_workers=4):
+        """
+        Args:
+            max_workers (int, optional): number of files written at the same time. Defaults to 4.
+        """
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                          thread_name_prefix='live2p-writer')
+        self.timings = {} # artifact name -> seconds
+        self.errors = {} # artifact name -> exception
+        self._futures = []
+
+    def submit(self, name, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) in the pool as the artifact name.
+
+        Returns:
+            concurrent.futures.Future
+        """
+        future = self.pool.submit(self._timed, name, fn, *args, **kwargs)
+        self._futures.append(future)
+        return future
+
+    def _timed(self, name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            logger.exception(f'Failed to write {name}.')
+            self.errors[name] = e
+            raise
+        finally:
+            self.timings[name] = time.perf_counter() - start
+
+    def wait(self, futures=None, timeout=None):
+        """
+        Wait for futures (from submit), or everything submitted so far.
+
+        Returns:
+            True if they all finished without errors
+        """
+        if futures is None:
+            futures = self._futures
+        done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+        self._futures = [f for f in self._futures if f not in done]
+        if not_done:
+            logger.warning(f'{len(not_done)} result writers timed out.')
+        return not not_done and all(f.exception() is None for f in done)
+
+    def report(self):
+        """Per artifact timings (slowest first) as a printable table."""
+        lines = [f'Wrote {len(self.timings)} artifacts:']
+        for name, t in sorted(self.timings.items(), key=lambda item: -item[1]):
+            status = ' (failed)' if name in self.errors else ''
+            lines.append(f'  {name}: {t*1000:.0f} ms{status}')
+        return '\n'.join(lines)
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown(wait=True)
+
+
+def write_bytes(path, data):
+    """Write already serialized data (eg. a json string encoded once for all destinations)."""
+    Path(path).write_bytes(data)
+
+def save_npy(path, array):
+    np.save(path, array)
+
+def save_mat(path, mdict):
+    # scipy.io is slow to import and only needed at the end
+    import scipy.io as sio
+    sio.savemat(str(path), mdict)
+
+def dump_json(obj):
+    """Serialize once to bytes, to be written to each destination with write_bytes."""
+    return json.dumps(obj).encode()
@@ -28,6 +28,10 @@ y_end = 512
 # 4 hours is ~100k frames
 max_frames = 128000
 
+# bounded trace memory, only trace_window frames of traces are kept in RAM and older frames are
+# spilled to disk (no frame cap, max_frames is ignored). None preallocates max_frames.
+trace_window = None
+
 # sensor tau off
 sensor_tau = 1.0 # float, in seconds
 
@@ -52,6 +56,84 @@ patch_motion_xy = (100., 100.) # patch size for non-rigid correction in um
 background = 3 # number of background components (default, 2 or 3).
 # a bigger number here decreases the background but too much can reduce the signal
 
+# how tiffs get added to the processing queue
+# 'acqdone' adds a tiff when MATLAB sends ACQDONE
+# 'watch' polls the epoch folder and adds each tiff once ScanImage is done writing it
+# 'tail' adds each frame as soon as ScanImage writes it (lowest latency)
+ingest_mode = 'acqdone'
+
+# how to build the seed (init) movie
+# None uses every frame of the seed tiffs picked in the popup GUI
+# 'even', 'first', or 'variance' samples n_init frames from the tiffs in the epoch folder (no GUI)
+seed_strategy = None
+n_init = 500
+
+# live orientation tuning from the vis_id LOG events
+# window is (base start, base stop, resp start, resp stop) in frames (per plane) from the trial start
+# None turns it off, summaries are sent to clients every tuning_interval seconds
+tuning_window = None # eg. (0, 5, 6, 15)
+tuning_interval = 60
+# vis_id is the condition number from MATLAB, not an angle. map it to the orientation in degrees
+# (blank is -45) for preferred orientation and OSI, None only gives per-condition responses
+vis_oris = None # eg. {1: -45, 2: 0, 3: 45, 4: 90, 5: 135}
+
+# background re-fit for long sessions, every refit_every frames a seeded CNMF is run on the last
+# refit_frames frames in another process and swapped into the live model. None turns it off.
+refit_every = None # eg. 5000
+refit_frames = 1000
+
+# adaptive degradation, if a plane falls behind (queue over degrade_backlog_high frames) it steps
+# down through skipping deconvolution, reusing motion shifts, and skipping frames (NaN in traces)
+# and back up once the queue is under degrade_backlog_low frames
+degrade = False
+degrade_backlog_high = 50
+degrade_backlog_low = 5
+
+# binning for rigs with many planes that can't keep up at full resolution
+# spatial_bin averages spatial_bin x spatial_bin pixels (1, 2 or 4), temporal_bin averages frames
+# traces are saved on the acquisition timebase, live PSTHs/tuning are in binned frames
+spatial_bin = 1
+temporal_bin = 1
+
+# batched motion correction, when mc_batch_backlog frames are queued (eg. a trial sent at once after
+# ACQDONE) up to mc_batch frames are registered at once. None registers frame by frame (rigid only)
+mc_batch = None # eg. 32
+mc_batch_backlog = 20
+
+# live snapshots for SNAPSHOT queries, refreshed every snapshot_every frames with the last
+# snapshot_frames frames of traces and a running mean image. None turns them off
+snapshot_every = 30
+snapshot_frames = 300
+
+# stream the registered frames of each plane to a movie in the out folder (True, 'h5' or 'zarr'),
+# it's decimated if the disk can't keep up
+save_movie = False
+movie_buffer = 300
+
+# import caiman etc. in the background once the server is up instead of before
+warmup = True
+
+# threads writing the results at the end of the session (each file in each output folder)
+writer_threads = 4
+
+# CPU layout, each plane worker is pinned to its own cores with a matching BLAS thread limit and
+# reserve_cores are kept free for MATLAB and the event loop (the layout is printed at setup)
+resources = False
+reserve_cores = 2
+
+# cross-plane motion sharing, motion_ref_plane estimates rigid motion once per volume and the other
+# planes only apply its shifts (with a check against their own every share_check_every frames)
+share_motion = False
+motion_ref_plane = 0
+share_check_every = 100
+
+# tiled mode for dense planes that saturate a core, each plane is split into tiles (rows, cols)
+# overlapping by tile_overlap pixels, each fit by its own process. None runs each plane as one.
+# live dF/F, tuning, re-fit and degrade are off with tiles, results are merged at the end
+tiles = None # eg. (2, 2)
+tile_overlap = 32
+tile_backlog = 500 # frames queued per tile before the plane waits on a slow tile
+
 # logging level (print more or less processing info)
 # 0 is no debug (INFO for live2p and ERROR for caiman)
 # 1 is debug live2p
@@ -111,6 +193,36 @@ server_settings = {
     'xslice': slice(x_start, x_end),
     'yslice': slice(y_start, y_end),
     'num_frames_max': max_frames,
+    'trace_window': trace_window,
+    'ingest_mode': ingest_mode,
+    'seed_strategy': seed_strategy,
+    'n_init': n_init,
+    'tuning_window': tuning_window,
+    'tuning_interval': tuning_interval,
+    'vis_oris': vis_oris,
+    'refit_every': refit_every,
+    'refit_frames': refit_frames,
+    'degrade': degrade,
+    'degrade_backlog_high': degrade_backlog_high,
+    'degrade_backlog_low': degrade_backlog_low,
+    'spatial_bin': spatial_bin,
+    'temporal_bin': temporal_bin,
+    'mc_batch': mc_batch,
+    'mc_batch_backlog': mc_batch_backlog,
+    'snapshot_every': snapshot_every,
+    'snapshot_frames': snapshot_frames,
+    'save_movie': save_movie,
+    'movie_buffer': movie_buffer,
+    'warmup': warmup,
+    'writer_threads': writer_threads,
+    'resources': resources,
+    'reserve_cores': reserve_cores,
+    'share_motion': share_motion,
+    'motion_ref_plane': motion_ref_plane,
+    'share_check_every': share_check_every,
+    'tiles': tiles,
+    'tile_overlap': tile_overlap,
+    'tile_backlog': tile_backlog,
 }
 
 # run everything
@@ -0,0 +1,83 @@
+"""
+Benchmark the per-frame latency of plane workers with and without a ResourceLayout (core pinning and
+BLAS thread limits). Each plane is a thread fed frames at the volume rate doing caiman-like work per
+frame (projections onto the footprints, a few BLAS solves and an FFT registration). Latency is from
+when the frame arrives to when it's done, so a plane that falls behind shows up in the tail.
+
+Usage: python scripts/bench_resources.py [nplanes] [nframes] [fr] [reserve]
+"""
+
+import sys
+import threading
+import time
+
+import numpy as np
+import scipy.fft
+
+from live2p.resources import ResourceLayout, available_cores, pinned
+
+
+def make_plane(rng, dims=(512, 512), ncells=500):
+    A = rng.random((dims[0] * dims[1] // 16, ncells), dtype=np.float32)
+    AtA = A.T @ A + np.eye(ncells, dtype=np.float32)
+    frames = rng.random((20, *dims), dtype=np.float32)
+    return A, AtA, frames
+
+def process(frame, A, AtA):
+    F = scipy.fft.rfft2(frame)
+    frame = scipy.fft.irfft2(F * np.conj(F), s=frame.shape)
+    y = A.T @ frame.ravel()[:A.shape[0]]
+    C = np.linalg.solve(AtA, np.repeat(y[:, None], 32, axis=1))
+    for _ in range(3):
+        C = AtA @ C
+        C /= np.abs(C).max()
+    return C
+
+def run_plane(plane, nframes, fr, start, cores, latencies):
+    rng = np.random.default_rng(plane)
+    A, AtA, frames = make_plane(rng)
+    out = []
+    with pinned(cores):
+        for i in range(nframes):
+            arrival = start + i / fr
+            wait = arrival - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            process(frames[i % len(frames)], A, AtA)
+            out.append(time.perf_counter() - arrival)
+    latencies[plane] = out
+
+def run(nplanes, nframes, fr, layout=None):
+    latencies = [None] * nplanes
+    start = time.perf_counter() + 0.5
+    threads = [threading.Thread(target=run_plane,
+                                args=(p, nframes, fr, start, layout.planes[p] if layout else None, latencies))
+               for p in range(nplanes)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return np.concatenate(latencies) * 1000
+
+def report(name, lat):
+    p50, p95, p99 = np.percentile(lat, [50, 95, 99])
+    print(f'{name:>10}: p50 {p50:7.1f} ms | p95 {p95:7.1f} ms | p99 {p99:7.1f} ms | max {lat.max():7.1f} ms')
+
+def main(nplanes=3, nframes=300, fr=10, reserve=2):
+    print(f'{len(available_cores())} cores, {nplanes} planes at {fr} Hz, {nframes} frames each\n')
+
+    report('default', run(nplanes, nframes, fr))
+
+    layout = ResourceLayout(nplanes, reserve=reserve)
+    print(layout.describe())
+    # BLAS limit only (each plane thread pins itself in run), it's undone after
+    layout.apply()
+    try:
+        report('layout', run(nplanes, nframes, fr, layout))
+    finally:
+        if layout.limiter is not None:
+            layout.limiter.restore_original_limits()
+
+
+if __name__ == '__main__':
+    main(*[float(a) if i == 2 else int(a) for i, a in enumerate(sys.argv[1:])])
@@ -0,0 +1,66 @@
+"""
+Benchmark the vectorized stimalign against the old per-cell/per-trial np.roll loop.
+
+Usage: python scripts/bench_stimalign.py [ncells] [ntrials] [nframes]
+"""
+
+import sys
+import warnings
+
+import numpy as np
+
+from live2p.analysis.traces import stimalign
+from live2p.utils import tic, toc
+
+
+def stimalign_loop(trialwise_data, stim_times, new_start):
+    """The old implementation (wraps around instead of NaN filling)."""
+    stim_times = stim_times.round().astype(int)
+    
+    aligned_data = np.zeros_like(trialwise_data)
+    if len(stim_times) == trialwise_data.shape[1]:
+        for i in range(trialwise_data.shape[0]):
+            aligned_data[i,...] = np.array([np.roll(cell_trace, -amt+new_start) for cell_trace, amt in zip(trialwise_data[i,...], stim_times)])
+    
+    elif len(stim_times) == trialwise_data.shape[0]:
+        for i in range(trialwise_data.shape[0]):
+            aligned_data[i,...] = np.roll(trialwise_data[i,...], -int(stim_times[i])+new_start, axis=1)
+            
+    else:
+        warnings.warn('Length of stim times did not match the number of cells or number of trials. Stim alignment not done.')
+            
+    return aligned_data
+
+
+def timeit(func, *args, reps=3):
+    times = []
+    for _ in range(reps):
+        t = tic()
+        out = func(*args)
+        times.append(toc(t))
+    return min(times), out
+
+
+def main(ncells=1500, ntrials=500, nframes=40):
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((ntrials, ncells, nframes))
+    new_start = 10
+    
+    for name, stim_times in [('per cell', rng.integers(5, 20, ncells).astype(float)),
+                             ('per trial', rng.integers(5, 20, ntrials).astype(float))]:
+        t_loop, old = timeit(stimalign_loop, data, stim_times, new_start)
+        t_vec, new = timeit(stimalign, data, stim_times, new_start)
+        
+        # should match wherever the old version didn't wrap around
+        valid = ~np.isnan(new)
+        match = np.allclose(old[valid], new[valid])
+        print(f'{name:>10}: loop {t_loop*1000:8.1f} ms | vectorized {t_vec*1000:8.1f} ms | '
+              f'{t_loop/t_vec:5.1f}x faster | match: {match}')
+    
+    stim_times = rng.integers(5, 20, (ntrials, ncells)).astype(float)
+    t_vec, _ = timeit(stimalign, data, stim_times, new_start)
+    print(f'{"trial x cell":>10}: vectorized {t_vec*1000:8.1f} ms (not supported by the loop)')
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
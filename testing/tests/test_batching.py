@@ -0,0 +1,197 @@
+import queue
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import scipy.sparse
+
+from live2p.analysis.traces import PSTHAccumulator
+from live2p.analysis.tuning import RunningTuning
+from live2p.binning import TemporalBinner
+from live2p.motion import MotionShare
+from live2p.snapshot import SnapshotBuffer
+import live2p.workers
+from live2p.workers import RealTimeQueue
+
+
+class FakeParams:
+    def __init__(self):
+        self.values = {('init', 'nb'): 1, ('motion', 'pw_rigid'): False, ('preprocess', 'p'): 1}
+
+    def get(self, group, key):
+        return self.values.get((group, key))
+
+
+class FakeOnACID:
+    """Just enough of OnACID for the worker loop, traces are the frame number."""
+
+    def __init__(self, T=200, M=3):
+        self.M = M
+        self.params = FakeParams()
+        self.estimates = SimpleNamespace(C_on=np.zeros((M, T)), noisyC=np.zeros((M, T)), shifts=[],
+                                         Ab=scipy.sparse.csc_matrix(np.ones((16, M + 1))), dims=(4, 4))
+
+    def mc_next(self, t, frame):
+        # the shift is the frame's value, to tell frames apart
+        self.estimates.shifts.append([float(frame[0, 0]), 0.0])
+        return frame
+
+    def fit_next(self, t, frame):
+        self.estimates.C_on[:, t] = t
+        self.estimates.noisyC[:, t] = t
+
+
+def make_worker(temporal_bin=1, mc_batch=None, motion_share=None, plane=0):
+    """A RealTimeQueue around a FakeOnACID, without the caiman init."""
+    w = RealTimeQueue.__new__(RealTimeQueue)
+    w.q = queue.Queue()
+    w.acid = FakeOnACID()
+    w.plane = plane
+    w.t = w.frame_start = 1
+    w.yslice = w.xslice = slice(None)
+    w.spatial_bin, w.temporal_bin = 1, temporal_bin
+    w.binner = TemporalBinner(temporal_bin)
+    w.bin_sizes = []
+    w.raw_frame_count = w._binned_raw = w._frame_raw = w._trial_raw = 0
+    w.live_frame_count = 0
+    w.update_freq = 10**9
+    w.live_dff = w.save_movie = False
+    w.refit_every = w.degrade = w.tiled = w.traces = w.movie = w.mean_img = w.snapshot_every = None
+    w.tuning = w.stim_log = w.vis_oris = w.cores = w._held = w._batch_reg = None
+    w.skipped_frames, w.refits, w.mc_batches = [], [], []
+    w.trial_starts, w.trial_ends, w.trial_lengths, w._pending_trials = [], [], [], []
+    w._trial_t = None
+    w.psths = PSTHAccumulator()
+    w.psth_key = 'vis_id'
+    w.snapshot = SnapshotBuffer()
+    w._trial_stats = SnapshotBuffer()
+    w._publish_trial_stats()
+    w.mc_batch, w.mc_batch_backlog = mc_batch, 0
+    w.motion_share = motion_share
+    w.share_check_every = 0
+    w._share_stats = {'shared': 0, 'own': 0, 'est_time': 0.0, 'apply_time': 0.0, 'checks': []}
+    # registration is tested in test_motion, frames go through mc_next one by one here
+    w._register_batch = lambda frames_: (None, None)
+    return w
+
+def run(w, nframes):
+    for i in range(nframes):
+        w.q.put(np.full((4, 4), i, dtype=np.float32))
+    w.q.put('STOP')
+    frame_time = []
+    while True:
+        frame = w.q.get() if w._held is None else w._held
+        w._held = None
+        if isinstance(frame, str):
+            w._flush_bin(frame_time)
+            break
+        if w.mc_batch:
+            w._process_batch(frame, frame_time)
+        else:
+            frame_ = w._ingest(frame)
+            if frame_ is not None:
+                w._process_frame(frame_, frame_time)
+
+@pytest.mark.parametrize('mc_batch', [None, 8])
+def test_bin_sizes_in_batches(mc_batch):
+    w = make_worker(temporal_bin=2, mc_batch=mc_batch)
+    run(w, 9)
+    assert w.bin_sizes == [2, 2, 2, 2, 1]
+    assert w.t - w.frame_start == 5
+
+@pytest.mark.parametrize('mc_batch', [None, 8])
+def test_shared_motion_in_batches(monkeypatch, mc_batch):
+    monkeypatch.setattr(live2p.workers, 'apply_shift_iteration', lambda frame, shift: frame)
+    share = MotionShare(ref_plane=0, timeout=0.01)
+    ref = make_worker(mc_batch=mc_batch, motion_share=share, plane=0)
+    run(ref, 9)
+    # published under each frame's own acquired frame number
+    assert share._shifts == {i + 1: (float(i), 0.0) for i in range(9)}
+
+    other = make_worker(mc_batch=mc_batch, motion_share=share, plane=1)
+    run(other, 9)
+    assert other._share_stats['shared'] == 9
+    assert other._share_stats['own'] == 0
+    assert other.acid.estimates.shifts == [[float(i), 0.0] for i in range(9)]
+
+def test_trials_fold_on_the_worker_only():
+    w = make_worker()
+    w.stim_log = {'vis_id': []}
+    run(w, 5)
+    # a trial ended before its condition was logged
+    w._trial_t = w.frame_start
+    w.trial_lengths.append(5)
+    w._end_trial()
+    assert w.get_psths()['conditions'] == []
+
+    # readers (server threads) don't fold, the loop does on the next frame
+    w.stim_log['vis_id'].append(1)
+    for _ in range(3):
+        assert w.get_psths()['conditions'] == []
+    w._process_frame(np.zeros((4, 4), dtype=np.float32), [])
+    psths = w.get_psths()
+    assert psths['conditions'] == [1]
+    assert psths['n_trials'] == [1]
+
+    # published copies don't change under the reader
+    held = w._trial_stats.get()['psths']
+    w._pending_trials.append((0, np.ones((2, 5))))
+    w._fold_pending_trials()
+    assert held.n_trials[1] == 1
+    assert w.get_psths()['n_trials'] == [2]
+
+def test_skipped_frames_on_acquisition_timebase():
+    w = make_worker(temporal_bin=3)
+    run(w, 8)
+    # bins of 3, 3, 2 acquired frames, the second one was skipped
+    assert w.bin_sizes == [3, 3, 2]
+    w.skipped_frames = [w.frame_start + 1]
+    assert w._skipped_acquired() == [3, 4, 5]
+
+def test_snapshot_query_validated():
+    w = make_worker()
+    w.snapshot.publish({'t': 10, 'start': 0, 'C': np.arange(30.).reshape(3, 10),
+                        'nC': np.arange(30.).reshape(3, 10), 'shifts': np.zeros((10, 2))})
+    snap = w.get_snapshot(cells=[-1, 1, 3], frames=4)
+    assert snap['C'].tolist() == [[16, 17, 18, 19]]
+    assert snap['start'] == 6
+    for frames in (0, -2):
+        with pytest.raises(ValueError):
+            w.get_snapshot(frames=frames)
+
+@pytest.fixture
+def com_calls(monkeypatch):
+    # CoMs without caiman, keeps what they were found from
+    calls = []
+    def fake_com(A, dims, x, bin_factor=1):
+        calls.append(A)
+        return np.zeros((A.shape[1], 2))
+    monkeypatch.setattr(live2p.workers, 'find_com', fake_com)
+    return calls
+
+def test_vis_id_mapped_to_oris(com_calls):
+    w = make_worker()
+    w.vis_oris = {1: 0, 2: 90}
+    w.tuning = RunningTuning((0, 1, 2, 3))
+    w.stim_log = {'vis_id': [2, 3, 1]}
+    for idx in range(3):
+        w._pending_trials.append((idx, np.ones((2, 4))))
+    w._fold_pending_trials()
+    # vis_id 3 has no orientation, it's left out of the tuning but not the PSTHs
+    assert w.tuning.conds == [90, 0]
+    assert w.get_psths()['conditions'] == [1, 2, 3]
+
+def test_tuning_coms_found_on_worker(com_calls):
+    calls = com_calls
+    w = make_worker()
+    w.acid.M = 4
+    w.tuning = RunningTuning((0, 1, 2, 3), oris=False)
+    w.stim_log = {'vis_id': [1]}
+    w._pending_trials.append((0, np.ones((3, 4))))
+    w._fold_pending_trials()
+    assert len(calls) == 1 and scipy.sparse.issparse(calls[0])
+    # readers don't touch the live footprints
+    for _ in range(3):
+        summary = w.get_tuning()
+    assert len(calls) == 1
+    assert len(summary['resp_map']) == 3
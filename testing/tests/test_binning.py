@@ -0,0 +1,38 @@
+import numpy as np
+
+from live2p.binning import TemporalBinner, bin_ain, bin_frame, bin_movie, unbin_coords, upsample_traces
+
+def test_bin_frame_crops_edges():
+    frame = np.arange(5*6, dtype=float).reshape(5, 6)
+    binned = bin_frame(frame, 2)
+    assert binned.shape == (2, 3)
+    assert binned[0, 0] == frame[:2, :2].mean()
+    
+def test_bin_movie():
+    mov = np.random.rand(7, 8, 8)
+    binned = bin_movie(mov, spatial=4, temporal=3)
+    assert binned.shape == (2, 2, 2)
+    assert np.isclose(binned[1, 0, 1], mov[3:6, :4, 4:].mean())
+
+def test_bin_ain_matches_frames():
+    # a mask binned the same way as the frames it came from
+    dims = (8, 6)
+    mask = np.zeros(dims, dtype=bool)
+    mask[2:4, 1:3] = True
+    A = np.stack([mask.ravel(order='F'), ~mask.ravel(order='F')], axis=1)
+    binned = bin_ain(A, dims, 2)
+    assert binned.dtype == bool and binned.shape == (12, 2)
+    assert np.array_equal(binned[:, 0].reshape(4, 3, order='F'), bin_frame(mask.astype(float), 2) > 0)
+    
+def test_unbin_coords():
+    assert np.allclose(unbin_coords([[0, 0], [3, 1]], 4), [[1.5, 1.5], [13.5, 5.5]])
+
+def test_temporal_binner_and_upsample():
+    binner = TemporalBinner(3)
+    out = [binner.add(np.full(2, i, dtype=float)) for i in range(5)]
+    assert [o is None for o in out] == [True, True, False, True, True]
+    assert np.allclose(out[2], 1)
+    assert np.allclose(binner.flush(), 3.5) and binner.flush() is None
+    
+    traces = np.array([[1., 3.5]])
+    assert np.array_equal(upsample_traces(traces, [3, 2]), [[1, 1, 1, 3.5, 3.5]])
@@ -0,0 +1,35 @@
+import pytest
+
+from live2p.degrade import DegradePolicy
+
+@pytest.fixture
+def policy():
+    return DegradePolicy(backlog_high=20, backlog_low=2, cooldown=10)
+
+def test_steps_down_and_up(policy):
+    assert policy.update(1, 50) == -1
+    assert policy.tier == 'no_deconv'
+    # cooldown holds the next step
+    assert policy.update(5, 50) == 0
+    policy.update(11, 50)
+    policy.update(21, 50)
+    assert policy.tier == 'skip' and policy.active('reduce_mc')
+    # can't go lower
+    assert policy.update(31, 50) == 0
+    
+    assert policy.update(41, 1) == 1
+    assert policy.tier == 'reduce_mc' and not policy.active('skip')
+    assert [t['to'] for t in policy.transitions] == ['no_deconv', 'reduce_mc', 'skip', 'reduce_mc']
+
+def test_frame_budget():
+    policy = DegradePolicy(backlog_high=20, backlog_low=2, frame_budget=0.1, cooldown=0)
+    # slow frames but nothing queued yet
+    assert policy.update(1, 0, frame_time=0.2) == 0
+    assert policy.update(2, 5, frame_time=0.2) == -1
+
+def test_custom_tiers():
+    policy = DegradePolicy(tiers=('skip',), backlog_high=1, cooldown=0)
+    policy.update(1, 10)
+    assert policy.active('skip') and not policy.active('no_deconv')
+    with pytest.raises(ValueError):
+        DegradePolicy(tiers=('fast',))
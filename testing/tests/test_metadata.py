@@ -0,0 +1,58 @@
+import math
+import struct
+
+import pytest
+
+from live2p import metadata
+
+FRAME_DATA = """SI.VERSION_MAJOR = '2020'
+SI.hChannels.channelSave = [1;2]
+SI.hRoiManager.scanVolumeRate = 6.36
+SI.hStackManager.zs = [0 30 60]
+SI.hFastZ.enable = true
+SI.hScan2D.logFileStem = 'it''s_00001'
+SI.hChannels.channelOffset = [-100 -80 0 0]
+SI.hScan2D.mask = [1,2;3,4]
+SI.hRoiManager.linePeriod = 6.3e-05
+SI.hMotors.motorPosition = NaN
+SI.hChannels.channelName = {'Channel 1' 'Channel 2'}
+SI.hStackManager.stackZStepSize = []
+"""
+
+@pytest.fixture
+def si_tiff(tmp_path):
+    # bigtiff header, then the ScanImage header block with the frame data
+    text = FRAME_DATA.encode() + b'\x00'
+    head = b'II+\x00' + struct.pack('<HHQ', 8, 0, 0)
+    head += struct.pack('<IIII', metadata.SI_MAGIC, 3, len(text), 0)
+    fname = tmp_path/'si_00001.tif'
+    fname.write_bytes(head + text)
+    metadata.clear_cache()
+    return fname
+
+def test_parse_values():
+    assert metadata.parse_value('[1;2]') == [1, 2]
+    assert metadata.parse_value('[1,2;3,4]') == [[1, 2], [3, 4]]
+    assert metadata.parse_value('false') is False
+    assert metadata.parse_value("'a b'") == 'a b'
+    assert metadata.parse_value('-Inf') == -math.inf
+    assert metadata.parse_value('1e3') == 1000.
+    assert metadata.parse_value('[]') == []
+    assert metadata.parse_value('@scanimage.thing') == '@scanimage.thing'
+
+def test_si_metadata(si_tiff):
+    meta = metadata.si_metadata(si_tiff)
+    assert meta['SI.VERSION_MAJOR'] == '2020'
+    assert meta['SI.hScan2D.logFileStem'] == "it's_00001"
+    assert meta['SI.hChannels.channelOffset'] == [-100, -80, 0, 0]
+    assert meta['SI.hChannels.channelName'] == ['Channel 1', 'Channel 2']
+    assert math.isnan(meta['SI.hMotors.motorPosition'])
+    assert metadata.get_nchannels(si_tiff) == 2
+    assert metadata.get_nplanes(si_tiff) == 3
+    assert metadata.get_fr(si_tiff) == 6.36
+    assert metadata.get_field(si_tiff, 'linePeriod') == 6.3e-05
+
+def test_si_metadata_cached(si_tiff):
+    first = metadata.si_metadata(si_tiff)
+    si_tiff.write_bytes(b'')
+    assert metadata.si_metadata(si_tiff) is first
@@ -0,0 +1,88 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from live2p.motion import MotionShare, RigidRegistration
+
+@pytest.fixture
+def scene():
+    # smooth random 'cells', frames are crops so shifts don't wrap
+    rng = np.random.default_rng(0)
+    return ndimage.gaussian_filter(rng.random((300, 300)), 2) * 100
+
+def crop(img):
+    return img[22:278, 22:278]
+
+@pytest.mark.parametrize('shift', [(3, -2), (2.5, -1.5), (0, 0), (-6, 4.3)])
+def test_register_finds_shift(scene, shift):
+    reg = RigidRegistration(crop(scene), update_every=0)
+    moved = crop(ndimage.shift(scene, shift, order=3))
+    frame_cor, found = reg.register(moved)
+    # correction moves the frame back
+    assert np.allclose(found, -np.array(shift), atol=0.1)
+    assert np.abs(frame_cor - crop(scene))[10:-10, 10:-10].mean() < 1
+    assert reg.shifts == [list(found)]
+    
+def test_max_shift(scene):
+    reg = RigidRegistration(crop(scene), max_shift=3, update_every=0)
+    _, found = reg.register(crop(ndimage.shift(scene, (8, 0), order=1)))
+    assert np.all(np.abs(found) <= 3)
+    
+def test_register_movie_sets_template(scene):
+    mov = np.stack([crop(ndimage.shift(scene, (s, -s), order=1)) for s in (0, 1, 2, 1)])
+    reg = RigidRegistration(mov[0])
+    out = reg.register_movie(mov)
+    assert out.shape == mov.shape and reg.shifts == []
+    assert np.allclose(reg.template, out.mean(axis=0))
+    
+def test_register_batch_matches_register(scene):
+    shifts = [(1, 2), (-3.5, 0.5), (4, -4), (0, 0)]
+    frames = np.stack([crop(ndimage.shift(scene, s, order=3)) for s in shifts])
+    single = RigidRegistration(crop(scene), update_every=0)
+    batch = RigidRegistration(crop(scene), update_every=0)
+    
+    one_by_one = [single.register(f) for f in frames]
+    frames_cor, found = batch.register_batch(frames)
+    assert frames_cor.shape == frames.shape and found.shape == (4, 2)
+    assert np.allclose(found, [s for _, s in one_by_one], atol=1e-4)
+    assert np.allclose(frames_cor, [f for f, _ in one_by_one], atol=1e-2)
+    assert np.allclose(found, -np.array(shifts), atol=0.1)
+    
+def test_set_template(scene):
+    reg = RigidRegistration(crop(scene), update_every=0)
+    reg.set_template(crop(ndimage.shift(scene, (2, 0), order=3)))
+    _, found = reg.register(crop(scene))
+    assert np.allclose(found, [2, 0], atol=0.1)
+
+def test_motion_share_waits_for_reference():
+    share = MotionShare(ref_plane=0, timeout=2)
+    timer = threading.Timer(0.05, share.publish, args=(3, np.array([1.5, -2])))
+    timer.start()
+    assert share.get(3) == (1.5, -2.0)
+    # not published and not coming
+    t = time.perf_counter()
+    assert share.get(4, timeout=0.05) is None
+    assert time.perf_counter() - t < 1
+    
+def test_motion_share_close_and_skipped():
+    share = MotionShare(timeout=5)
+    share.publish(1, None)
+    assert share.get(1) is None
+    share.close()
+    t = time.perf_counter()
+    assert share.get(2) is None
+    assert time.perf_counter() - t < 1
+    
+def test_motion_share_bounded():
+    share = MotionShare(timeout=5, max_frames=100)
+    for frame in range(1, 1001):
+        share.publish(frame, (frame, 0))
+    assert len(share._shifts) == 100
+    assert share.get(1000) == (1000.0, 0.0)
+    # dropped frames don't wait for the timeout
+    t = time.perf_counter()
+    assert share.get(900) is None
+    assert time.perf_counter() - t < 1
@@ -0,0 +1,72 @@
+import threading
+
+import numpy as np
+import pytest
+
+from live2p.moviewriter import MovieWriter, open_store
+
+
+class ListStore:
+    """In memory store, optionally waiting on an event before each write (a slow disk)."""
+
+    def __init__(self, gate=None):
+        self.blocks = []
+        self.frames = []
+        self.gate = gate
+        self.closed = False
+
+    def append(self, block, frames):
+        if self.gate is not None:
+            self.gate.wait()
+        self.blocks.append(block)
+        self.frames.extend(frames)
+
+    def close(self):
+        self.closed = True
+
+
+def test_writes_all_frames_in_order():
+    store = ListStore()
+    writer = MovieWriter(store, chunk_frames=10, buffer_frames=50)
+    for t in range(35):
+        writer.put(np.full((4, 4), t, dtype=np.float32), t)
+    writer.close()
+
+    assert store.closed
+    assert store.frames == list(range(35))
+    mov = np.concatenate(store.blocks)
+    np.testing.assert_array_equal(mov[:, 0, 0], np.arange(35))
+    assert writer.summary()['written'] == 35
+    assert writer.dropped == 0
+
+def test_decimates_instead_of_blocking():
+    gate = threading.Event()
+    store = ListStore(gate)
+    writer = MovieWriter(store, chunk_frames=5, buffer_frames=10, max_step=4)
+    # the disk is stuck, put must still return right away
+    for t in range(100):
+        writer.put(np.zeros((2, 2)), t)
+    assert writer.step == 4
+    assert writer.dropped > 0
+    assert [step for _, step in writer.step_log] == [2, 4]
+
+    gate.set()
+    writer.close()
+    assert store.frames == sorted(store.frames)
+    assert writer.written + writer.dropped <= 100
+
+def test_unknown_backend(tmp_path):
+    with pytest.raises(ValueError):
+        open_store(tmp_path/'mov', (4, 4), np.float32, backend='tiff')
+
+def test_h5_store(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    store = open_store(tmp_path/'mov', (4, 4), np.float32, chunk_frames=10, backend='h5')
+    writer = MovieWriter(store, chunk_frames=10)
+    for t in range(25):
+        writer.put(np.full((4, 4), t, dtype=np.float32), t)
+    writer.close()
+
+    with h5py.File(tmp_path/'mov.h5', 'r') as f:
+        assert f['mov'].shape == (25, 4, 4)
+        np.testing.assert_array_equal(f['frames'][:], np.arange(25))
@@ -0,0 +1,74 @@
+from queue import Queue
+
+import numpy as np
+import pytest
+import tifffile
+
+from live2p.readers import PrefetchReader, TiffTailer
+
+@pytest.fixture
+def tiff_list(tmp_path):
+    files = []
+    for i, nframes in enumerate([40, 40, 10, 40]):
+        mov = np.full((nframes, 16, 16), i, dtype='int16')
+        mov[1::2] += 100 # second 'plane'
+        fname = tmp_path/f'file_{i:05}.tif'
+        tifffile.imwrite(fname, mov)
+        files.append(fname)
+    return files
+
+def test_prefetch_order(tiff_list):
+    reader = PrefetchReader(tiff_list, [slice(0, None, 2), slice(1, None, 2)], ahead=1, min_frames=15)
+    out = [(planes[0][0,0,0], planes[1][0,0,0]) for _, planes in reader]
+    assert out == [(0, 100), (1, 101), (3, 103)]
+    
+def test_prefetch_stats(tiff_list):
+    reader = PrefetchReader(tiff_list, ahead=2)
+    nframes = [planes[0].shape[0] for _, planes in reader]
+    assert nframes == [40, 40, 10, 40]
+    assert reader.report()['nfiles'] == 4
+    
+def test_prefetch_skips_missing(tiff_list, tmp_path):
+    reader = PrefetchReader(tiff_list[:1] + [tmp_path/'missing.tif'])
+    assert len(list(reader)) == 1
+    
+def test_tailer_planes(tmp_path):
+    # 2 channels x 3 planes x 4 volumes, value is the page number
+    mov = np.arange(24, dtype='int16')[:,None,None] * np.ones((1, 8, 8), dtype='int16')
+    tifffile.imwrite(tmp_path/'src.tif', mov)
+    data = (tmp_path/'src.tif').read_bytes()
+    epoch = tmp_path/'epoch'
+    epoch.mkdir()
+    
+    qs = [Queue() for _ in range(3)]
+    tailer = TiffTailer(epoch, qs, nchannels=2, nplanes=3)
+    (epoch/'file_00001.tif').write_bytes(data[:len(data)//2])
+    tailer.poll()
+    (epoch/'file_00001.tif').write_bytes(data)
+    (epoch/'file_00002.tif').write_bytes(data)
+    tailer.poll(final=True)
+    
+    out = [qs[1].get() for _ in range(qs[1].qsize())]
+    out = [x if isinstance(x, str) else int(x[0,0]) for x in out]
+    assert out == ['TRIAL START', 2, 8, 14, 20, 'TRIAL END'] * 2
+    assert tailer.lengths == [4, 4]
+    
+def test_tailer_growing_file(tmp_path):
+    # ScanImage appends pages to the open file, the tailer keeps up and sends all of them
+    epoch = tmp_path/'epoch'
+    epoch.mkdir()
+    qs = [Queue()]
+    tailer = TiffTailer(epoch, qs, nchannels=1, nplanes=1)
+    fname = epoch/'file_00001.tif'
+    tifffile.imwrite(fname, np.zeros((8, 8), dtype='int16'))
+    tailer.poll()
+    for page in range(1, 5):
+        tifffile.imwrite(fname, np.full((8, 8), page, dtype='int16'), append=True)
+        tailer.poll()
+        assert qs[0].qsize() == page + 2 # TRIAL START and the pages so far
+    tailer.poll(final=True)
+    
+    out = [qs[0].get() for _ in range(qs[0].qsize())]
+    out = [x if isinstance(x, str) else int(x[0,0]) for x in out]
+    assert out == ['TRIAL START', 0, 1, 2, 3, 4, 'TRIAL END']
+    assert tailer.lengths == [5]
@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import scipy.sparse
+
+from live2p.refit import RefitBuffer, read_buffer, swap_footprints
+from live2p.workers import RealTimeQueue
+
+def test_buffer_order(tmp_path):
+    buf = RefitBuffer(tmp_path/'buf.mmap', 5, (4, 3))
+    for i in range(8):
+        buf.add(np.full((4, 3), i))
+    frames = read_buffer(**buf.job())
+    assert buf.n_valid == 5
+    assert np.array_equal(frames[:,0,0], [3, 4, 5, 6, 7])
+    buf.close()
+    assert not (tmp_path/'buf.mmap').exists()
+
+def test_swap_footprints():
+    pytest.importorskip('caiman.source_extraction.cnmf.utilities')
+    rng = np.random.default_rng(0)
+    nb, ncells, npix = 2, 5, 100
+    # one extra cell was added by OnACID after the re-fit started
+    Ab = scipy.sparse.csc_matrix(rng.random((npix, nb + ncells + 1)) * (rng.random((npix, nb + ncells + 1)) > 0.7))
+    est = SimpleNamespace(Ab=Ab, Yr_buf=rng.random((10, npix)), Ab_dense=np.zeros((npix, 20)))
+    
+    A = scipy.sparse.csc_matrix(Ab[:, nb:nb+ncells].toarray() * 3)
+    b = Ab[:, :nb].toarray() * 2
+    swap_footprints(est, A, b, nb)
+    
+    # footprints are rescaled to the old norms, the added cell is untouched
+    assert np.allclose(est.Ab.toarray(), Ab.toarray())
+    assert np.allclose(est.AtA, (Ab.T @ Ab).toarray())
+    assert len(est.ind_A) == ncells + 1
+    assert np.allclose(est.Ab_dense[:, :Ab.shape[1]], Ab.toarray())
+
+@pytest.mark.parametrize('nrefit', [4, 6])
+def test_refit_must_match_seeds(nrefit):
+    # a fit that dropped (or added) cells would shift every cell after it, so it isn't swapped
+    nb, nseeds = 1, 5
+    worker = SimpleNamespace(acid=SimpleNamespace(M=nb + nseeds + 1, params=SimpleNamespace(get=lambda *k: nb)),
+                             plane=0, t=100, refits=[])
+    result = {'A': scipy.sparse.csc_matrix((20, nrefit)), 'b': np.zeros((20, nb)), 'nseeds': nseeds,
+              'nframes': 50, 'fit_time': 1.0}
+    RealTimeQueue._swap_refit(worker, result)
+    assert worker.refits == []
+
+def test_swap_footprints_too_many_cells():
+    est = SimpleNamespace(Ab=scipy.sparse.csc_matrix((20, 4)))
+    with pytest.raises(ValueError):
+        swap_footprints(est, scipy.sparse.csc_matrix((20, 4)), np.zeros((20, 1)), 1)
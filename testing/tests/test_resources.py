@@ -0,0 +1,59 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from live2p.resources import BLAS_ENV_VARS, ResourceLayout, available_cores, limit_blas, pin_process, pinned
+
+def test_layout_splits_cores():
+    layout = ResourceLayout(3, reserve=2, cores=range(16))
+    assert layout.reserved == [0, 1]
+    assert layout.planes == [[2, 3, 4, 5, 6], [7, 8, 9, 10, 11], [12, 13, 14, 15]]
+    assert layout.blas_threads == 4
+    text = layout.describe()
+    assert 'MATLAB/event loop: 0-1' in text and 'plane 2: 12-15' in text
+    
+def test_layout_more_planes_than_cores():
+    layout = ResourceLayout(4, reserve=2, cores=range(4))
+    assert layout.reserved == [0, 1]
+    assert layout.planes == [[2], [3], [2], [3]]
+    assert layout.blas_threads == 1
+    # always leaves a core for the planes
+    assert ResourceLayout(1, reserve=8, cores=range(2)).planes == [[1]]
+    
+def test_limit_blas_sets_env(monkeypatch):
+    for var in BLAS_ENV_VARS:
+        monkeypatch.delenv(var, raising=False)
+    limiter = limit_blas(2)
+    try:
+        assert all(os.environ[var] == '2' for var in BLAS_ENV_VARS)
+    finally:
+        if limiter is not None:
+            limiter.restore_original_limits()
+            
+@pytest.mark.skipif(not hasattr(os, 'sched_setaffinity'), reason='needs sched_setaffinity')
+def test_pinned_restores():
+    before = available_cores()
+    with pinned(before[:1]):
+        assert available_cores() == before[:1]
+    assert available_cores() == before
+
+@pytest.mark.skipif(not hasattr(os, 'sched_setaffinity'), reason='needs sched_setaffinity')
+def test_apply_leaves_loop_unpinned(monkeypatch):
+    # threads and processes started from the loop would inherit its cores
+    for var in BLAS_ENV_VARS:
+        monkeypatch.delenv(var, raising=False)
+    before = available_cores()
+    layout = ResourceLayout(2, reserve=1, cores=before)
+    layout.apply()
+    try:
+        assert available_cores() == before
+    finally:
+        if layout.limiter is not None:
+            layout.limiter.restore_original_limits()
+
+@pytest.mark.skipif(not hasattr(os, 'sched_setaffinity'), reason='needs sched_setaffinity')
+def test_pin_process():
+    cores = available_cores()[-1:]
+    with ProcessPoolExecutor(max_workers=1, initializer=pin_process, initargs=(cores,)) as pool:
+        assert sorted(pool.submit(os.sched_getaffinity, 0).result()) == cores
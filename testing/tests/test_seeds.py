@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+import tifffile
+
+from live2p.seeds import build_seed
+
+@pytest.fixture
+def tiff_list(tmp_path):
+    # 2 channels x 2 planes x 25 volumes, value is the global frame number of plane 1
+    files = []
+    for i in range(8):
+        mov = np.zeros((100, 16, 16), dtype='int16')
+        mov[2::4] = (np.arange(25) + i*25)[:,None,None]
+        if i == 5:
+            mov[2::4] += np.random.randint(0, 500, size=(25, 16, 16)).astype('int16')
+        fname = tmp_path/f'file_{i:05}.tif'
+        tifffile.imwrite(fname, mov)
+        files.append(fname)
+    return files
+
+def test_seed_first(tiff_list):
+    seed = build_seed(tiff_list, 1, 2, 2, n_init=30, strategy='first', x_slice=slice(4, 12))
+    assert seed.shape == (30, 16, 8)
+    assert np.array_equal(seed[:,0,0], np.arange(30))
+    
+def test_seed_even(tiff_list):
+    seed = build_seed(tiff_list, 1, 2, 2, n_init=20, strategy='even')
+    assert seed.shape[0] == 20
+    assert seed[0,0,0] == 0 and seed[-1,0,0] == 199
+    
+def test_seed_variance(tiff_list):
+    seed = build_seed(tiff_list, 1, 2, 2, n_init=25, strategy='variance')
+    assert seed.shape[0] == 25
+    assert np.all(seed.min(axis=(1,2)) >= 125)
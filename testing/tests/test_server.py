@@ -11,4 +11,28 @@ def server():
     pass
     # thread = threading.Thread(target=TestServer(**server_settings))
     # thread.daemon = True
-    # thread.start()
\ No newline at end of file
+    # thread.start()
+def test_process_and_save_same_folder_once(tmp_path):
+    import json
+    import numpy as np
+    from live2p.websockets.server import Live2pServer
+    from live2p.writer import ResultWriter
+    
+    server = Live2pServer.__new__(Live2pServer)
+    server.writer = ResultWriter()
+    submitted = []
+    submit = server.writer.submit
+    server.writer.submit = lambda name, *args: submitted.append(name) or submit(name, *args)
+    server.lengths, server.trialtimes_success, server.fr = [5, 5], ['12:00:00', '12:00:01'], 1
+    C = np.random.default_rng(0).random((3, 10))
+    C[0, 2] = np.nan
+    # the epoch folder is also the output folder
+    (tmp_path/'epoch').mkdir()
+    server.process_and_save([{'C': C}], save_paths=[tmp_path, tmp_path/'epoch'/'..'])
+    server.writer.close()
+    
+    assert sum('raw_data.json' in name for name in submitted) == 1
+    assert not server.writer.errors
+    raw = json.loads((tmp_path/'raw_data.json').read_text())
+    assert raw['raw_traces'][0][2] is None and raw['trial_lengths'] == [5, 5]
+    assert json.loads((tmp_path/'traces_data.json').read_text())['psth_lengths'] == [5, 5]
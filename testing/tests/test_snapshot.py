@@ -0,0 +1,29 @@
+import numpy as np
+
+from live2p.snapshot import RunningMeanImage, SnapshotBuffer
+
+
+def test_buffer_swaps_whole_snapshots():
+    buf = SnapshotBuffer()
+    assert buf.get() is None
+
+    first = {'t': 1, 'C': np.zeros((2, 3))}
+    buf.publish(first)
+    held = buf.get()
+    buf.publish({'t': 2, 'C': np.ones((2, 3))})
+
+    # a reader holding the old snapshot keeps it unchanged
+    assert held is first
+    assert held['t'] == 1 and held['C'].sum() == 0
+    assert buf.get()['t'] == 2
+    assert buf.version == 2
+
+def test_running_mean_downsamples():
+    mean = RunningMeanImage(ds=4, frames=10)
+    mean.add(np.ones((16, 16)))
+    assert mean.image.shape == (4, 4)
+    np.testing.assert_allclose(mean.image, 1)
+
+    for _ in range(200):
+        mean.add(np.full((16, 16), 3.0))
+    np.testing.assert_allclose(mean.image, 3, atol=1e-3)
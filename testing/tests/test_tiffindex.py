@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import tifffile
+
+from live2p.tiffindex import TiffIndex, index_tiff
+from live2p.watcher import EpochWatcher
+
+@pytest.fixture(params=[False, True], ids=['tiff', 'bigtiff'])
+def tiff_bytes(request, tmp_path):
+    mov = np.random.randint(0, 1000, size=(30, 20, 24)).astype('int16')
+    fname = tmp_path/'src.tif'
+    tifffile.imwrite(fname, mov, bigtiff=request.param)
+    return mov, fname.read_bytes()
+
+def test_index_pages(tiff_bytes, tmp_path):
+    mov, data = tiff_bytes
+    fname = tmp_path/'full.tif'
+    fname.write_bytes(data)
+    idx = TiffIndex(fname)
+    assert len(idx) == 30 and idx.complete
+    assert np.array_equal(idx.pages(slice(1, None, 3)), mov[1::3])
+    
+def test_index_partial(tiff_bytes, tmp_path):
+    mov, data = tiff_bytes
+    fname = tmp_path/'part.tif'
+    fname.write_bytes(data[:len(data)//2])
+    idx = index_tiff(fname)
+    assert not idx.complete
+    
+    fname.write_bytes(data)
+    idx.update()
+    assert len(idx) == 30 and idx.complete
+    
+def test_index_growing(tmp_path):
+    # pages appended one at a time like ScanImage, each patches the last IFD's next offset
+    mov = np.random.randint(0, 1000, size=(5, 20, 24)).astype('int16')
+    fname = tmp_path/'growing.tif'
+    tifffile.imwrite(fname, mov[0])
+    idx = TiffIndex(fname)
+    assert len(idx) == 1 and idx.update() == 0
+    
+    for frame in mov[1:3]:
+        tifffile.imwrite(fname, frame, append=True)
+    assert idx.update() == 2
+    tifffile.imwrite(fname, mov[3], append=True)
+    assert idx.update() == 1
+    tifffile.imwrite(fname, mov[4], append=True)
+    assert idx.update() == 1
+    assert np.array_equal(idx.pages(slice(None)), mov)
+    idx.close()
+    
+def test_watcher_order(tiff_bytes, tmp_path):
+    _, data = tiff_bytes
+    epoch = tmp_path/'epoch'
+    epoch.mkdir()
+    (epoch/'seed_00001.tif').write_bytes(data)
+    
+    found = []
+    watcher = EpochWatcher(epoch, found.append, stable_polls=1)
+    (epoch/'file_00003.tif').write_bytes(data)
+    (epoch/'file_00002.tif').write_bytes(data[:len(data)//2])
+    watcher.poll()
+    assert found == []
+    
+    (epoch/'file_00002.tif').write_bytes(data)
+    watcher.poll()
+    watcher.stop()
+    assert [f[-14:] for f in found] == ['file_00002.tif', 'file_00003.tif']
+    
+def test_watcher_skips_unreadable(tiff_bytes, tmp_path):
+    _, data = tiff_bytes
+    epoch = tmp_path/'epoch'
+    epoch.mkdir()
+    
+    found = []
+    watcher = EpochWatcher(epoch, found.append, stable_polls=2)
+    (epoch/'a_00001.tif').write_bytes(b'not a tiff at all')
+    (epoch/'a_00002.tif').write_bytes(data)
+    (epoch/'a_00003.tif').write_bytes(data)
+    for _ in range(5):
+        watcher.poll()
+    watcher.stop()
+    assert [f[-11:] for f in found] == ['a_00002.tif', 'a_00003.tif']
+    assert 'a_00001.tif' in watcher.done
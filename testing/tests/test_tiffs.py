@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+import tifffile
+
+from live2p.analysis.tiffs import project_tiffs
+
+@pytest.fixture
+def epoch(tmp_path):
+    # 2 planes, 2 channels interleaved like ScanImage
+    rng = np.random.default_rng(0)
+    movs = [rng.integers(0, 1000, size=(40 + 4*i, 16, 12)).astype('int16') for i in range(3)]
+    files = []
+    for i, mov in enumerate(movs):
+        fname = tmp_path/f'file_{i:05}.tif'
+        tifffile.imwrite(fname, mov)
+        files.append(fname)
+    return files, movs
+
+def test_projection_mean_max(epoch):
+    files, movs = epoch
+    frames = np.concatenate([m[3::4] for m in movs]) # plane 1, channel 1
+    mean = project_tiffs(files, 1, 1, 2, 2, kind='mean', chunk=3, cache_dir=False)
+    assert np.allclose(mean, frames.mean(axis=0))
+    mx = project_tiffs(files, 1, 1, 2, 2, kind='max', cache_dir=False)
+    assert np.array_equal(mx, frames.max(axis=0))
+    
+def test_projection_cache(epoch, tmp_path):
+    files, movs = epoch
+    cache = tmp_path/'cache'
+    first = project_tiffs(files, 0, 0, 2, 2, cache_dir=cache)
+    assert len(list(cache.glob('*.npz'))) == 3
+    
+    # cached results are used, a changed file is recomputed
+    assert np.array_equal(project_tiffs(files, 0, 0, 2, 2, cache_dir=cache), first)
+    tifffile.imwrite(files[0], movs[0] + 100)
+    changed = project_tiffs(files, 0, 0, 2, 2, cache_dir=cache)
+    assert len(list(cache.glob('*.npz'))) == 4
+    assert not np.allclose(changed, first)
+
+def test_projection_processes(epoch):
+    files, _ = epoch
+    serial = project_tiffs(files, 0, 1, 2, 2, cache_dir=False)
+    assert np.allclose(project_tiffs(files, 0, 1, 2, 2, processes=2, cache_dir=False), serial)
@@ -0,0 +1,74 @@
+import queue
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import scipy.sparse
+
+from live2p.tiling import TiledPlane, component_centers, dedupe_components, embed_tile, tile_layout
+
+def blob(dims, center, r=3):
+    y, x = np.ogrid[:dims[0], :dims[1]]
+    img = np.exp(-((y - center[0])**2 + (x - center[1])**2) / (2 * r**2))
+    img[img < 0.05] = 0
+    return img.ravel(order='F')
+
+def test_tile_layout():
+    tiles, cores = tile_layout((100, 60), (2, 3), 10)
+    assert len(tiles) == len(cores) == 6
+    assert tiles[0] == (slice(0, 55), slice(0, 25))
+    assert tiles[4] == (slice(45, 100), slice(15, 45))
+    # cores cover the FOV once
+    cover = np.zeros((100, 60), dtype=int)
+    for ys, xs in cores:
+        cover[ys, xs] += 1
+    assert np.all(cover == 1)
+    
+def test_embed_tile():
+    dims = (20, 30)
+    tile = (slice(5, 15), slice(10, 30))
+    A_tile = np.stack([blob((10, 20), (4, 7), r=2), blob((10, 20), (2, 15))], axis=1)
+    A = embed_tile(A_tile, tile, dims)
+    assert A.shape == (600, 2)
+    full = A[:, 0].toarray().reshape(dims, order='F')
+    assert np.array_equal(full[tile], A_tile[:, 0].reshape(10, 20, order='F'))
+    assert np.allclose(component_centers(A, dims)[0], [9, 17], atol=0.1)
+    
+def test_dedupe_components():
+    dims = (40, 80)
+    tiles, cores = tile_layout(dims, (1, 2), 16)
+    # same cell in the overlap found by both tiles, owned by tile 0 (center x=38 < 40)
+    # a cell only tile 1 found in tile 0's core, and one cell in each tile's own core
+    A = np.stack([blob(dims, (20, 38)), blob(dims, (20, 38.5)), blob(dims, (10, 35)),
+                  blob(dims, (20, 10)), blob(dims, (20, 70))], axis=1)
+    tile_idx = np.array([0, 1, 1, 0, 1])
+    keep = dedupe_components(scipy.sparse.csc_matrix(A), tile_idx, cores, dims)
+    assert keep.tolist() == [True, False, True, True, True]
+
+def fake_tiled(alive, backlog=2):
+    # TiledPlane without the tile processes, tile 1 has already sent its model
+    plane = TiledPlane.__new__(TiledPlane)
+    plane.plane, plane.poll_interval, plane._results = 0, 0.01, None
+    plane.tiles = [(slice(0, 4), slice(0, 4))] * len(alive)
+    plane.wait_time = [0.0] * len(alive)
+    plane._in_qs = [queue.Queue(maxsize=backlog) for _ in alive]
+    plane._out_q = queue.Queue()
+    plane._out_q.put(('done', 1, {'nframes': 0}))
+    plane._procs = [SimpleNamespace(is_alive=lambda a=a: a, join=lambda timeout: None, terminate=lambda: None)
+                    for a in alive]
+    plane.registration = SimpleNamespace(register=lambda frame: (frame, None))
+    return plane
+
+def test_stop_gives_up_on_dead_tiles():
+    plane = fake_tiled([False, False])
+    # tile 0 died with a full queue
+    plane._in_qs[0].put(1)
+    plane._in_qs[0].put(2)
+    assert list(plane.stop()) == [1]
+
+def test_fit_stops_on_dead_tile():
+    plane = fake_tiled([False], backlog=1)
+    plane.fit(np.zeros((4, 4)))
+    with pytest.raises(RuntimeError):
+        plane.fit(np.zeros((4, 4)))
+    assert plane.wait_time[0] > 0
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from live2p.analysis.traces import (PSTHAccumulator, RunningQuantile, baseline_subtract,
+                                    make_trialwise, process_data, rolling_f0, stimalign, trial_mask)
+
+@pytest.fixture
+def trialwise():
+    # trials x cells x time, value is the frame number
+    return np.tile(np.arange(20, dtype=float), (4, 3, 1))
+
+def test_stimalign_per_cell(trialwise):
+    aligned = stimalign(trialwise, np.array([5, 8, 2]), new_start=4)
+    assert np.all(aligned[:,0,4] == 5) and np.all(aligned[:,1,4] == 8) and np.all(aligned[:,2,4] == 2)
+    
+def test_stimalign_per_trial(trialwise):
+    aligned = stimalign(trialwise, np.array([5, 6, 7, 8]), new_start=4)
+    assert np.array_equal(aligned[:,0,4], [5, 6, 7, 8])
+    
+def test_stimalign_trial_by_cell(trialwise):
+    stim_times = np.arange(12).reshape(4, 3) + 4
+    aligned = stimalign(trialwise, stim_times, new_start=4)
+    assert np.array_equal(aligned[...,4], stim_times)
+    
+def test_stimalign_nan_fill(trialwise):
+    aligned = stimalign(trialwise, np.array([1, 10, 2]), new_start=4)
+    # shifted in from before the trial start
+    assert np.all(np.isnan(aligned[:,0,:3])) and aligned[0,0,3] == 0
+    # shifted in from after the trial end
+    assert np.all(np.isnan(aligned[:,1,14:])) and aligned[0,1,13] == 19
+    
+def test_make_trialwise_ragged():
+    traces = np.arange(30, dtype=float).reshape(3, 10)
+    trialwise, lengths = make_trialwise(traces, [4, 2, 4], return_lengths=True)
+    assert trialwise.shape == (3, 3, 4)
+    assert np.array_equal(lengths, [4, 2, 4])
+    assert np.array_equal(trialwise[1,0,:2], [4, 5]) and np.all(np.isnan(trialwise[1,:,2:]))
+    assert np.array_equal(trial_mask(lengths, 4), ~np.isnan(trialwise[:,0,:]))
+    
+def test_baseline_subtract_ragged():
+    traces = np.ones((2, 7))
+    trialwise = make_trialwise(traces, [2, 5])
+    baselined = baseline_subtract(trialwise, 3)
+    assert np.all(baselined[0,:,:2] == 0) and np.all(np.isnan(baselined[0,:,2:]))
+    
+def test_process_data_lengths():
+    # the last trial is short, its frames are kept and the rest is padding
+    traces = np.random.default_rng(3).random((3, 22))
+    _, psths, lengths = process_data(traces, [8, 8, 8], fr=1, new_start=2, return_lengths=True)
+    assert psths.shape == (3, 3, 8)
+    assert lengths.tolist() == [8, 8, 6]
+    assert np.array_equal(trial_mask(lengths, 8), ~np.isnan(psths[:,0,:]))
+    
+    _, cut, cut_lengths = process_data(traces, [8, 8, 8], fr=1, new_start=2, total_length=7,
+                                       return_lengths=True)
+    assert cut.shape == (3, 3, 7) and cut_lengths.tolist() == [7, 7, 6]
+    
+def test_running_quantile_matches_batch():
+    traces = np.random.default_rng(0).random((5, 300))
+    rq = RunningQuantile(5, window=50, q=0.2)
+    online = np.stack([rq.update(traces[:,t]) for t in range(300)], axis=1)
+    # a trailing window is the same as a centered window shifted back by half a window
+    batch = rolling_f0(traces, window=50, q=0.2)
+    assert np.allclose(online[:,49:], batch[:,25:-24], atol=1e-6)
+    
+def test_running_quantile_ties_and_resize():
+    # few distinct values so the sorted buffer is full of ties
+    traces = np.random.default_rng(1).integers(0, 5, (6, 120)).astype(np.float32)
+    rq = RunningQuantile(4, window=16, q=0.3)
+    for t in range(120):
+        if t == 40:
+            rq.resize(6)
+        ncells = 4 if t < 40 else 6
+        value = rq.update(traces[:ncells,t])
+        start = [max(t - 15, 0)] * 4 + [max(t - 15, 40)] * (ncells - 4)
+        expected = [np.quantile(traces[c,start[c]:t+1], 0.3) for c in range(ncells)]
+        assert np.allclose(value, expected, atol=1e-6)
+    
+def test_rolling_f0_step():
+    # slow baseline plus noise, F0 computed every 4 frames stays within the noise
+    rng = np.random.default_rng(2)
+    traces = 1 + 0.5 * np.sin(np.arange(400) / 60) + 0.1 * rng.random((3, 400))
+    exact = rolling_f0(traces, window=50, q=0.2)
+    assert np.allclose(rolling_f0(traces, window=50, q=0.2, step=4), exact, atol=0.05)
+    
+def test_psth_accumulator():
+    rng = np.random.default_rng(0)
+    trials = rng.random((6, 4, 10))
+    conds = [0, 90, 0, 90, 0, [1, 2]]
+    acc = PSTHAccumulator()
+    for trial, cond in zip(trials, conds):
+        acc.add(trial, cond)
+    assert np.allclose(acc.mean(0), trials[[0,2,4]].mean(axis=0))
+    assert np.allclose(acc.std(90), trials[[1,3]].std(axis=0))
+    assert acc.mean().shape == (3, 4, 10) and acc.n_trials[(1, 2)] == 1
+    
+def test_psth_accumulator_ragged():
+    acc = PSTHAccumulator()
+    acc.add(np.ones((2, 5)), 'a')
+    acc.add(np.full((3, 8), 3.), 'a')
+    mean = acc.mean('a')
+    assert mean.shape == (3, 8)
+    assert np.allclose(mean[:2,:5], 2) and np.allclose(mean[:,5:], 3) and np.allclose(mean[2], 3)
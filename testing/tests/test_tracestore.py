@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from live2p.tracestore import TraceStore, TraceWindow
+
+def test_trace_store_grows_rows(tmp_path):
+    store = TraceStore(tmp_path/'C.traces')
+    store.append(np.ones((2, 3)))
+    # a component was added
+    store.append(np.full((3, 2), 2.0))
+    assert store.nframes == 5
+    out = store.read(slice(1, 3), 1, 5)
+    assert np.array_equal(out, [[1, 1, 2, 2], [0, 0, 2, 2]])
+    store.close()
+    assert not (tmp_path/'C.traces').exists()
+
+@pytest.fixture
+def window(tmp_path):
+    est = SimpleNamespace(C_on=np.zeros((3, 20)), noisyC=np.zeros((3, 20)))
+    return TraceWindow(est, tmp_path, start=5, keep=4)
+
+def run_frames(window, t, nframes):
+    # fill each frame with its global frame number, spilling like the worker does
+    est = window.estimates
+    for _ in range(nframes):
+        est.C_on[:, t] = t
+        est.noisyC[:, t] = -t
+        t += 1
+        if window.full(t):
+            window.spill(t, 3)
+    return t
+
+def test_trace_window_spills_and_reads(window):
+    t = run_frames(window, 5, 60)
+    assert window.offset > 0 and window.local(t) < window.size
+    C = window.read('C_on', slice(1, 3), 5, t)
+    assert C.shape == (2, 60)
+    assert np.array_equal(C[0], np.arange(5, 65))
+    assert np.array_equal(window.read('noisyC', slice(0, 1), 30, 62)[0], -np.arange(30, 62))
+    # only from the window
+    assert np.array_equal(window.read('C_on', slice(0, 1), t - 2, t)[0], [t - 2, t - 1])
+    
+def test_trace_window_keep_too_big(tmp_path):
+    est = SimpleNamespace(C_on=np.zeros((3, 10)), noisyC=np.zeros((3, 10)))
+    with pytest.raises(ValueError):
+        TraceWindow(est, tmp_path, start=0, keep=9)
+
+def fake_fit_next(est, t, frame, mbs=3):
+    # like OnACID, t is the column of the frame and the sample count of the running statistics
+    est.noisyC[:, t] = 0.5 * est.noisyC[:, t - 1] + frame[:est.noisyC.shape[0]]
+    est.C_on[:, t] = np.maximum(est.noisyC[:, t], 0)
+    # OASIS rewrites the last pool
+    est.C_on[0, t - 1:t + 1] = est.C_on[0, t]
+    if t % mbs == 0:
+        ccf = est.C_on[:, t - mbs + 1:t + 1]
+        w = np.zeros_like(est.CC)
+        w[:ccf.shape[0], :ccf.shape[0]] = ccf @ ccf.T
+        est.CC = est.CC * (1 - mbs / t) + w / t
+    # a component is added, the trace arrays are grown with vstack
+    if t == 40:
+        est.C_on = np.vstack([est.C_on, np.zeros((1, est.C_on.shape[1]))])
+        est.noisyC = np.vstack([est.noisyC, np.zeros((1, est.noisyC.shape[1]))])
+
+@pytest.mark.parametrize('nframes', [10, 90])
+def test_model_updates_match_without_window(tmp_path, nframes):
+    rng = np.random.default_rng(0)
+    frames = rng.normal(size=(nframes + 10, 4))
+    init = 5
+
+    full = SimpleNamespace(C_on=np.zeros((3, 200)), noisyC=np.zeros((3, 200)), CC=np.zeros((4, 4)))
+    windowed = SimpleNamespace(C_on=np.zeros((3, 20)), noisyC=np.zeros((3, 20)), CC=np.zeros((4, 4)))
+    window = TraceWindow(windowed, tmp_path, start=0, keep=8)
+
+    for t in range(init, init + nframes):
+        fake_fit_next(full, t, frames[t])
+        fake_fit_next(windowed, t, frames[t])
+        if window.full(t + 1):
+            window.spill(t + 1, windowed.C_on.shape[0])
+
+    assert (window.offset > 0) == (nframes > 10)
+    np.testing.assert_allclose(windowed.CC, full.CC)
+    stop = init + nframes
+    rows = slice(0, full.C_on.shape[0])
+    for name in ('C_on', 'noisyC'):
+        np.testing.assert_allclose(window.read(name, rows, 0, stop), getattr(full, name)[:, :stop])
+    # indexed by global frame
+    np.testing.assert_allclose(windowed.C_on[:, stop - 1], full.C_on[:, stop - 1])
+    if window.offset:
+        with pytest.raises(IndexError):
+            windowed.C_on[:, 0]
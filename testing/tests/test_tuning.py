@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from live2p.analysis.tuning import RunningTuning, condition_tensor, osi, tuning, tuning_df
+
+@pytest.fixture
+def tuned():
+    # 4 cells preferring 0, 45, 90, 135 (both directions), blank trials are -45
+    rng = np.random.default_rng(0)
+    oris = np.tile([-45, 0, 45, 90, 135, 180, 225, 270, 315], 8)
+    prefs = np.array([0, 45, 90, 135])
+    traces = rng.standard_normal((4, oris.size, 40)) * 0.1
+    amp = np.cos(np.deg2rad(2 * (oris[None, :] - prefs[:, None]))) + 1
+    amp[:, oris == -45] = 0
+    traces[:, :, 20:30] += amp[..., None]
+    return traces, oris
+
+def test_condition_tensor_unequal_trials():
+    conds = np.array([0, 90, 0, 0, 90])
+    tensor, conditions = condition_tensor(np.arange(5.)[None, :], conds)
+    assert np.array_equal(conditions, [0, 90])
+    assert np.array_equal(tensor[0, 0], [0, 2, 3]) and np.array_equal(tensor[0, 1, :2], [1, 4])
+    assert np.isnan(tensor[0, 1, 2])
+
+def test_tuning(tuned):
+    traces, oris = tuned
+    results = tuning(traces, oris, (0, 15, 20, 30))
+    assert np.array_equal(results['pref'], [0, 45, 90, 135])
+    assert np.array_equal(results['ortho'], [90, 135, 0, 45])
+    assert np.all(results['vis_resp'])
+    assert np.all(results['osi'] > 0.5)
+
+def test_osi_missing_ortho():
+    # ortho (90) never shown
+    responses = np.array([[1., 0.5, 1.2, 0.4]])
+    assert np.isnan(osi(responses, np.array([0, 45, 0, 45])))[0]
+
+def test_tuning_df(tuned):
+    traces, oris = tuned
+    mdf = tuning_df(tuning(traces, oris, (0, 15, 20, 30)))
+    assert len(mdf) == traces.shape[0] * traces.shape[1]
+    assert mdf.groupby('cell').pref.first().tolist() == [0, 45, 90, 135]
+
+def test_running_tuning_matches_batch(tuned):
+    traces, oris = tuned
+    running = RunningTuning((0, 15, 20, 30))
+    for i, ori in enumerate(oris):
+        # a cell shows up partway through
+        cells = 3 if i < 10 else 4
+        running.add(traces[:cells, i], ori)
+    
+    results = running.results()
+    expected = tuning(traces, oris, (0, 15, 20, 30))
+    assert running.responses.shape == (4, oris.size)
+    assert np.isnan(running.responses[3, :10]).all()
+    assert np.array_equal(results['pref'], expected['pref'])
+    assert np.allclose(results['pval'][:3], expected['pval'][:3])
+
+def test_running_tuning_summary(tuned):
+    traces, oris = tuned
+    running = RunningTuning((0, 15, 20, 30))
+    assert running.summary()['n_trials'] == 0
+    for i, ori in enumerate(oris):
+        running.add(traces[:, i], ori)
+    
+    summary = running.summary(coms=np.arange(8).reshape(4, 2), bins=5)
+    assert summary['n_responsive'] == 4 and sum(summary['osi_hist']) == 4
+    assert summary['po_map'][1][:3] == [2., 3., 45.]
+
+def test_running_tuning_without_oris(tuned):
+    # condition numbers (MATLAB's vis_id) aren't angles, no pref/OSI from them
+    traces, oris = tuned
+    running = RunningTuning((0, 15, 20, 30), oris=False)
+    for i, ori in enumerate(oris):
+        running.add(traces[:, i], ori // 45 + 1)
+    
+    results = running.results()
+    assert 'osi' not in results and 'pref' not in results
+    assert results['vis_resp'].all()
+    summary = running.summary(coms=np.arange(8).reshape(4, 2))
+    assert 'po_map' not in summary and 'osi_hist' not in summary
+    # best condition is either direction of the preferred orientation
+    assert [(row[2] - 1) % 4 for row in summary['resp_map']] == [0, 1, 2, 3]
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats as stats
+
+from live2p.analysis.vis import find_vis_resp, trial_tensor
+
+@pytest.fixture
+def mdf():
+    # mean dataframe with unequal trials per ori, every 3rd cell responds to 90
+    rng = np.random.default_rng(0)
+    rows = []
+    for cell in range(12):
+        for ori in [0, 45, 90, 135]:
+            for _ in range(rng.integers(4, 8)):
+                rows.append((cell, ori, len(rows), rng.standard_normal() + (cell % 3 == 0) * (ori == 90) * 3))
+    return pd.DataFrame(rows, columns=['cell', 'ori', 'trial', 'df'])
+
+def _samples(mdf, cell):
+    return [g.df.values for _, g in mdf[mdf.cell == cell].groupby('ori')]
+
+def test_trial_tensor_pads(mdf):
+    tensor, conds = trial_tensor(mdf)
+    assert tensor.shape[:2] == (12, 4) and np.array_equal(conds, [0, 45, 90, 135])
+    assert (~np.isnan(tensor)).sum() == len(mdf)
+
+def test_anova_matches_scipy(mdf):
+    _, p_vals = find_vis_resp(mdf)
+    expected = [stats.f_oneway(*_samples(mdf, c)).pvalue for c in range(12)]
+    assert np.allclose(p_vals, expected)
+
+def test_kruskal_matches_scipy(mdf):
+    _, p_vals = find_vis_resp(mdf, test='kruskal')
+    expected = [stats.kruskal(*_samples(mdf, c)).pvalue for c in range(12)]
+    assert np.allclose(p_vals, expected)
+
+def test_shuffle_finds_responsive(mdf):
+    cells, p_vals = find_vis_resp(mdf, test='shuffle', n_shuffles=200, seed=0)
+    assert set([0, 3, 6, 9]) <= set(cells)
+    assert p_vals.min() >= 1 / 201
@@ -0,0 +1,38 @@
+import subprocess
+import sys
+
+from live2p.cli import make_args
+from live2p.warmup import Warmup, _parse_importtime, profile_imports
+
+
+def test_warmup_imports_in_background():
+    warmup = Warmup(modules=('json', 'not_a_real_module_live2p')).start()
+    assert warmup.wait(timeout=10)
+    assert warmup.done
+    assert set(warmup.timings) == {'json', 'not_a_real_module_live2p'}
+    assert list(warmup.errors) == ['not_a_real_module_live2p']
+    assert '(failed)' in warmup.describe()
+
+def test_parse_importtime():
+    assert _parse_importtime('import time: self [us] | cumulative | imported package') is None
+    assert _parse_importtime('import time:       120 |        480 |   scipy.fft') == (120, 'scipy.fft')
+    assert _parse_importtime('something else') is None
+
+def test_profile_imports():
+    report = profile_imports(startup=('json',), heavy=('decimal', 'not_a_real_module_live2p'))
+    assert 'start-up' in report and 'warm-up' in report
+    assert 'decimal' in report.split('warm-up')[1]
+    assert 'failed' not in report
+
+def test_cli_flag():
+    args = make_args().parse_args(['--profile-imports'])
+    assert args.profile_imports
+    assert not make_args().parse_args([]).profile_imports
+
+def test_server_import_is_light():
+    # the socket is opened before the heavy modules (and the tkinter GUI) are imported
+    heavy = ('caiman', 'live2p.utils', 'live2p.workers', 'tkinter', 'pandas')
+    code = f'import sys, live2p.websockets.server; print([m for m in {heavy!r} if m in sys.modules])'
+    proc = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.strip() == '[]'
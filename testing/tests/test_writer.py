@@ -0,0 +1,52 @@
+import json
+import threading
+
+import numpy as np
+import scipy.io as sio
+
+from live2p.writer import ResultWriter, dump_json, save_mat, save_npy, write_bytes
+
+
+def test_writes_each_destination(tmp_path):
+    dests = [tmp_path/'a', tmp_path/'b']
+    for d in dests:
+        d.mkdir()
+    data = np.arange(6.).reshape(2, 3)
+    payload = dump_json({'raw_traces': data.tolist()})
+
+    writer = ResultWriter(max_workers=3)
+    futures = []
+    for d in dests:
+        futures.append(writer.submit(str(d/'raw.json'), write_bytes, d/'raw.json', payload))
+        futures.append(writer.submit(str(d/'traces.npy'), save_npy, d/'traces.npy', data))
+        futures.append(writer.submit(str(d/'data.mat'), save_mat, d/'data.mat', {'onlineTraces': data}))
+    assert writer.wait(futures)
+    writer.close()
+
+    for d in dests:
+        assert json.loads((d/'raw.json').read_text())['raw_traces'] == data.tolist()
+        np.testing.assert_array_equal(np.load(d/'traces.npy'), data)
+        np.testing.assert_array_equal(sio.loadmat(str(d/'data.mat'))['onlineTraces'], data)
+    assert len(writer.timings) == 6
+    assert 'Wrote 6 artifacts' in writer.report()
+
+def test_failures_are_reported(tmp_path):
+    writer = ResultWriter()
+    ok = writer.submit('ok', write_bytes, tmp_path/'ok.json', b'{}')
+    bad = writer.submit('bad', write_bytes, tmp_path/'missing'/'bad.json', b'{}')
+    assert writer.wait([ok])
+    assert not writer.wait([bad])
+    assert 'bad' in writer.errors
+    assert '(failed)' in writer.report()
+    writer.close()
+
+def test_wait_only_waits_for_given_futures():
+    writer = ResultWriter(max_workers=2)
+    release = threading.Event()
+    slow = writer.submit('slow', release.wait)
+    fast = writer.submit('fast', lambda: None)
+    assert writer.wait([fast])
+    assert not slow.done()
+    release.set()
+    writer.close()
+    assert slow.done()